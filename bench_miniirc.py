@@ -0,0 +1,591 @@
+#!/usr/bin/python3
+#
+# miniirc benchmarks
+#
+# Usage: python3 bench_miniirc.py [--json FILE] [--compare FILE]
+#                                  [benchmark names...]
+# These don't need a network connection or an IRC server.
+#
+# To check for performance regressions, save a baseline with
+# "--json baseline.json" before making changes and then run the benchmarks
+# again with "--compare baseline.json". The exit status is 1 if any
+# benchmark is more than --threshold (default 10%) slower than the baseline.
+#
+
+import argparse, collections, gc, json, miniirc, miniirc_testserver, os
+import socket, ssl, sys, threading, time, tracemalloc
+
+# Units where smaller values are better, everything else is a rate.
+lower_is_better = frozenset(('bytes', 'ms'))
+
+benchmarks = {}
+
+
+def benchmark(func):
+    benchmarks[func.__name__] = func
+    return func
+
+
+def _dummy_irc(**kwargs):
+    return miniirc.IRC('', 0, 'miniirc-bench', auto_connect=False, **kwargs)
+
+
+# Dispatch lines to handlers and wait for every handler call to finish.
+# Returns lines per second.
+def _dispatch(executor, lines=20000, handlers=2):
+    irc = _dummy_irc(executor=executor)
+    remaining = lines * handlers
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def make_handler():
+        def handler(irc, hostmask, args):
+            nonlocal remaining
+            with lock:
+                remaining -= 1
+                if remaining == 0:
+                    done.set()
+        return handler
+
+    for _ in range(handlers):
+        irc.Handler('PRIVMSG', colon=False)(make_handler())
+
+    msg = miniirc.ircv3_message_parser(
+        ':nick!user@host PRIVMSG #channel :Hello world!'
+    )
+    start = time.perf_counter()
+    for _ in range(lines):
+        irc._handle(*msg)
+    done.wait()
+    return lines / (time.perf_counter() - start)
+
+
+# Some realistic IRC traffic
+traffic = [
+    '@time=2024-12-09T12:34:56.789Z;msgid=Ay4Fuv3Hm2hZGdJ9r6YuTX;account=nick '
+    ':nick!~user@user.example.com PRIVMSG #channel :Hello world, this is a '
+    'fairly typical message.',
+    '@batch=1a2b3c;time=2024-12-09T12:34:57.001Z;msgid=qH2nJ4w5N3 '
+    ':relay!relay@2001:db8::1 PRIVMSG #channel :' + 'Lorem ipsum dolor sit '
+    'amet, consectetur adipiscing elit. ' * 10,
+    '@+draft/reply=Ay4Fuv3Hm2hZGdJ9r6YuTX;+typing=active;'
+    'label=a\\sb\\:c\\\\d :nick!~user@user.example.com TAGMSG #channel',
+    ':irc.example.com 353 nick = #channel :@op +voice ' +
+    ' '.join('user{}'.format(i) for i in range(40)),
+    ':irc.example.com 005 nick CHANTYPES=# PREFIX=(ov)@+ NETWORK=Example '
+    'TARGMAX=PRIVMSG:4,NOTICE:4 :are supported by this server',
+    '@time=2024-12-09T12:34:58.000Z :nick!~user@user.example.com JOIN '
+    '#channel account :Real Name',
+    'PING :irc.example.com',
+]
+
+
+# The message parser from miniirc v1.10.0, for comparison
+def _legacy_tags_to_dict(tag_list, separator=';'):
+    tags = {}
+    if separator:
+        tag_list = tag_list.split(separator)
+    for tag in tag_list:
+        tag = tag.split('=', 1)
+        if len(tag) == 1:
+            tags[tag[0]] = True
+        elif len(tag) == 2:
+            if '\\' in tag[1]:
+                value = ''
+                escape = False
+                for char in tag[1]:
+                    if escape:
+                        value += miniirc.ircv3_tag_escapes.get(char, char)
+                        escape = False
+                    elif char == '\\':
+                        escape = True
+                    else:
+                        value += char
+            else:
+                value = tag[1] or True
+            tags[tag[0]] = value
+
+    return tags
+
+
+def legacy_ircv3_message_parser(msg):
+    n = msg.split(' ')
+    if n[0].startswith('@'):
+        tags = _legacy_tags_to_dict(n.pop(0)[1:])
+    else:
+        tags = {}
+
+    if n[0].startswith(':'):
+        while len(n) < 2:
+            n.append('')
+        hostmask = n[0][1:].split('!', 1)
+        if len(hostmask) < 2:
+            hostmask.append(hostmask[0])
+        i = hostmask[1].split('@', 1)
+        if len(i) < 2:
+            i.append(i[0])
+        hostmask = (hostmask[0], i[0], i[1])
+        cmd = n[1]
+    else:
+        cmd = n[0]
+        hostmask = (cmd, cmd, cmd)
+        n.insert(0, '')
+
+    args = []
+    c = 1
+    for word in n[2:]:
+        c += 1
+        if word.startswith(':'):
+            args.append(' '.join(n[c:]))
+            break
+        elif word:
+            args.append(word)
+        else:
+            raise ValueError('Ambiguous IRC message')
+
+    return cmd, hostmask, tags, args
+
+
+# Run func(line) for every line in traffic and return lines per second
+def _per_line(func, lines=traffic, repeat=20000):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for line in lines:
+            func(line)
+    return repeat * len(lines) / (time.perf_counter() - start)
+
+
+# IRC objects use _lazy_message_parser, ircv3_message_parser decodes tags
+# straight away.
+@benchmark
+def parse():
+    return _per_line(miniirc._lazy_message_parser), 'lines/s'
+
+
+@benchmark
+def parse_eager():
+    return _per_line(miniirc.ircv3_message_parser), 'lines/s'
+
+
+@benchmark
+def parse_and_read_tags():
+    parse = miniirc._lazy_message_parser
+    return _per_line(lambda line: parse(line)[2].get('time')), 'lines/s'
+
+
+@benchmark
+def parse_legacy():
+    return _per_line(legacy_ircv3_message_parser), 'lines/s'
+
+
+# Decode the tags of every line in traffic that has tags
+_tag_lists = [line[1:].split(' ', 1)[0] for line in traffic
+              if line.startswith('@')]
+
+
+@benchmark
+def decode_tags():
+    return _per_line(miniirc._tags_to_dict, _tag_lists, 50000), 'tags/s'
+
+
+# Split received data into lines, the parser just counts them
+@benchmark
+def receive(repeat=2000):
+    irc = _dummy_irc()
+    count = 0
+
+    def parser(line):
+        nonlocal count
+        count += 1
+
+    irc.change_parser(parser)
+    data = ''.join(line + '\r\n' for line in traffic).encode('utf-8') * 20
+    chunks = [data[i:i + 8192] for i in range(0, len(data), 8192)]
+    buffer = miniirc._RecvBuffer()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for chunk in chunks:
+            buffer.feed(chunk)
+            irc._handle_lines(buffer)
+    return count / (time.perf_counter() - start), 'lines/s'
+
+
+# Encode the same message with the same tags repeatedly
+def _encode(tags, repeat=200000):
+    irc = _dummy_irc()
+    irc.connected = True
+    irc.active_caps.add('message-tags')
+    irc._write = lambda msg, force: None
+    start = time.perf_counter()
+    for _ in range(repeat):
+        irc.msg('#channel', 'Hello world!', tags=tags)
+    return repeat / (time.perf_counter() - start), 'lines/s'
+
+
+_tags = {'+draft/reply': 'Ay4Fuv3Hm2hZGdJ9r6YuTX', 'label': 'a b;c'}
+
+
+@benchmark
+def encode_tags_dict():
+    return _encode(_tags)
+
+
+@benchmark
+def encode_tags_object():
+    return _encode(miniirc.Tags(_tags))
+
+
+@benchmark
+def encode_tags_uncached():
+    return _encode(collections.OrderedDict(_tags, unhashable=['x']))
+
+
+# Send pre-encoded messages with quote_raw() and the same messages with
+# quote()
+def _send(func, msg, repeat=200000, **kwargs):
+    irc = _dummy_irc(**kwargs)
+    irc.connected = True
+    irc._write = lambda msg, force: None
+    func = getattr(irc, func)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(msg)
+    return repeat / (time.perf_counter() - start), 'lines/s'
+
+
+@benchmark
+def send_str():
+    return _send('quote', traffic[0].split(' ', 2)[2])
+
+
+@benchmark
+def send_raw():
+    return _send('quote_raw', traffic[0].split(' ', 2)[2].encode('utf-8'))
+
+
+# Send messages with debug mode on, writing debug messages to a file
+@benchmark
+def send_debug_file():
+    with open(os.devnull, 'w') as f:
+        return _send('quote', traffic[0].split(' ', 2)[2], debug=f)
+
+
+@benchmark
+def send_debug_log():
+    with open(os.devnull, 'w') as f:
+        log = miniirc.DebugLog(f, max_records=1024)
+        result = _send('quote', traffic[0].split(' ', 2)[2], debug=log)
+        log.flush()
+        return result
+
+
+# Runs handlers immediately so that only miniirc's dispatch code is measured
+class _InlineExecutor:
+    @staticmethod
+    def submit(func, *args):
+        func(*args)
+
+
+# Dispatch a parsed line to N handlers
+def _dispatch_inline(handlers, lines=50000):
+    irc = _dummy_irc(executor=_InlineExecutor())
+    for _ in range(handlers):
+        irc.Handler('PRIVMSG', colon=False)(lambda irc, hostmask, args: None)
+    msg = miniirc.ircv3_message_parser(traffic[0])
+    start = time.perf_counter()
+    for _ in range(lines):
+        irc._handle(*msg)
+    return lines / (time.perf_counter() - start), 'lines/s'
+
+
+@benchmark
+def dispatch_1_handler():
+    return _dispatch_inline(1)
+
+
+@benchmark
+def dispatch_10_handlers():
+    return _dispatch_inline(10)
+
+
+# Dispatch to 10 handlers that are each filtered to a different channel, only
+# one of which matches
+@benchmark
+def dispatch_10_filtered_handlers(lines=50000):
+    irc = _dummy_irc(executor=_InlineExecutor())
+    for i in range(10):
+        irc.Handler('PRIVMSG', colon=False, target='#channel' + str(i or ''))(
+            lambda irc, hostmask, args: None
+        )
+    msg = miniirc.ircv3_message_parser(traffic[0])
+    start = time.perf_counter()
+    for _ in range(lines):
+        irc._handle(*msg)
+    return lines / (time.perf_counter() - start), 'lines/s'
+
+
+# Send messages through a real (local) socket
+@benchmark
+def send_socketpair(repeat=100000):
+    irc = _dummy_irc()
+    irc.connected = True
+    irc.sock, other = socket.socketpair()
+    irc.sock.setblocking(False)
+    received = 0
+
+    def drain():
+        nonlocal received
+        while True:
+            data = other.recv(65536)
+            if not data:
+                return
+            received += len(data)
+
+    thread = threading.Thread(target=drain)
+    thread.start()
+    try:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            irc.msg('#channel', 'Hello world!')
+        elapsed = time.perf_counter() - start
+    finally:
+        irc.sock.shutdown(socket.SHUT_WR)
+        thread.join()
+        irc.sock.close()
+        other.close()
+    assert received == repeat * len(b'PRIVMSG #channel :Hello world!\r\n')
+    return repeat / elapsed, 'lines/s'
+
+
+# The memory used by an IRC object that is connected but idle, including its
+# receive buffer and cached handler dispatch tables. The PING line in traffic
+# is skipped because there's no socket to send the PONG to.
+@benchmark
+def memory_per_connection(count=100):
+    ircs = []
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for _ in range(count):
+            irc = _dummy_irc(executor=_InlineExecutor())
+            irc.connected = True
+            irc._reactor_buffer = miniirc._RecvBuffer()
+            for line in traffic[:-1]:
+                irc._handle(*miniirc.ircv3_message_parser(line))
+            ircs.append(irc)
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    return used / count, 'bytes'
+
+
+# The memory used by StateTracker per user, with 100k users spread across 100
+# channels (each user is in two channels).
+@benchmark
+def state_tracker_memory_per_user(users=100000, channels=100):
+    tracker = miniirc.StateTracker()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        tracker._update('001', ('server',) * 3, ['miniirc-bench', ':Welcome'])
+        for i in range(channels):
+            tracker._update('JOIN', ('miniirc-bench', 'bench', 'host'),
+                            ['#channel{}'.format(i)])
+        for i in range(users):
+            hostmask = ('user{}'.format(i), 'ident', 'host.example.com')
+            for j in (i, i + 1):
+                tracker._update('JOIN', hostmask,
+                                ['#channel{}'.format(j % channels)])
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    assert len(tracker.users()) == users + 1
+    return used / users, 'bytes'
+
+
+# Lines per second with channel state tracking enabled
+@benchmark
+def dispatch_state_tracker(lines=50000):
+    irc = _dummy_irc(executor=_InlineExecutor(),
+                     state_tracker=miniirc.StateTracker())
+    irc.Handler('PRIVMSG', colon=False)(lambda irc, hostmask, args: None)
+    irc._handle(*miniirc.ircv3_message_parser(
+        ':miniirc-bench!bench@host JOIN #channel'))
+    msgs = [miniirc.ircv3_message_parser(line) for line in (
+        ':nick!~user@host JOIN #channel',
+        traffic[0],
+        ':nick!~user@host NICK nick_',
+        ':nick_!~user@host PART #channel :Bye',
+    )]
+    start = time.perf_counter()
+    for _ in range(lines // len(msgs)):
+        for msg in msgs:
+            irc._handle(*msg)
+    return lines / (time.perf_counter() - start), 'lines/s'
+
+
+# Get an SSL context like connect() does
+@benchmark
+def ssl_context_cached(repeat=1000):
+    irc = _dummy_irc()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        irc._get_ssl_context()
+    return repeat / (time.perf_counter() - start), 'contexts/s'
+
+
+# What miniirc used to do on every connection
+@benchmark
+def ssl_context_uncached(repeat=20):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        ssl.create_default_context(cafile=miniirc.get_ca_certs())
+    return repeat / (time.perf_counter() - start), 'contexts/s'
+
+
+# End-to-end benchmarks with miniirc_testserver. Every client has a PRIVMSG
+# handler, so these also include parsing and running handlers.
+def _e2e(func, clients=10, irc_kwargs={}, **kwargs):
+    with miniirc_testserver.TestServer(**kwargs) as server:
+        ircs = [server.connect_irc('bench{}'.format(i), persist=True,
+                                   **irc_kwargs)
+                for i in range(clients)]
+        try:
+            server.wait_for_clients(clients)
+            return func(server, ircs)
+        finally:
+            for irc in ircs:
+                irc.disconnect()
+
+
+@benchmark
+def e2e_throughput():
+    report = _e2e(lambda server, ircs:
+                  miniirc_testserver.measure_load(server, ircs, 5000))
+    return report.throughput, 'lines/s'
+
+
+# The 99th percentile latency at 1,000 lines per second per client
+@benchmark
+def e2e_latency_p99():
+    report = _e2e(lambda server, ircs: miniirc_testserver.measure_load(
+        server, ircs, 2000, rate=1000
+    ))
+    return report.latency_p99 * 1000, 'ms'
+
+
+# A server that sends data in small chunks
+@benchmark
+def e2e_partial_writes():
+    report = _e2e(lambda server, ircs:
+                  miniirc_testserver.measure_load(server, ircs, 1000),
+                  write_size=100)
+    return report.throughput, 'lines/s'
+
+
+# How long it takes for every client to reconnect after the server
+# disconnects all of them (with the default ReconnectPolicy, which tries to
+# reconnect immediately)
+@benchmark
+def e2e_reconnect():
+    times = _e2e(lambda server, ircs:
+                 miniirc_testserver.measure_reconnect(server, len(ircs)),
+                 irc_kwargs={'reconnect_policy': miniirc.ReconnectPolicy()})
+    return times[-1] * 1000, 'ms'
+
+
+@benchmark
+def dispatch_thread_per_call():
+    return _dispatch(miniirc.HandlerPool(0)), 'lines/s'
+
+
+@benchmark
+def dispatch_pooled():
+    return _dispatch(miniirc.HandlerPool()), 'lines/s'
+
+
+# Runs a benchmark "repeat" times and returns the best result
+def run(name, repeat=1):
+    results = [benchmarks[name]() for _ in range(repeat)]
+    unit = results[0][1]
+    best = min if unit in lower_is_better else max
+    return best(value for value, _ in results), unit
+
+
+# Returns how much worse (as a fraction) value is than the baseline value
+def regression(value, baseline, unit):
+    if unit in lower_is_better:
+        return value / baseline - 1
+    return baseline / value - 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs miniirc benchmarks.')
+    parser.add_argument('names', nargs='*', metavar='benchmark',
+                        help='The benchmarks to run (default: all).')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Run each benchmark this many times and use '
+                             'the best result (default: 1).')
+    parser.add_argument('--json', metavar='FILE',
+                        help='Write the results to FILE as JSON ("-" for '
+                             'stdout).')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='Compare the results with a JSON file created '
+                             'with --json.')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='The largest allowed regression when using '
+                             '--compare (default: 0.1, which is 10%%).')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['benchmarks']
+
+    names = args.names or sorted(benchmarks)
+    for name in names:
+        if name not in benchmarks:
+            parser.error('Unknown benchmark: {!r}'.format(name))
+
+    results = {}
+    regressions = []
+    log = sys.stderr if args.json == '-' else sys.stdout
+    for name in names:
+        value, unit = run(name, args.repeat)
+        results[name] = {'value': value, 'unit': unit}
+        line = '{}: {:,.0f} {}'.format(name, value, unit)
+        if name in baseline and baseline[name]['unit'] == unit:
+            change = regression(value, baseline[name]['value'], unit)
+            line += ' ({:+.1%} vs baseline)'.format(-change or 0.0)
+            if change > args.threshold:
+                regressions.append(name)
+                line += ' REGRESSION'
+        print(line, file=log)
+
+    if args.json:
+        data = {
+            'python': sys.version.split()[0],
+            'miniirc': miniirc.__version__,
+            'benchmarks': results,
+        }
+        if args.json == '-':
+            json.dump(data, sys.stdout, indent=4, sort_keys=True)
+            print()
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(data, f, indent=4, sort_keys=True)
+                f.write('\n')
+
+    if regressions:
+        print('{} benchmark(s) regressed by more than {:.0%}: {}'.format(
+            len(regressions), args.threshold, ', '.join(regressions)
+        ), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
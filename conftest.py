@@ -0,0 +1,5 @@
+import sys
+
+# test_miniirc_asyncio.py uses syntax that older Python versions can't parse
+if sys.version_info < (3, 7):
+    collect_ignore = ['test_miniirc_asyncio.py']
@@ -5,7 +5,9 @@
 # © 2018-2022 by luk3yx and other contributors of miniirc.
 #
 
-import atexit, threading, time, select, socket, ssl, sys, warnings
+import atexit, bisect, collections, collections.abc, functools, heapq
+import errno, itertools, os, queue, random, re, threading, time, select
+import selectors, socket, ssl, sys, traceback, types, warnings, weakref
 
 # The version string and tuple
 ver = __version_info__ = (1, 10, 0)
@@ -13,7 +15,10 @@ version = 'miniirc IRC framework v1.10.0'
 __version__ = '1.10.0'
 
 # __all__ and _default_caps
-__all__ = ['CmdHandler', 'Handler', 'IRC']
+__all__ = ['ChannelState', 'CmdHandler', 'DebugLog', 'FloodControl',
+           'Handler', 'HandlerPool', 'HandlerProfiler', 'IRC', 'Message',
+           'Metrics', 'Reactor', 'ReconnectPolicy', 'Resolver',
+           'StateTracker', 'Tags', 'UserState', 'prometheus_metrics']
 _default_caps = {'account-tag', 'away-notify', 'cap-notify', 'chghost',
                  'draft/message-tags-0.2', 'invite-notify', 'message-tags',
                  'oragono.io/maxline-2', 'server-time', 'sts'}
@@ -27,11 +32,63 @@ except ImportError:
 
 # Create global handlers
 _global_handlers = {}
+_global_handler_filters = {}
 _colon_warning = False
 
-
-def _add_handler(handlers, events, ircv3, cmd_arg, colon):
-    if (colon and _colon_warning and
+# This is incremented whenever a handler is added so that IRC objects know
+# when to rebuild their dispatch tables.
+_handler_generation = 0
+
+
+# Handler filters are set with the target, sender, prefix and pattern keyword
+# arguments to Handler() and CmdHandler(). Targets are indexed when IRC objects
+# build their dispatch tables, and the other filters are checked before the
+# handler is submitted to the executor.
+class _HandlerFilter:
+    __slots__ = ('pattern', 'prefix', 'senders', 'targets')
+
+    def __init__(self, targets, senders, prefix, pattern):
+        self.targets = targets
+        self.senders = senders
+        self.prefix = prefix
+        self.pattern = pattern
+
+
+def _str_tuple(value):
+    if value is None:
+        return None
+    elif isinstance(value, str):
+        return (value,)
+    return tuple(value)
+
+
+def _make_filter(target, sender, prefix, pattern):
+    if target is None and sender is None and prefix is None and \
+            pattern is None:
+        return None
+    if isinstance(pattern, str):
+        pattern = re.compile(pattern)
+    return _HandlerFilter(_str_tuple(target), _str_tuple(sender),
+                          _str_tuple(prefix), pattern)
+
+
+# Converts nick!user@host masks (with * and ? wildcards) into a regex. Masks
+# without "!" or "@" only match nicknames.
+def _compile_masks(masks):
+    res = []
+    for mask in masks:
+        if '!' not in mask and '@' not in mask:
+            mask += '!*@*'
+        res.append(re.escape(mask).replace('\\*', '.*').replace('\\?', '.'))
+    return re.compile('(?:' + '|'.join(res) + ')\\Z', re.DOTALL)
+
+
+# Filters are stored in "filters" (indexed by (event, func)) rather than on
+# the function, so the same function can be registered for different events
+# or IRC objects with different filters.
+def _add_handler(handlers, events, ircv3, cmd_arg, colon, message=False,
+                 filter=None, filters=None):
+    if (colon and not message and _colon_warning and
             not all(str(e).upper().startswith('IRCV3 ') for e in events)):
         warnings.warn('Using colon=True or not specifying the colon '
                       'keyword argument to miniirc.Handler is deprecated.',
@@ -43,6 +100,8 @@ def _add_handler(handlers, events, ircv3, cmd_arg, colon):
         events = (None,)
 
     def add_handler(func):
+        global _handler_generation
+        _handler_generation += 1
         for event in events:
             if event is not None:
                 event = str(event).upper()
@@ -50,6 +109,10 @@ def _add_handler(handlers, events, ircv3, cmd_arg, colon):
                 handlers[event] = []
             if func not in handlers[event]:
                 handlers[event].append(func)
+            if filter is not None:
+                filters[(event, func)] = filter
+            elif filters is not None:
+                filters.pop((event, func), None)
 
         f = getattr(func, '__func__', func)
         if ircv3:
@@ -58,97 +121,254 @@ def _add_handler(handlers, events, ircv3, cmd_arg, colon):
             f.miniirc_cmd_arg = True
         if colon:
             f.miniirc_colon = True
+        if message:
+            f.miniirc_message = True
         return func
 
     return add_handler
 
 
-def Handler(*events, ircv3=False, colon=True):
-    return _add_handler(_global_handlers, events, ircv3, False, colon)
-
-
-def CmdHandler(*events, ircv3=False, colon=True):
-    return _add_handler(_global_handlers, events, ircv3, True, colon)
+# Functions that create the parameters passed to handlers, indexed by
+# (colon, ircv3, cmd_arg). "args" has the leading colon of the last argument
+# and "stripped" doesn't.
+_param_builders = {
+    (True, False, False):
+        lambda irc, cmd, hostmask, tags, args, stripped:
+            (irc, hostmask, list(args)),
+    (False, False, False):
+        lambda irc, cmd, hostmask, tags, args, stripped:
+            (irc, hostmask, list(stripped)),
+    (True, True, False):
+        lambda irc, cmd, hostmask, tags, args, stripped:
+            (irc, hostmask, _copy_tags(tags), list(args)),
+    (False, True, False):
+        lambda irc, cmd, hostmask, tags, args, stripped:
+            (irc, hostmask, _copy_tags(tags), list(stripped)),
+    (True, False, True):
+        lambda irc, cmd, hostmask, tags, args, stripped:
+            (irc, cmd, hostmask, list(args)),
+    (False, False, True):
+        lambda irc, cmd, hostmask, tags, args, stripped:
+            (irc, cmd, hostmask, list(stripped)),
+    (True, True, True):
+        lambda irc, cmd, hostmask, tags, args, stripped:
+            (irc, cmd, hostmask, _copy_tags(tags), list(args)),
+    (False, True, True):
+        lambda irc, cmd, hostmask, tags, args, stripped:
+            (irc, cmd, hostmask, _copy_tags(tags), list(stripped)),
+}
+
+
+# Message handlers are called with (irc, message) and don't have a builder.
+def _get_param_builder(handler):
+    if hasattr(handler, 'miniirc_message'):
+        return None
+    return _param_builders[(hasattr(handler, 'miniirc_colon'),
+                            hasattr(handler, 'miniirc_ircv3'),
+                            hasattr(handler, 'miniirc_cmd_arg'))]
+
+
+def Handler(*events, ircv3=False, colon=True, message=False, target=None,
+            sender=None, prefix=None, pattern=None):
+    return _add_handler(_global_handlers, events, ircv3, False, colon, message,
+                        _make_filter(target, sender, prefix, pattern),
+                        _global_handler_filters)
+
+
+def CmdHandler(*events, ircv3=False, colon=True, message=False, target=None,
+               sender=None, prefix=None, pattern=None):
+    return _add_handler(_global_handlers, events, ircv3, True, colon, message,
+                        _make_filter(target, sender, prefix, pattern),
+                        _global_handler_filters)
 
 
 # Parse IRCv3 tags
 ircv3_tag_escapes = {':': ';', 's': ' ', 'r': '\r', 'n': '\n'}
 
 
+# Un-escape a tag value by splitting it at every backslash, the first
+# character of every part after a backslash is looked up in
+# ircv3_tag_escapes.
+def _unescape_tag(value):
+    parts = value.split('\\')
+    res = [parts[0]]
+    get_escape = ircv3_tag_escapes.get
+    i = 1
+    length = len(parts)
+    while i < length:
+        part = parts[i]
+        if part:
+            res.append(get_escape(part[0], part[0]))
+            res.append(part[1:])
+        elif i + 1 < length:
+            # An escaped backslash, the next part isn't escaped
+            res.append('\\')
+            i += 1
+            res.append(parts[i])
+        i += 1
+    return ''.join(res)
+
+
+# Tag keys that are sent with most messages. These are interned so that every
+# message doesn't get its own copy of them, and so that looking them up is
+# faster.
+_common_tag_keys = {key: sys.intern(key) for key in (
+    'account', 'batch', 'label', 'msgid', 'time', '+draft/reply',
+    '+draft/react', '+typing',
+)}
+
+
 def _tags_to_dict(tag_list, separator=';'):
     tags = {}
     if separator:
         tag_list = tag_list.split(separator)
+    intern = _common_tag_keys.get
     for tag in tag_list:
-        tag = tag.split('=', 1)
-        if len(tag) == 1:
-            tags[tag[0]] = True
-        elif len(tag) == 2:
-            if '\\' in tag[1]:  # Iteration is bad, only do it if required.
-                value = ''
-                escape = False
-                for char in tag[1]:  # TODO: Remove this iteration.
-                    if escape:
-                        value += ircv3_tag_escapes.get(char, char)
-                        escape = False
-                    elif char == '\\':
-                        escape = True
-                    else:
-                        value += char
-            else:
-                value = tag[1] or True
-            tags[tag[0]] = value
+        key, sep, value = tag.partition('=')
+        key = intern(key, key)
+        if not sep:
+            tags[key] = True
+        elif '\\' in value:
+            tags[key] = _unescape_tag(value)
+        else:
+            tags[key] = value or True
 
     return tags
 
 
-# Create the IRCv2/3 parser
-def ircv3_message_parser(msg):
-    n = msg.split(' ')
+# A read-only mapping of IRCv3 tags that is only decoded when it is first
+# used, most handlers never look at tags. This isn't a dict subclass because
+# C code (such as json.dumps()) would read the (empty) dict directly.
+class _LazyTags(collections.abc.Mapping):
+    __slots__ = ('_raw', '_tags')
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._tags = None
+
+    # If two threads decode the tags at the same time, one dict is discarded
+    def _decode(self):
+        tags = self._tags
+        if tags is None:
+            tags = self._tags = _tags_to_dict(self._raw)
+        return tags
+
+    def __getitem__(self, key):
+        return self._decode()[key]
+
+    def __contains__(self, key):
+        return key in self._decode()
+
+    def __iter__(self):
+        return iter(self._decode())
+
+    def __len__(self):
+        return len(self._decode())
+
+    def __repr__(self):
+        return repr(self._decode())
+
+    def get(self, key, default=None):
+        return self._decode().get(key, default)
+
+    def copy(self):
+        return self._decode().copy()
+
+    def __reduce__(self):
+        return dict, (self.copy(),)
+
+
+# Copy tags before passing them to a handler, _LazyTags objects are decoded
+# first.
+def _copy_tags(tags):
+    if type(tags) is _LazyTags:
+        return tags.copy()
+    return dict(tags)
 
+
+# Create the IRCv2/3 parser
+def ircv3_message_parser(msg, *, _tags_type=_tags_to_dict):
     # Process IRCv3 tags
-    if n[0].startswith('@'):
-        tags = _tags_to_dict(n.pop(0)[1:])
+    if msg[:1] == '@':
+        raw_tags, sep, msg = msg.partition(' ')
+        if not sep:
+            raise ValueError('No command in IRC message')
+        tags = _tags_type(raw_tags[1:])
     else:
         tags = {}
 
-    # Process arguments
-    if n[0].startswith(':'):
-        while len(n) < 2:
-            n.append('')
-        hostmask = n[0][1:].split('!', 1)
-        if len(hostmask) < 2:
-            hostmask.append(hostmask[0])
-        i = hostmask[1].split('@', 1)
-        if len(i) < 2:
-            i.append(i[0])
-        hostmask = (hostmask[0], i[0], i[1])
-        cmd = n[1]
+    # Process the hostmask
+    if msg[:1] == ':':
+        prefix, _, msg = msg.partition(' ')
+        nick, sep, host = prefix[1:].partition('!')
+        if not sep:
+            host = nick
+        ident, sep, host = host.partition('@')
+        if not sep:
+            host = ident
+        hostmask = (nick, ident, host)
+        cmd, sep, msg = msg.partition(' ')
     else:
-        cmd = n[0]
+        cmd, sep, msg = msg.partition(' ')
         hostmask = (cmd, cmd, cmd)
-        n.insert(0, '')
-
-    # Get the command and arguments
-    args = []
-    c = 1
-    for word in n[2:]:
-        c += 1
-        if word.startswith(':'):
-            args.append(' '.join(n[c:]))
-            break
-        elif word:
-            args.append(word)
+
+    # Get the arguments, everything after " :" is one argument
+    if not sep:
+        args = []
+    elif msg[:1] == ':':
+        args = [msg]
+    else:
+        i = msg.find(' :')
+        if i < 0:
+            args = msg.split(' ')
         else:
+            args = msg[:i].split(' ')
+        if '' in args:
             # RFC 1459 allows multiple spaces to separate parameters, but this
             # is very uncommon and could possibly happen if a server tries to
             # send an empty parameter
             raise ValueError('Ambiguous IRC message')
+        if i >= 0:
+            args.append(msg[i + 1:])
 
     # Return the parsed data
     return cmd, hostmask, tags, args
 
 
+# IRC objects that use the default parser use this instead, tags are decoded
+# when they're first used. Handlers always get a copy of the tags as a dict.
+_lazy_message_parser = functools.partial(ircv3_message_parser,
+                                         _tags_type=_LazyTags)
+
+
+# A read-only message passed to handlers created with message=True. Only one
+# Message object is created for each message, and it is shared between all of
+# the handlers. "args" doesn't have the leading colon of the last argument.
+class Message:
+    __slots__ = ('command', 'hostmask', 'tags', 'args', 'raw', 'received')
+
+    def __init__(self, command, hostmask, tags, args, raw=None,
+                 received=None):
+        setattr = object.__setattr__
+        setattr(self, 'command', command)
+        setattr(self, 'hostmask', tuple(hostmask))
+        setattr(self, 'tags', types.MappingProxyType(tags))
+        setattr(self, 'args', tuple(args))
+        setattr(self, 'raw', raw)
+        setattr(self, 'received', received)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Message objects are read-only.')
+
+    def __delattr__(self, name):
+        raise AttributeError('Message objects are read-only.')
+
+    def __repr__(self):
+        return '<miniirc.Message {!r} from {!r}: {!r}>'.format(
+            self.command, self.hostmask[0], self.args
+        )
+
+
 # Escape tags
 def _escape_tag(tag):
     tag = str(tag).replace('\\', '\\\\')
@@ -157,21 +377,114 @@ def _escape_tag(tag):
     return tag
 
 
-# Convert a dict into an IRCv3 tags string
-def _dict_to_tags(tags):
-    res = b'@'
-    for tag, value in tags.items():
+# Convert (tag, value) pairs into an IRCv3 tags string
+def _encode_tags(items):
+    res = []
+    size = 1
+    for tag, value in items:
         if value and value != '':
             etag = _escape_tag(tag).replace('=', '-')
             if value and isinstance(value, str):
                 etag += '=' + _escape_tag(value)
             etag = (etag + ';').encode('utf-8')
-            if len(res) + len(etag) > 4094:
+            size += len(etag)
+            if size > 4094:
                 break
-            res += etag
-    if len(res) < 3:
+            res.append(etag)
+    if not res:
         return b''
-    return res[:-1] + b' '
+    return b'@' + b''.join(res)[:-1] + b' '
+
+
+# The same tags tend to be sent over and over again, so encoded tags are
+# cached.
+_cached_encode_tags = functools.lru_cache(maxsize=256)(_encode_tags)
+
+
+# Convert a dict into an IRCv3 tags string. Only tags with str names and str or
+# True values are cached, other objects can compare equal to them but be
+# encoded differently (for example {1: True} and {True: True}).
+def _dict_to_tags(tags):
+    if type(tags) is Tags:
+        return tags._encoded
+    items = tuple(tags.items())
+    for tag, value in items:
+        if type(tag) is not str or (value is not True and
+                                    type(value) is not str):
+            return _encode_tags(items)
+    return _cached_encode_tags(items)
+
+
+# Pre-encoded IRCv3 tags that can be passed to irc.quote() (and irc.msg()
+# etc) instead of a dict. Tags objects can't be modified.
+class Tags(collections.abc.Mapping):
+    __slots__ = ('_encoded', '_tags')
+
+    def __init__(self, tags=(), **kwargs):
+        self._tags = dict(tags, **kwargs)
+        self._encoded = _encode_tags(self._tags.items())
+
+    def __getitem__(self, key):
+        return self._tags[key]
+
+    def __iter__(self):
+        return iter(self._tags)
+
+    def __len__(self):
+        return len(self._tags)
+
+    def __repr__(self):
+        return 'miniirc.Tags({!r})'.format(self._tags)
+
+
+# A receive buffer. Data is received directly into the buffer with
+# recv_into(), so incomplete lines aren't copied whenever more data arrives
+# and only new data is searched for line terminators. The buffer starts small
+# and only grows (up to max_size bytes) when an incomplete line needs the
+# space, most connections never need more than a few kilobytes.
+class _RecvBuffer:
+    __slots__ = ('data', 'view', 'end', 'scanned', 'max_size')
+
+    # Replace the buffer with a larger one that can hold at least "needed"
+    # bytes. If the buffer can't grow any further, ConnectionAbortedError is
+    # raised so that the connection is treated as lost.
+    def _grow(self, needed):
+        if needed > self.max_size:
+            raise ConnectionAbortedError('Very long line detected!')
+        size = len(self.data)
+        while size < needed:
+            size *= 2
+        data = bytearray(min(size, self.max_size))
+        data[:self.end] = self.view[:self.end]
+        self.data = data
+        self.view = memoryview(data)
+
+    # Returns a memoryview of the free space at the end of the buffer
+    def space(self):
+        # Receiving a handful of bytes at a time is slow, so the buffer is
+        # grown before it fills up completely.
+        size = len(self.data)
+        if size - self.end < 512 and size < self.max_size:
+            self._grow(size + 1)
+        elif self.end >= size:
+            raise ConnectionAbortedError('Very long line detected!')
+        return self.view[self.end:]
+
+    # Copy data into the buffer, used when recv_into() can't be used
+    def feed(self, data):
+        end = self.end + len(data)
+        if end >= len(self.data):
+            self._grow(end + 1)
+        self.data[self.end:end] = data
+        self.end = end
+
+    def __init__(self, size=4096, max_size=65536):
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+        self.max_size = max_size
+
+        # Everything before "scanned" is part of an incomplete line
+        self.end = self.scanned = 0
 
 
 # A wrapper for callable logfiles
@@ -191,6 +504,122 @@ class _Logfile:
         self._lock = threading.Lock()
 
 
+# Debug messages are put into categories based on their first argument. The
+# levels are logging.DEBUG and logging.INFO.
+_debug_categories = {'<<<': 'in', '>>>': 'out', '>3>': 'out', '>Q>': 'out'}
+_debug_levels = {'in': 10, 'out': 10, 'state': 20}
+
+
+# DebugLog objects are flushed when Python exits. This only keeps weak
+# references so that DebugLog objects that aren't used anymore can be freed.
+_debug_logs = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_debug_logs():
+    for log in list(_debug_logs):
+        _call(log.flush)
+
+
+# Writes debug messages from a background thread so that debug logging doesn't
+# slow down sending and receiving. Messages are only formatted when they are
+# written, and the oldest messages are dropped if more than max_records are
+# waiting. The output can be a file-like object, a function or a
+# logging.Logger.
+class DebugLog:
+    __slots__ = ('__weakref__', '_event', '_lock', '_output', '_records',
+                 '_thread', '_write_lock', 'categories', 'dropped')
+
+    def __init__(self, output=None, *, categories=('in', 'out', 'state'),
+                 max_records=4096):
+        self._output = sys.stdout if output is None else output
+        self._records = collections.deque(maxlen=max_records)
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self.categories = frozenset(categories)
+        self.dropped = 0
+        _debug_logs.add(self)
+
+    # Called by IRC.debug(). Appending to a deque is thread-safe, so no locks
+    # are needed unless the writer thread has to be woken up.
+    def _log(self, args, kwargs):
+        category = 'state'
+        if args and type(args[0]) is str:
+            category = _debug_categories.get(args[0], 'state')
+        if category not in self.categories:
+            return
+
+        records = self._records
+        if len(records) == records.maxlen:
+            self.dropped += 1
+        records.append((category, args, kwargs))
+        if not self._event.is_set():
+            if self._thread is None:
+                with self._lock:
+                    if self._thread is None:
+                        self._thread = threading.Thread(
+                            target=self._run,
+                            args=(weakref.ref(self), self._event),
+                            daemon=True, name='miniirc-debug'
+                        )
+                        self._thread.start()
+
+                        # Write any remaining messages and wake the thread
+                        # up so that it can exit once this object is freed
+                        weakref.finalize(self, self._flush, self._write_lock,
+                                         self._records, self._output)
+                        weakref.finalize(self, self._event.set)
+            self._event.set()
+
+    # The writer thread only keeps a weak reference to the DebugLog
+    @staticmethod
+    def _run(ref, event):
+        while True:
+            event.wait()
+            event.clear()
+            log = ref()
+            if log is None:
+                return
+            _call(log.flush)
+            del log
+
+    # Write any waiting debug messages
+    def flush(self):
+        self._flush(self._write_lock, self._records, self._output)
+
+    # This doesn't use self so that it can be called after the DebugLog has
+    # been freed
+    @staticmethod
+    def _flush(write_lock, waiting, output):
+        with write_lock:
+            records = []
+            popleft = waiting.popleft
+            try:
+                while True:
+                    records.append(popleft())
+            except IndexError:
+                pass
+            if not records:
+                return
+
+            if hasattr(output, 'log') and hasattr(output, 'isEnabledFor'):
+                for category, args, kwargs in records:
+                    level = _debug_levels[category]
+                    if output.isEnabledFor(level):
+                        output.log(level, '%s',
+                                   kwargs.get('sep', ' ').join(map(str, args)))
+            elif hasattr(output, 'write'):
+                for category, args, kwargs in records:
+                    print(*args, file=output, **kwargs)
+                if hasattr(output, 'flush'):
+                    output.flush()
+            else:
+                for category, args, kwargs in records:
+                    output(kwargs.get('sep', ' ').join(map(str, args)))
+
+
 # Replace invalid RFC1459 characters with Unicode lookalikes
 def _prune_arg(arg):
     if arg.startswith(':'):
@@ -201,13 +630,1010 @@ def _prune_arg(arg):
     return arg.replace(' ', '\xa0').replace('\r', '\xa0').replace('\n', '\xa0')
 
 
+# Split text into chunks of at most "size" bytes when encoded, at spaces if
+# possible. Chunks are never split in the middle of a UTF-8 character.
+def _split_text(text, size):
+    data = text.encode('utf-8')
+    while len(data) > size:
+        i = data.rfind(b' ', 0, size + 1)
+        if i > 0:
+            yield data[:i].decode('utf-8')
+            data = data[i + 1:]
+            continue
+
+        # Find the start of the character that doesn't fit
+        i = size
+        while data[i] & 0xc0 == 0x80:
+            i -= 1
+        yield data[:i].decode('utf-8')
+        data = data[i:]
+    yield data.decode('utf-8')
+
+
+# Split targets into lists with at most "limit" items that are at most "size"
+# bytes long when joined with commas.
+def _pack_targets(targets, limit, size,
+                  length=lambda target: len(target.encode('utf-8')) + 1):
+    batch = []
+    total = 0
+    for target in targets:
+        target_length = length(target)
+        if batch and (len(batch) == limit or total + target_length > size):
+            yield batch
+            batch = []
+            total = 0
+        batch.append(target)
+        total += target_length
+
+    if batch:
+        yield batch
+
+
+# Convert send() arguments into quote() arguments
+def _send_args(msg):
+    msg = tuple(msg)
+    if len(msg) > 1:
+        return tuple(map(_prune_arg, msg[:-1])) + (':' + msg[-1],)
+    return msg
+
+
+# Call a function and print any exceptions, like threading.Thread does
+def _call(func, *args):
+    try:
+        func(*args)
+    except Exception:
+        traceback.print_exc()
+
+
+# A bounded thread pool for running handlers. Worker threads are started when
+# required and exit after being idle for idle_timeout seconds. If max_queue
+# handlers are already waiting, overflow decides what happens to new ones:
+#   'block':  Wait until there is space in the queue (this will stop miniirc
+#             from reading any more data from the server in the meantime).
+#   'drop':   Discard the handler call.
+#   'thread': Run the handler in a new thread.
+# HandlerPool(0) starts a new thread for every handler call, which is what
+# miniirc v1.10.0 and earlier did.
+class HandlerPool:
+    __slots__ = ('_idle', '_idle_timeout', '_lock', '_max_workers',
+                 '_pending', '_queue', '_workers', 'dropped', 'overflow')
+
+    def __init__(self, max_workers=16, *, max_queue=1024, overflow='thread',
+                 idle_timeout=60):
+        if overflow not in ('block', 'drop', 'thread'):
+            raise ValueError('Invalid overflow policy: {!r}'.format(overflow))
+        self._max_workers = max_workers
+        self._idle_timeout = idle_timeout
+        self._queue = queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._workers = self._idle = self._pending = 0
+        self.overflow = overflow
+        self.dropped = 0
+
+    # Compatible with concurrent.futures.Executor.submit(), however this
+    # doesn't return a future.
+    def submit(self, func, *args):
+        if self._max_workers < 1:
+            threading.Thread(target=func, args=args).start()
+            return
+
+        # Start a new worker if there aren't enough idle ones
+        with self._lock:
+            self._pending += 1
+            if (self._workers < self._max_workers and
+                    self._pending > self._idle):
+                self._workers += 1
+                threading.Thread(target=self._worker, daemon=True,
+                                 name='miniirc-handler').start()
+
+        try:
+            self._queue.put_nowait((func, args))
+        except queue.Full:
+            if self.overflow == 'block':
+                self._queue.put((func, args))
+                return
+
+            with self._lock:
+                self._pending -= 1
+            if self.overflow == 'drop':
+                self.dropped += 1
+            else:
+                threading.Thread(target=func, args=args).start()
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def _worker(self):
+        get = self._queue.get
+        while True:
+            with self._lock:
+                self._idle += 1
+            try:
+                func, args = get(timeout=self._idle_timeout)
+            except queue.Empty:
+                # submit() increments _pending before adding the handler to
+                # the queue, so only exit if every pending handler can be
+                # run by another idle worker.
+                with self._lock:
+                    self._idle -= 1
+                    if self._pending <= self._idle:
+                        self._workers -= 1
+                        return
+                continue
+
+            with self._lock:
+                self._idle -= 1
+                self._pending -= 1
+            _call(func, *args)
+
+
+# The default HandlerPool, this is created when it is first needed. You can
+# replace this with your own HandlerPool (or executor) before connecting.
+handler_pool = None
+_handler_pool_lock = threading.Lock()
+
+
+def _get_handler_pool():
+    global handler_pool
+    with _handler_pool_lock:
+        if handler_pool is None:
+            handler_pool = HandlerPool()
+        return handler_pool
+
+
+# Per-handler statistics, see HandlerProfiler
+class _HandlerStats:
+    __slots__ = ('calls', 'errors', 'event', 'latency_counts', 'max_queued',
+                 'max_time', 'name', 'queued', 'total_time')
+
+    def __init__(self, name, event, buckets):
+        self.name = name
+        self.event = event
+        self.calls = self.errors = 0
+        self.total_time = self.max_time = self.queued = self.max_queued = 0.0
+        self.latency_counts = [0] * (buckets + 1)
+
+
+def _handler_name(handler):
+    name = getattr(handler, '__qualname__', None)
+    if name is None:
+        return repr(handler)
+    module = getattr(handler, '__module__', None)
+    return name if module is None else module + '.' + name
+
+
+# Records how long handlers take to run and how long they wait between the
+# line being received and the handler starting. Handlers that take
+# slow_threshold seconds or longer are passed to on_slow(irc, name, event,
+# seconds), or logged with irc.debug() if on_slow is None.
+class HandlerProfiler:
+    __slots__ = ('_lock', '_stats', 'buckets', 'on_slow', 'slow_threshold')
+
+    def __init__(self, slow_threshold=None, *, on_slow=None,
+                 buckets=(0.001, 0.01, 0.1, 1, 10)):
+        self.slow_threshold = slow_threshold
+        self.on_slow = on_slow
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _get_stats(self, handler, event):
+        name = _handler_name(handler)
+        with self._lock:
+            try:
+                return self._stats[(name, event)]
+            except KeyError:
+                stats = self._stats[(name, event)] = _HandlerStats(
+                    name, event, len(self.buckets)
+                )
+                return stats
+
+    # This is submitted to the executor instead of the handler
+    def _call(self, irc, stats, handler, queued_at, *params):
+        start = time.perf_counter()
+        error = False
+        try:
+            handler(*params)
+        except BaseException:
+            error = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            queued = start - queued_at
+            with self._lock:
+                stats.calls += 1
+                stats.errors += error
+                stats.total_time += elapsed
+                stats.max_time = max(stats.max_time, elapsed)
+                stats.queued += queued
+                stats.max_queued = max(stats.max_queued, queued)
+                stats.latency_counts[
+                    bisect.bisect_left(self.buckets, elapsed)
+                ] += 1
+
+            if (self.slow_threshold is not None and
+                    elapsed >= self.slow_threshold):
+                if self.on_slow is None:
+                    irc.debug('Slow handler:', stats.name, 'for',
+                              stats.event, 'took', round(elapsed, 3),
+                              'seconds')
+                else:
+                    _call(self.on_slow, irc, stats.name, stats.event,
+                          elapsed)
+
+    # Returns a list of dicts with statistics for each handler and event,
+    # the slowest handlers (by total time) are first.
+    def report(self):
+        with self._lock:
+            res = [{
+                'handler': stats.name,
+                'event': stats.event,
+                'calls': stats.calls,
+                'errors': stats.errors,
+                'total_time': stats.total_time,
+                'mean_time': stats.total_time / (stats.calls or 1),
+                'max_time': stats.max_time,
+                'mean_queue_time': stats.queued / (stats.calls or 1),
+                'max_queue_time': stats.max_queued,
+                'latency': dict(zip(self.buckets + (float('inf'),),
+                                    stats.latency_counts)),
+            } for stats in self._stats.values() if stats.calls]
+        res.sort(key=lambda stats: stats['total_time'], reverse=True)
+        return res
+
+    # The statistics objects are cached in IRC objects' dispatch tables, so
+    # they're reset instead of being removed.
+    def reset(self):
+        with self._lock:
+            for stats in self._stats.values():
+                stats.__init__(stats.name, stats.event, len(self.buckets))
+
+
+# A token bucket that limits how quickly messages are sent to the server.
+# Messages sent with force=True and the commands in "immediate" skip the queue,
+# and the commands in "bulk" are only sent when nothing else is waiting.
+class FloodControl:
+    __slots__ = ('_irc', '_lanes', '_last', '_lock', '_queued', '_slowdown',
+                 '_slowed_at', '_thread', '_tokens', 'adaptive', 'burst',
+                 'coalesce', 'dropped', 'max_queue', 'rate')
+
+    immediate = frozenset((b'AUTHENTICATE', b'CAP', b'PASS', b'PING',
+                           b'PONG', b'QUIT'))
+    bulk = frozenset((b'NOTICE', b'PRIVMSG', b'TAGMSG'))
+
+    def __init__(self, burst=5, rate=0.5, *, max_queue=1024, coalesce=True,
+                 adaptive=True):
+        if rate <= 0 or burst < 1:
+            raise ValueError('FloodControl rate and burst must be positive.')
+        self.burst = burst
+        self.rate = rate
+        self.max_queue = max_queue
+        self.coalesce = coalesce
+        self.adaptive = adaptive
+        self.dropped = 0
+        self._irc = self._thread = None
+        self._lanes = (collections.deque(), collections.deque())
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._last = self._slowed_at = time.monotonic()
+        self._slowdown = 1
+
+    # The number of messages waiting to be sent
+    def qsize(self):
+        return len(self._lanes[0]) + len(self._lanes[1])
+
+    # Discard any queued messages and refill the bucket, this is called when
+    # disconnecting.
+    def clear(self):
+        with self._lock:
+            self._lanes[0].clear()
+            self._lanes[1].clear()
+            self._queued.clear()
+            self._tokens = self.burst
+            self._last = time.monotonic()
+
+    # Queued messages are sent to the IRC object that this is bound to, so
+    # FloodControl objects can't be shared between IRC objects
+    def _bind(self, irc):
+        with self._lock:
+            if self._irc is not None and self._irc is not irc:
+                raise ValueError('FloodControl objects can only be used by '
+                                 'one IRC object.')
+            self._irc = irc
+
+    # Must be called with the lock held
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self._rate())
+        self._last = now
+
+        # Speed back up if there haven't been any flood disconnects recently
+        if self._slowdown > 1 and now - self._slowed_at >= 300:
+            self._slowdown //= 2
+            self._slowed_at = now
+
+    # The current rate (this is lower than self.rate after flood disconnects)
+    def _rate(self):
+        return self.rate / self._slowdown
+
+    # Send or queue encoded messages
+    def _submit(self, irc, messages):
+        if self._irc is not irc:
+            self._bind(irc)
+        batch = []
+        with self._lock:
+            self._refill()
+            for msg in messages:
+                # Empty and tags-only lines are queued like other messages
+                parts = msg.split(None, 2)
+                if parts and parts[0][:1] == b'@':
+                    del parts[0]
+                cmd = parts[0].upper() if parts else b''
+                if cmd in self.immediate:
+                    self._tokens = max(self._tokens - 1, 0)
+                    batch.append(msg)
+                elif self._thread is None and self._tokens >= 1:
+                    self._tokens -= 1
+                    batch.append(msg)
+                elif self.coalesce and msg in self._queued:
+                    self.dropped += 1
+                elif self.qsize() >= self.max_queue:
+                    self.dropped += 1
+                else:
+                    self._lanes[cmd in self.bulk].append(msg)
+                    self._queued.add(msg)
+                    if self._thread is None:
+                        self._thread = threading.Thread(
+                            target=self._run, daemon=True,
+                            name='miniirc-flood-control'
+                        )
+                        self._thread.start()
+
+        if batch:
+            irc._write(b''.join(batch), False)
+
+    # Sends queued messages when there are enough tokens
+    def _run(self):
+        while True:
+            batch = []
+            with self._lock:
+                self._refill()
+                while self._tokens >= 1:
+                    lane = self._lanes[0] or self._lanes[1]
+                    if not lane:
+                        break
+                    msg = lane.popleft()
+                    self._queued.discard(msg)
+                    batch.append(msg)
+                    self._tokens -= 1
+
+                if not batch and not self.qsize():
+                    self._thread = None
+                    return
+                irc = self._irc
+
+            if not batch:
+                time.sleep((1 - self._tokens) / self._rate())
+            elif irc.connected:
+                # The socket may have been closed since the lock was released
+                try:
+                    irc._write(b''.join(batch), False)
+                except OSError:
+                    pass
+
+    # Called when the server disconnects miniirc for flooding. The rate is
+    # halved (down to 1/16 of self.rate) and then doubled again after every 5
+    # minutes without another flood disconnect.
+    def _excess_flood(self):
+        if self.adaptive:
+            with self._lock:
+                self._slowdown = min(self._slowdown * 2, 16)
+                self._slowed_at = time.monotonic()
+
+
+# Decides how long to wait before reconnecting. The first attempt waits
+# first_delay seconds, after that the delay starts at "base" seconds and is
+# multiplied by "factor" after every failed attempt (up to max_delay). With
+# jitter, a random delay between 0 and that is used so that lots of clients
+# don't all reconnect at the same time. If max_attempts is not None, miniirc
+# gives up after that many failed attempts. on_reconnect(irc, attempt, delay)
+# is called before waiting, and can return False to stop reconnecting.
+class ReconnectPolicy:
+    __slots__ = ('base', 'factor', 'first_delay', 'jitter', 'max_attempts',
+                 'max_delay', 'on_reconnect')
+
+    def __init__(self, base=1, *, factor=2, max_delay=300, first_delay=0,
+                 jitter=True, max_attempts=None, on_reconnect=None):
+        self.base = base
+        self.factor = factor
+        self.max_delay = max_delay
+        self.first_delay = first_delay
+        self.jitter = jitter
+        self.max_attempts = max_attempts
+        self.on_reconnect = on_reconnect
+
+    # Returns the delay before an attempt (starting at 0)
+    def delay(self, attempt):
+        if attempt == 0:
+            delay = self.first_delay
+        else:
+            delay = min(self.base * self.factor ** (attempt - 1),
+                        self.max_delay)
+        if self.jitter and delay > 0:
+            delay = random.uniform(0, delay)
+        return delay
+
+
+# What miniirc did before ReconnectPolicy was added
+_legacy_reconnect_policy = ReconnectPolicy(5, factor=1, first_delay=5,
+                                           jitter=False)
+
+
+# Counters and a ping round-trip time histogram for one IRC object. Metrics
+# are only collected if a Metrics object is passed to miniirc.IRC. Counters
+# are updated without a lock and may be slightly off if several threads send
+# messages at the same time.
+class Metrics:
+    __slots__ = ('bytes_received', 'bytes_sent', 'connects', 'handler_calls',
+                 'ignored_lines', 'lines_received', 'lines_sent', 'reconnects',
+                 'rtt_buckets', 'rtt_counts', 'rtt_sum')
+
+    def __init__(self, *, rtt_buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+                                       2.5, 5, 10)):
+        self.bytes_received = self.bytes_sent = 0
+        self.lines_received = self.lines_sent = self.ignored_lines = 0
+        self.handler_calls = self.connects = self.reconnects = 0
+        self.rtt_buckets = tuple(sorted(rtt_buckets))
+
+        # The last item is the number of round trips longer than the largest
+        # bucket.
+        self.rtt_counts = [0] * (len(self.rtt_buckets) + 1)
+        self.rtt_sum = 0.0
+
+    def _observe_rtt(self, rtt):
+        self.rtt_counts[bisect.bisect_left(self.rtt_buckets, rtt)] += 1
+        self.rtt_sum += rtt
+
+
+# IRC objects with metrics, for prometheus_metrics()
+_metrics_ircs = weakref.WeakSet()
+
+# (name, type, description, function)
+_prometheus_metrics = (
+    ('connected', 'gauge', 'Whether miniirc is connected to the server.',
+     lambda irc: int(bool(irc.connected))),
+    ('sendq_length', 'gauge', 'Messages waiting to be sent.',
+     lambda irc: len(irc.sendq or ()) + (irc.flood_control.qsize()
+                                          if irc.flood_control else 0)),
+    ('bytes_received_total', 'counter', 'Bytes received from the server.',
+     lambda irc: irc.metrics.bytes_received),
+    ('bytes_sent_total', 'counter', 'Bytes sent to the server.',
+     lambda irc: irc.metrics.bytes_sent),
+    ('lines_received_total', 'counter', 'Lines received from the server.',
+     lambda irc: irc.metrics.lines_received),
+    ('lines_sent_total', 'counter', 'Lines sent to the server.',
+     lambda irc: irc.metrics.lines_sent),
+    ('ignored_lines_total', 'counter', 'Received lines that were ignored '
+     'because they could not be parsed.',
+     lambda irc: irc.metrics.ignored_lines),
+    ('handler_calls_total', 'counter', 'Handlers called for received '
+     'messages.', lambda irc: irc.metrics.handler_calls),
+    ('connects_total', 'counter', 'Successful connections to the server.',
+     lambda irc: irc.metrics.connects),
+    ('reconnects_total', 'counter', 'Reconnection attempts.',
+     lambda irc: irc.metrics.reconnects),
+)
+
+
+def _prometheus_label(value):
+    return '"{}"'.format(str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+
+
+# Returns the metrics of IRC objects (by default all IRC objects with
+# metrics) in the Prometheus text format.
+def prometheus_metrics(ircs=None):
+    if ircs is None:
+        ircs = list(_metrics_ircs)
+    ircs = [(irc, 'server={},port={},nick={}'.format(
+        _prometheus_label(irc.ip), _prometheus_label(irc.port),
+        _prometheus_label(irc._desired_nick)
+    )) for irc in ircs if irc.metrics is not None]
+
+    res = []
+    for name, kind, description, func in _prometheus_metrics:
+        res.append('# HELP miniirc_{} {}'.format(name, description))
+        res.append('# TYPE miniirc_{} {}'.format(name, kind))
+        for irc, labels in ircs:
+            res.append('miniirc_{}{{{}}} {}'.format(name, labels, func(irc)))
+
+    res.append('# HELP miniirc_ping_rtt_seconds Ping round-trip time.')
+    res.append('# TYPE miniirc_ping_rtt_seconds histogram')
+    for irc, labels in ircs:
+        metrics = irc.metrics
+        total = 0
+        for le, count in zip(metrics.rtt_buckets + ('+Inf',),
+                             metrics.rtt_counts):
+            total += count
+            res.append('miniirc_ping_rtt_seconds_bucket{{{},le="{}"}} {}'
+                       .format(labels, le, total))
+        res.append('miniirc_ping_rtt_seconds_sum{{{}}} {}'.format(
+            labels, metrics.rtt_sum))
+        res.append('miniirc_ping_rtt_seconds_count{{{}}} {}'.format(
+            labels, total))
+
+    res.append('')
+    return '\n'.join(res)
+
+
+# A selector-based event loop that can drive many IRC objects from one thread
+class Reactor:
+    __slots__ = ('_active_timers', '_lock', '_selector', '_thread',
+                 '_timer_ids', '_timers', '_wakeup_r', '_wakeup_w')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._thread = None
+        self._timers = []
+        self._active_timers = 0
+        self._timer_ids = itertools.count()
+
+        # Used to interrupt select() when sockets or timers are added
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+
+    # Call func() from the reactor thread whenever sock is readable
+    def register(self, sock, func):
+        with self._lock:
+            self._selector.register(sock, selectors.EVENT_READ, func)
+            self._start()
+        self._wakeup()
+
+    # This must be called before the socket is closed
+    def unregister(self, sock):
+        with self._lock:
+            try:
+                self._selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+        self._wakeup()
+
+    # Call func(*args) from the reactor thread after delay seconds
+    def call_later(self, delay, func, *args):
+        timer = [time.monotonic() + delay, next(self._timer_ids), func, args]
+        with self._lock:
+            heapq.heappush(self._timers, timer)
+            self._active_timers += 1
+            self._start()
+        self._wakeup()
+        return timer
+
+    # Cancel a timer returned by call_later()
+    def cancel(self, timer):
+        with self._lock:
+            if timer[2] is not None:
+                timer[2] = None
+                self._active_timers -= 1
+        self._wakeup()
+
+    # Checks whether the current thread is the reactor thread
+    def in_reactor_thread(self):
+        return threading.current_thread() is self._thread
+
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send(b'\x00')
+        except OSError:
+            pass
+
+    # Start the reactor thread if it isn't running. Like miniirc's per-IRC
+    # threads, the reactor thread exits once there is nothing left to do.
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name='miniirc-reactor')
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if (len(self._selector.get_map()) < 2 and
+                        not self._active_timers):
+                    self._thread = None
+                    return
+
+                # Cancelled timers are removed lazily
+                while self._timers and self._timers[0][2] is None:
+                    heapq.heappop(self._timers)
+                if self._timers:
+                    timeout = max(self._timers[0][0] - time.monotonic(), 0)
+                else:
+                    timeout = None
+
+            for key, _ in self._selector.select(timeout):
+                if key.data is None:
+                    try:
+                        while self._wakeup_r.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                else:
+                    _call(key.data)
+
+            # Run any timers that have expired
+            now = time.monotonic()
+            while True:
+                with self._lock:
+                    if not self._timers or self._timers[0][0] > now:
+                        break
+                    _, _, func, args = heapq.heappop(self._timers)
+                    if func is None:
+                        continue
+                    self._active_timers -= 1
+                _call(func, *args)
+
+
+# Resolves host names and caches the results for "ttl" seconds. One Resolver
+# is shared between every IRC object by default. resolve() returns a list of
+# (family, type, proto, canonname, address) tuples like socket.getaddrinfo().
+class Resolver:
+    __slots__ = ('_cache', '_lock', 'ttl')
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        key = (host, port)
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        addrs = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        with self._lock:
+            self._cache[key] = (time.monotonic() + self.ttl, addrs)
+        return addrs
+
+    # Removes a host from the cache, this is called if connecting to every
+    # address failed.
+    def invalidate(self, host, port):
+        with self._lock:
+            self._cache.pop((host, port), None)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+_default_resolver = Resolver()
+_connect_in_progress = frozenset((errno.EINPROGRESS, errno.EWOULDBLOCK,
+                                  errno.EAGAIN,
+                                  getattr(errno, 'WSAEWOULDBLOCK', None)))
+
+
+# Waits for a socket to become readable or writable and returns False if the
+# timeout expires. select.select() only supports file descriptors below
+# FD_SETSIZE (usually 1024) on most platforms, which the reactor can easily
+# get to. epoll (selectors.DefaultSelector) can't be used either because it
+# doesn't notice the socket being closed by disconnect() in another thread.
+if hasattr(select, 'poll'):
+    def _wait_for_socket(sock, events, timeout):
+        poll = select.poll()
+        poll.register(sock, select.POLLIN if events == selectors.EVENT_READ
+                      else select.POLLOUT)
+        return bool(poll.poll(None if timeout is None else timeout * 1000))
+else:
+    # Windows doesn't have poll(), but its select() doesn't limit file
+    # descriptor numbers
+    def _wait_for_socket(sock, events, timeout):
+        sockets = (sock,)
+        if events == selectors.EVENT_READ:
+            return any(select.select(sockets, (), sockets, timeout))
+        return any(select.select((), sockets, sockets, timeout))
+
+
+# Sorts addresses so that address families alternate, starting with the
+# first family returned by getaddrinfo() (RFC 8305 section 4).
+def _interleave_addrs(addrs):
+    families = collections.OrderedDict()
+    for addr in addrs:
+        families.setdefault(addr[0], []).append(addr)
+    res = []
+    for group in itertools.zip_longest(*families.values()):
+        res.extend(addr for addr in group if addr is not None)
+    return res
+
+
+# Translation tables for casemappings, used by irc.casefold() and
+# StateTracker. Unknown casemappings fall back to rfc1459, which is also the
+# default if the server doesn't send CASEMAPPING.
+_ascii_upper = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+_casemaps = {
+    'ascii': str.maketrans(_ascii_upper, _ascii_upper.lower()),
+    'rfc1459': str.maketrans(_ascii_upper + '[]\\~',
+                             _ascii_upper.lower() + '{}|^'),
+    'strict-rfc1459': str.maketrans(_ascii_upper + '[]\\',
+                                    _ascii_upper.lower() + '{}|'),
+}
+_rfc1459 = _casemaps['rfc1459']
+
+
+# A user that shares at least one channel with miniirc. "channels" is a set
+# of ChannelState objects, ident, host and account are None if unknown.
+class UserState:
+    __slots__ = ('account', 'channels', 'host', 'ident', 'nick')
+
+    def __init__(self, nick):
+        self.nick = nick
+        self.ident = self.host = self.account = None
+        self.channels = set()
+
+    def __repr__(self):
+        return '<miniirc.UserState {!r}>'.format(self.nick)
+
+
+# A channel that miniirc is in. "members" is a set of UserState objects.
+class ChannelState:
+    __slots__ = ('members', 'name')
+
+    def __init__(self, name):
+        self.name = name
+        self.members = set()
+
+    def __repr__(self):
+        return '<miniirc.ChannelState {!r}>'.format(self.name)
+
+
+# Keeps track of which users are in which channels. State is updated in the
+# receiving thread before handlers are called, and lookups (which normalise
+# names with the server's casemapping) take O(1) time. Every IRC object needs
+# its own StateTracker.
+class StateTracker:
+    __slots__ = ('_casemap', '_channels', '_lock', '_nick', '_prefixes',
+                 '_users')
+
+    def __init__(self):
+        self._casemap = _rfc1459
+        self._prefixes = '~&@%+'
+        self._lock = threading.Lock()
+        self._users = {}
+        self._channels = {}
+        self._nick = None
+
+    def _key(self, name):
+        return sys.intern(name.translate(self._casemap))
+
+    def _is_me(self, nick):
+        return (self._nick is not None and
+                nick.translate(self._casemap) ==
+                self._nick.translate(self._casemap))
+
+    def get_user(self, nick):
+        return self._users.get(nick.translate(self._casemap))
+
+    def get_channel(self, name):
+        return self._channels.get(name.translate(self._casemap))
+
+    # Returns a frozenset of UserState objects, or None if miniirc isn't in
+    # the channel.
+    def members(self, channel):
+        channel = self.get_channel(channel)
+        if channel is None:
+            return None
+        with self._lock:
+            return frozenset(channel.members)
+
+    # Returns a frozenset of ChannelState objects that the user is in
+    def user_channels(self, nick):
+        user = self.get_user(nick)
+        if user is None:
+            return frozenset()
+        with self._lock:
+            return frozenset(user.channels)
+
+    def is_member(self, channel, nick):
+        channel = self.get_channel(channel)
+        return channel is not None and self.get_user(nick) in channel.members
+
+    def users(self):
+        with self._lock:
+            return list(self._users.values())
+
+    def channels(self):
+        with self._lock:
+            return list(self._channels.values())
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self._channels.clear()
+
+    # Adds a user to a channel, creating the user if required
+    def _add_member(self, channel, nick, ident=None, host=None):
+        key = self._key(nick)
+        user = self._users.get(key)
+        if user is None:
+            user = self._users[key] = UserState(sys.intern(nick))
+        if ident is not None:
+            user.ident, user.host = ident, host
+        user.channels.add(channel)
+        channel.members.add(user)
+        return user
+
+    # Removes a user from a channel and forgets about them if they aren't in
+    # any other channels.
+    def _remove_member(self, channel, user):
+        channel.members.discard(user)
+        user.channels.discard(channel)
+        if not user.channels:
+            self._users.pop(self._key(user.nick), None)
+
+    def _remove_channel(self, key):
+        channel = self._channels.pop(key, None)
+        if channel is not None:
+            for user in tuple(channel.members):
+                self._remove_member(channel, user)
+
+    def _part(self, channel, nick):
+        key = self._key(channel)
+        if self._is_me(nick):
+            self._remove_channel(key)
+            return
+        channel = self._channels.get(key)
+        user = self._users.get(self._key(nick))
+        if channel is not None and user is not None:
+            self._remove_member(channel, user)
+
+    def _on_001(self, hostmask, args):
+        self._users.clear()
+        self._channels.clear()
+        self._nick = args[0]
+
+    def _on_005(self, hostmask, args):
+        for token in args[1:-1]:
+            if token.startswith('PREFIX='):
+                self._prefixes = token.partition(')')[2]
+            elif token.startswith('CASEMAPPING='):
+                casemap = _casemaps.get(token[12:], _rfc1459)
+                if casemap is not self._casemap:
+                    self._casemap = casemap
+                    self._rekey()
+
+    # Rebuilds the indexes after the casemapping changes
+    def _rekey(self):
+        self._users = {self._key(user.nick): user
+                       for user in self._users.values()}
+        self._channels = {self._key(channel.name): channel
+                          for channel in self._channels.values()}
+
+    def _on_join(self, hostmask, args):
+        key = self._key(args[0])
+        channel = self._channels.get(key)
+        if channel is None:
+            # Only track channels that miniirc has joined
+            if not self._is_me(hostmask[0]):
+                return
+            channel = self._channels[key] = ChannelState(sys.intern(args[0]))
+        user = self._add_member(channel, hostmask[0], hostmask[1],
+                                hostmask[2])
+
+        # extended-join
+        if len(args) > 2:
+            user.account = None if args[1] == '*' else args[1]
+
+    def _on_part(self, hostmask, args):
+        self._part(args[0], hostmask[0])
+
+    def _on_kick(self, hostmask, args):
+        if len(args) > 1:
+            self._part(args[0], args[1])
+
+    def _on_quit(self, hostmask, args):
+        user = self._users.pop(self._key(hostmask[0]), None)
+        if user is not None:
+            for channel in user.channels:
+                channel.members.discard(user)
+            user.channels.clear()
+
+    def _on_nick(self, hostmask, args):
+        if self._is_me(hostmask[0]):
+            self._nick = args[0]
+        user = self._users.pop(self._key(hostmask[0]), None)
+        if user is not None:
+            user.nick = sys.intern(args[0])
+            self._users[self._key(args[0])] = user
+
+    # RPL_NAMREPLY, with support for multi-prefix and userhost-in-names
+    def _on_353(self, hostmask, args):
+        if len(args) < 4:
+            return
+        channel = self._channels.get(self._key(args[2]))
+        if channel is None:
+            return
+        for name in args[3].split():
+            nick, _, userhost = name.lstrip(self._prefixes).partition('!')
+            if userhost:
+                ident, _, host = userhost.partition('@')
+                self._add_member(channel, nick, ident, host)
+            elif nick:
+                self._add_member(channel, nick)
+
+    def _on_account(self, hostmask, args):
+        user = self._users.get(self._key(hostmask[0]))
+        if user is not None:
+            user.account = None if args[0] == '*' else args[0]
+
+    def _on_chghost(self, hostmask, args):
+        user = self._users.get(self._key(hostmask[0]))
+        if user is not None and len(args) > 1:
+            user.ident, user.host = args[0], args[1]
+
+    _updaters = {'001': _on_001, '005': _on_005, '353': _on_353,
+                 'ACCOUNT': _on_account, 'CHGHOST': _on_chghost,
+                 'JOIN': _on_join, 'KICK': _on_kick, 'NICK': _on_nick,
+                 'PART': _on_part, 'QUIT': _on_quit}
+
+    # Called by IRC._handle() with the unmodified arguments
+    def _update(self, cmd, hostmask, args):
+        func = self._updaters.get(str(cmd).upper())
+        if func is None or not args:
+            return
+        if args[-1][:1] == ':':
+            args = args[:-1] + [args[-1][1:]]
+        with self._lock:
+            func(self, hostmask, args)
+
+
+# Creating SSL contexts is slow (the CA certificates have to be loaded), so
+# they're shared between IRC objects. The contexts must not be modified.
+_ssl_contexts = {}
+_ssl_contexts_lock = threading.Lock()
+
+
+def _get_ssl_context(verify_ssl, cafile):
+    key = (verify_ssl, cafile)
+    try:
+        return _ssl_contexts[key]
+    except KeyError:
+        pass
+
+    with _ssl_contexts_lock:
+        if key not in _ssl_contexts:
+            ctx = ssl.create_default_context(cafile=cafile)
+            if verify_ssl:
+                assert ctx.check_hostname
+            else:
+                ctx.check_hostname = False
+                ctx.verify_mode = ssl.CERT_NONE
+            _ssl_contexts[key] = ctx
+        return _ssl_contexts[key]
+
+
 # Create the IRC class
 class IRC:
     connected = None
     debug_file = sys.stdout
     sendq = None
     msglen = 512
+    metrics = None
+    handler_profiler = None
+    state_tracker = None
+    _reconnect_attempts = 0
+    _pending_joins = None
+    _ssl_session = None
+    server_address = None
+    connection_attempt_delay = 0.25
     _main_thread = None
+    _received_at = None
+    _userhost = None
+    _ping_timer = None
+    _ping_sent = None
     _sasl = False
     _unhandled_caps = None
 
@@ -229,7 +1655,10 @@ class IRC:
                  auto_connect=True, ircv3_caps=None, connect_modes=None,
                  quit_message='I grew sick and died.', ping_interval=60,
                  ping_timeout=None, verify_ssl=True, server_password=None,
-                 executor=None):
+                 executor=None, reactor=None, fallback_encodings=(),
+                 flood_control=None, metrics=None, handler_profiler=None,
+                 reconnect_policy=None, ssl_context=None, resolver=None,
+                 state_tracker=None):
         # Set basic variables
         self.ip = ip
         self.port = int(port)
@@ -249,9 +1678,26 @@ class IRC:
         self.ping_interval = ping_interval
         self.ping_timeout = ping_timeout
         self.verify_ssl = verify_ssl
+        self.ssl_context = ssl_context
+        self.resolver = resolver
         self.server_password = server_password
+        self.fallback_encodings = tuple(fallback_encodings)
+        self.flood_control = flood_control
+        if flood_control is not None:
+            flood_control._bind(self)
+        self.metrics = metrics
+        if metrics is not None:
+            _metrics_ircs.add(self)
+        self.handler_profiler = handler_profiler
+        self.reconnect_policy = reconnect_policy
+        self.state_tracker = state_tracker
+        self.connect_timings = {}
         self._keepnick_active = False
         self._executor = executor
+        self._reactor = reactor
+        if reactor is not None:
+            self._reactor_done = threading.Event()
+            self._reactor_done.set()
 
         # Set the NickServ identity
         if not ns_identity or isinstance(ns_identity, str):
@@ -262,7 +1708,7 @@ class IRC:
         # Set the debug file
         if not debug:
             self.debug_file = None
-        elif hasattr(debug, 'write'):
+        elif hasattr(debug, 'write') or isinstance(debug, DebugLog):
             self.debug_file = debug
         elif hasattr(debug, '__call__'):
             self.debug_file = _Logfile(debug)
@@ -274,6 +1720,9 @@ class IRC:
         # Add handlers and set the default message parser
         self.change_parser()
         self.handlers = {}
+        self._handler_filters = {}
+        self._dispatch = {}
+        self._dispatch_generation = None
         self._send_lock = threading.Lock()
         if ssl is None and self.port == 6697:
             self.ssl = True
@@ -284,14 +1733,100 @@ class IRC:
 
     # Debug print()
     def debug(self, *args, **kwargs):
-        if self.debug_file:
+        if type(self.debug_file) is DebugLog:
+            self.debug_file._log(args, kwargs)
+        elif self.debug_file:
             print(*args, file=self.debug_file, **kwargs)
             if hasattr(self.debug_file, 'flush'):
                 self.debug_file.flush()
 
     # Send raw messages
     def quote(self, *msg, force=None, tags=None):
-        if not tags and msg and isinstance(msg[0], dict):
+        data = self._quote_data(msg, force, tags)
+        if data is not None:
+            self._send_data((data,), force)
+
+    # Send multiple raw messages with as few writes as possible. Each message
+    # is either a string or a tuple/list of arguments to quote().
+    def quote_many(self, messages, *, force=None, tags=None):
+        data = []
+        for msg in messages:
+            if isinstance(msg, str):
+                msg = (msg,)
+            msg = self._quote_data(tuple(msg), force, tags)
+            if msg is not None:
+                data.append(msg)
+        if data:
+            self._send_data(data, force)
+
+    # Write a list of encoded messages, unless they have to wait for flood
+    # control.
+    def _send_data(self, data, force):
+        if force or self.flood_control is None:
+            self._write(b''.join(data), force)
+        else:
+            self.flood_control._submit(self, data)
+
+    # Send pre-encoded messages. "data" is a bytes-like object containing one
+    # or more lines, only line endings, NUL bytes and the length of each
+    # line are checked.
+    def quote_raw(self, data, *, force=None):
+        if type(data) is not bytes:
+            data = bytes(data)
+        if not self.connected and not force:
+            self.debug('>Q>', data)
+            if not self.sendq:
+                self.sendq = []
+            self.sendq.append(data)
+            return
+
+        send_tags = ('message-tags' in self.active_caps or
+                     'draft/message-tags-0.2' in self.active_caps)
+        lines = []
+        for line in data.split(b'\n'):
+            if line[-1:] == b'\r':
+                line = line[:-1]
+            if not line:
+                continue
+            if b'\r' in line or b'\x00' in line:
+                line = line.replace(b'\r', b' ').replace(b'\x00',
+                                                        b'\xef\xbf\xbd')
+
+            # Tags have a separate length limit (4094 bytes including the
+            # "@" and the trailing space, like _encode_tags())
+            if line[:1] == b'@':
+                tags, _, line = line.partition(b' ')
+                if not line.strip(b' '):
+                    self.debug('Dropping a raw message without a command')
+                    continue
+                if not send_tags:
+                    tags = b''
+                elif len(tags) < 2 or len(tags) + 1 > 4094:
+                    self.debug('Dropping invalid or oversized tags from a '
+                               'raw message')
+                    tags = b''
+                else:
+                    tags += b' '
+            else:
+                tags = b''
+
+            # Don't split UTF-8 characters when truncating
+            if len(line) + 2 > self.msglen:
+                i = self.msglen - 2
+                while i > 0 and line[i] & 0xc0 == 0x80:
+                    i -= 1
+                line = line[:i]
+
+            if self.debug_file:
+                self.debug('>>>', (tags + line).decode('utf-8', 'replace'))
+            lines.append(tags + line + b'\r\n')
+
+        if lines:
+            self._send_data(lines, force)
+
+    # Returns the encoded message, or None if it was added to the send queue
+    def _quote_data(self, msg, force, tags):
+        if not tags and msg and isinstance(msg[0], (dict, Tags)):
             tags = msg[0]
             msg = msg[1:]
         if not self.connected and not force:
@@ -301,13 +1836,21 @@ class IRC:
             if tags:
                 msg = (tags,) + msg
             self.sendq.append(msg)
-            return
+            return None
 
-        if (not isinstance(tags, dict)
+        if (not isinstance(tags, (dict, Tags))
                 or ('message-tags' not in self.active_caps and
                     'draft/message-tags-0.2' not in self.active_caps)):
             tags = None
-        self.debug('>3> ' + repr(tags) if tags else '>>>', *msg)
+        if self.debug_file:
+            if tags:
+                self.debug('>3>', tags, *msg)
+            else:
+                self.debug('>>>', *msg)
+        return self._encode(msg, tags)
+
+    # Encode a message (without any checks) into bytes
+    def _encode(self, msg, tags):
         msg = (' '.join(msg).replace('\x00', '\ufffd').encode('utf-8')
                .replace(b'\r', b' ') .replace(b'\n', b' '))
 
@@ -319,21 +1862,25 @@ class IRC:
         if tags:
             msg = _dict_to_tags(tags) + msg
 
+        return msg + b'\r\n'
+
+    # Write encoded data to the socket
+    def _write(self, msg, force):
         # Non-blocking sockets can't use sendall() reliably
-        msg += b'\r\n'
         self._send_lock.acquire()
         sent_bytes = 0
         try:  # Apparently try/finally is faster than "with".
+            # A memoryview is used so that partial writes don't copy the
+            # rest of the data.
+            view = memoryview(msg)
             while True:
                 try:
                     # Attempt to send to the socket
-                    sent_bytes += self.sock.send(msg[sent_bytes:])
+                    sent_bytes += self.sock.send(view[sent_bytes:])
                 except ssl.SSLWantReadError:
                     # Wait for the socket to become ready again
-                    readable, _, _ = select.select(
-                        (self.sock,), (), (self.sock,),
-                        self.ping_timeout or self.ping_interval
-                    )
+                    _wait_for_socket(self.sock, selectors.EVENT_READ,
+                                     self.ping_timeout or self.ping_interval)
                     continue
                 except (BlockingIOError, ssl.SSLWantWriteError):
                     pass
@@ -343,8 +1890,8 @@ class IRC:
                         break
 
                 # Otherwise wait for the socket to become writable
-                select.select((), (self.sock,), (self.sock,),
-                              self.ping_timeout or self.ping_interval)
+                _wait_for_socket(self.sock, selectors.EVENT_WRITE,
+                                 self.ping_timeout or self.ping_interval)
         except socket.timeout:
             # Abort the connection if there was a timeout because the data may
             # have been partially written
@@ -360,34 +1907,149 @@ class IRC:
                 raise
         finally:
             self._send_lock.release()
+            if self.metrics is not None and sent_bytes:
+                self.metrics.bytes_sent += sent_bytes
+                self.metrics.lines_sent += msg.count(b'\n', 0, sent_bytes)
 
     def send(self, *msg, force=None, tags=None):
-        if len(msg) > 1:
-            self.quote(*tuple(map(_prune_arg, msg[:-1])) + (':' + msg[-1],),
-                       force=force, tags=tags)
-        else:
-            self.quote(*msg, force=force, tags=tags)
+        return self.quote(*_send_args(msg), force=force, tags=tags)
 
-    # User-friendly msg, notice, and CTCP functions.
-    def msg(self, target, *msg, tags=None):
-        self.quote('PRIVMSG', target, ':' + ' '.join(msg), tags=tags)
-
-    def notice(self, target, *msg, tags=None):
-        self.quote('NOTICE', target, ':' + ' '.join(msg), tags=tags)
+    # Send multiple messages like send(), each message is a tuple/list of
+    # arguments.
+    def send_many(self, messages, *, force=None, tags=None):
+        return self.quote_many(map(_send_args, messages), force=force,
+                               tags=tags)
 
-    def ctcp(self, target, *msg, reply=False, tags=None):
+    # User-friendly msg, notice, and CTCP functions.
+    def msg(self, target, *msg, tags=None, split=False):
+        if split:
+            return self._send_split('PRIVMSG', target, ' '.join(msg), tags)
+        return self.quote('PRIVMSG', target, ':' + ' '.join(msg), tags=tags)
+
+    def notice(self, target, *msg, tags=None, split=False):
+        if split:
+            return self._send_split('NOTICE', target, ' '.join(msg), tags)
+        return self.quote('NOTICE', target, ':' + ' '.join(msg), tags=tags)
+
+    def ctcp(self, target, *msg, reply=False, tags=None, split=False):
+        if split and len(msg) > 1:
+            return self._send_split('NOTICE' if reply else 'PRIVMSG', target,
+                                    ' '.join(msg[1:]), tags,
+                                    '\x01' + msg[0] + ' ', '\x01')
         m = (self.notice if reply else self.msg)
         return m(target, '\x01{}\x01'.format(' '.join(msg)), tags=tags)
 
-    def me(self, target, *msg, tags=None):
-        return self.ctcp(target, 'ACTION', *msg, tags=tags)
+    def me(self, target, *msg, tags=None, split=False):
+        return self.ctcp(target, 'ACTION', *msg, tags=tags, split=split)
+
+    # Send the same message to multiple targets with as few lines as possible
+    def msg_many(self, targets, *msg, tags=None):
+        return self._send_targets('PRIVMSG', targets, ' '.join(msg), tags)
+
+    def notice_many(self, targets, *msg, tags=None):
+        return self._send_targets('NOTICE', targets, ' '.join(msg), tags)
+
+    # Returns the maximum number of targets for a command from ISUPPORT, or
+    # None if there is no limit. "default" is used if the server doesn't
+    # say.
+    def _max_targets(self, cmd, default=1):
+        targmax = self.isupport.get('TARGMAX')
+        if isinstance(targmax, str):
+            for item in targmax.split(','):
+                name, _, limit = item.partition(':')
+                if name.upper() == cmd:
+                    return int(limit) if limit.isdigit() else None
+
+            # Commands that aren't listed don't support multiple targets
+            if cmd in ('PRIVMSG', 'NOTICE'):
+                return 1
+            return default
+
+        maxtargets = self.isupport.get('MAXTARGETS')
+        if (cmd in ('PRIVMSG', 'NOTICE') and isinstance(maxtargets, int) and
+                maxtargets > 0):
+            return maxtargets
+        return default
+
+    def _send_targets(self, cmd, targets, text, tags):
+        size = self.msglen - len('{}  :{}\r\n'.format(cmd, text)
+                                 .encode('utf-8'))
+        return self.quote_many(
+            ((cmd, ','.join(batch), ':' + text) for batch in
+             _pack_targets(targets, self._max_targets(cmd), size)),
+            tags=tags
+        )
 
-    # Allow per-connection handlers
-    def Handler(self, *events, ircv3=False, colon=True):
-        return _add_handler(self.handlers, events, ircv3, False, colon)
+    # Join or part multiple channels with as few lines as possible. "keys"
+    # is an optional dict of channel keys.
+    def join(self, channels, keys=None):
+        return self.quote_many(self._join_lines(channels, keys))
+
+    def part(self, channels, msg=None):
+        if isinstance(channels, str):
+            channels = channels.split(',')
+        suffix = ' :' + msg if msg else ''
+        size = self.msglen - len('PART {}\r\n'.format(suffix).encode('utf-8'))
+        return self.quote_many(
+            'PART ' + ','.join(batch) + suffix for batch in
+            _pack_targets(channels, self._max_targets('PART', None), size)
+        )
+
+    def _join_lines(self, channels, keys=None):
+        if isinstance(channels, str):
+            channels = channels.split(',')
+
+        # Channels with keys have to be first
+        keys = keys or {}
+        channels = sorted(channels, key=lambda channel: channel not in keys)
+
+        # Key lengths are counted as part of the channel name when splitting
+        # channels into multiple lines.
+        def length(channel):
+            if channel in keys:
+                return len('{} {}'.format(channel, keys[channel])
+                           .encode('utf-8')) + 1
+            return len(channel.encode('utf-8')) + 1
+
+        size = self.msglen - len(b'JOIN \r\n')
+        for batch in _pack_targets(channels, self._max_targets('JOIN', None),
+                                   size, length):
+            batch_keys = [keys[channel] for channel in batch
+                          if channel in keys]
+            if batch_keys:
+                yield 'JOIN {} {}'.format(','.join(batch),
+                                          ','.join(batch_keys))
+            else:
+                yield 'JOIN ' + ','.join(batch)
+
+    # Send text as multiple PRIVMSGs or NOTICEs if it is too long to fit in
+    # one message. The lines are sent with quote_many().
+    def _send_split(self, cmd, target, text, tags, prefix='', suffix=''):
+        # Servers add ":nick!ident@host " when relaying messages, if the
+        # hostname isn't known yet assume that it is 63 bytes long.
+        userhost = self._userhost or '~{}@{}'.format(self.ident, 'x' * 63)
+        size = self.msglen - len(':{}!{} {} {} :{}{}\r\n'.format(
+            self.current_nick, userhost, cmd, target, prefix, suffix
+        ).encode('utf-8'))
+
+        lines = _split_text(text, max(size, 16))
+        return self.quote_many(((cmd, target, ':' + prefix + line + suffix)
+                                for line in lines), tags=tags)
 
-    def CmdHandler(self, *events, ircv3=False, colon=True):
-        return _add_handler(self.handlers, events, ircv3, True, colon)
+    # Allow per-connection handlers
+    def Handler(self, *events, ircv3=False, colon=True, message=False,
+                target=None, sender=None, prefix=None, pattern=None):
+        return _add_handler(self.handlers, events, ircv3, False, colon,
+                            message,
+                            _make_filter(target, sender, prefix, pattern),
+                            self._handler_filters)
+
+    def CmdHandler(self, *events, ircv3=False, colon=True, message=False,
+                   target=None, sender=None, prefix=None, pattern=None):
+        return _add_handler(self.handlers, events, ircv3, True, colon,
+                            message,
+                            _make_filter(target, sender, prefix, pattern),
+                            self._handler_filters)
 
     # The connect function
     def connect(self):
@@ -401,21 +2063,166 @@ class IRC:
             self._send_lock.release()
 
         self.debug('Connecting to', self.ip, 'port', self.port)
-        self.sock = socket.create_connection(
-            (self.ip, self.port),
-            timeout=self.ping_timeout or self.ping_interval,
-        )
+        timings = self.connect_timings = {}
+        start = time.monotonic()
+        resolver = self.resolver or _default_resolver
+        addrs = resolver.resolve(self.ip, self.port)
+        timings['dns'] = time.monotonic() - start
+        try:
+            self.sock = self._create_connection(addrs)
+        except OSError:
+            resolver.invalidate(self.ip, self.port)
+            raise
+        timings['tcp'] = time.monotonic() - start - timings['dns']
         if self.ssl:
             self.debug('SSL handshake')
-            ctx = ssl.create_default_context(cafile=get_ca_certs())
-            if self.verify_ssl:
-                assert ctx.check_hostname
-            else:
-                warnings.warn('Disabling verify_ssl is usually a bad idea.')
-                ctx.check_hostname = False
-                ctx.verify_mode = ssl.CERT_NONE
-            self.sock = ctx.wrap_socket(self.sock, server_hostname=self.ip)
+            ctx = self._get_ssl_context()
+
+            # The session keyword argument was added in Python 3.6, sessions
+            # are never saved on older versions.
+            kwargs = {}
+            session = self._get_ssl_session(ctx)
+            if session is not None:
+                kwargs['session'] = session
+            self.sock = ctx.wrap_socket(self.sock, server_hostname=self.ip,
+                                        **kwargs)
+            timings['tls'] = (time.monotonic() - start - timings['dns'] -
+                              timings['tcp'])
+            if getattr(self.sock, 'session_reused', False):
+                self.debug('TLS session resumed')
+
+        if self.metrics is not None:
+            self.metrics.connects += 1
+
+        self._registration_start = time.monotonic()
+        self._login()
+        self.debug('Starting main loop...')
+        self._sasl = self._pinged = self._keepnick_active = False
+        self._start_main_loop()
+
+    # Connect to the server. If there are multiple addresses, a new connection
+    # attempt is started every connection_attempt_delay seconds (or as soon as
+    # an attempt fails) and the first one to succeed is used, so an
+    # unreachable address doesn't stall connecting (RFC 8305).
+    def _create_connection(self, addrs):
+        timeout = self.ping_timeout or self.ping_interval
+        if len(addrs) == 1:
+            family, type, proto, _, address = addrs[0]
+            sock = socket.socket(family, type, proto)
+            try:
+                sock.settimeout(timeout)
+                sock.connect(address)
+            except OSError:
+                sock.close()
+                raise
+            self.server_address = address
+            return sock
+
+        addrs = collections.deque(_interleave_addrs(addrs))
+        selector = selectors.DefaultSelector()
+        deadline = timeout and time.monotonic() + timeout
+        next_attempt = 0
+        error = None
+        try:
+            while addrs or selector.get_map():
+                # Start another attempt if the last one is taking too long or
+                # if every other attempt has failed
+                now = time.monotonic()
+                if addrs and (now >= next_attempt or not selector.get_map()):
+                    family, type, proto, _, address = addrs.popleft()
+                    next_attempt = now + self.connection_attempt_delay
+                    sock = None
+                    try:
+                        sock = socket.socket(family, type, proto)
+                        sock.setblocking(False)
+                        err = sock.connect_ex(address)
+                    except OSError as e:
+                        if sock is not None:
+                            sock.close()
+                        error = e
+                        continue
+
+                    if err in _connect_in_progress:
+                        selector.register(sock, selectors.EVENT_WRITE,
+                                          address)
+                    elif err:
+                        sock.close()
+                        error = OSError(err, os.strerror(err))
+                    else:
+                        self.server_address = address
+                        sock.settimeout(timeout)
+                        return sock
+                    continue
+
+                # Wait for an attempt to finish
+                if deadline and now >= deadline:
+                    raise socket.timeout('timed out')
+                wait = [t for t in (deadline, addrs and next_attempt) if t]
+                wait = min(wait) - now if wait else None
+                for key, _ in selector.select(wait):
+                    sock = key.fileobj
+                    selector.unregister(sock)
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err == 0:
+                        self.server_address = key.data
+                        sock.settimeout(timeout)
+                        return sock
+                    sock.close()
+                    error = OSError(err, os.strerror(err))
+                    next_attempt = 0
+
+            raise error or OSError('getaddrinfo returned an empty list')
+        finally:
+            for key in list(selector.get_map().values()):
+                key.fileobj.close()
+            selector.close()
+
+    # Returns how long to wait before the next reconnection attempt, or None
+    # if miniirc shouldn't reconnect.
+    def _next_reconnect(self):
+        if not self.persist:
+            return None
+        policy = self.reconnect_policy or _legacy_reconnect_policy
+        attempt = self._reconnect_attempts
+        if policy.max_attempts is not None and attempt >= policy.max_attempts:
+            self.debug('Giving up after', attempt, 'reconnection attempts.')
+            return None
+
+        self._reconnect_attempts += 1
+        delay = policy.delay(attempt)
+        if (policy.on_reconnect is not None and
+                policy.on_reconnect(self, attempt + 1, delay) is False):
+            return None
+        return delay
+
+    # Reconnect until it works or the reconnect policy gives up
+    def _reconnect(self):
+        while True:
+            delay = self._next_reconnect()
+            if delay is None:
+                return
+            time.sleep(delay)
+            if self._reconnect_now(delay):
+                return
 
+    # Returns True if reconnecting worked or if miniirc should stop trying
+    def _reconnect_now(self, delay):
+        if not self.persist:
+            return True
+        self.debug('Reconnecting...')
+        if self.metrics is not None:
+            self.metrics.reconnects += 1
+        try:
+            self.connect()
+        except OSError:
+            self.debug('Failed to reconnect!')
+            self.connected = None
+            return False
+        self.connect_timings['backoff'] = delay
+        return True
+
+    # Send the commands required to log in after connecting
+    def _login(self):
         self._current_nick = self._desired_nick
         self._unhandled_caps = None
         if self.server_password is not None:
@@ -425,11 +2232,36 @@ class IRC:
                    force=True)
         self.quote('NICK', self._desired_nick, force=True)
         atexit.register(self.disconnect)
-        self.debug('Starting main loop...')
-        self._sasl = self._pinged = self._keepnick_active = False
-        self._start_main_loop()
+
+    def _get_ssl_context(self):
+        if self.ssl_context is not None:
+            return self.ssl_context
+        if not self.verify_ssl:
+            warnings.warn('Disabling verify_ssl is usually a bad idea.')
+        return _get_ssl_context(bool(self.verify_ssl), get_ca_certs())
+
+    # Returns the TLS session from the last connection to the same server
+    # (if any) so that the handshake can be resumed.
+    def _get_ssl_session(self, ctx):
+        session = self._ssl_session
+        if session is not None and session[0] == (self.ip, self.port, ctx):
+            return session[1]
+        return None
 
     def _start_main_loop(self):
+        if self._reactor is not None:
+            self._reactor_done.clear()
+            self.sock.setblocking(False)
+            self._reactor_buffer = _RecvBuffer()
+            self.debug('Main loop running!')
+            self._reactor.register(self.sock, self._reactor_read)
+            if self.ping_interval:
+                self._ping_deadline = time.monotonic() + self.ping_interval
+                self._ping_timer = self._reactor.call_later(
+                    self.ping_interval, self._reactor_ping, self.sock
+                )
+            return
+
         # Start the thread before updating _main_thread so that
         # wait_until_disconnected() works correctly.
         thread = threading.Thread(target=self._main)
@@ -444,11 +2276,33 @@ class IRC:
         atexit.unregister(self.disconnect)
         self._current_nick = self._desired_nick
         self._unhandled_caps = None
+        self._userhost = None
+        if self.flood_control is not None:
+            self.flood_control.clear()
+        if self.state_tracker is not None:
+            self.state_tracker.clear()
+
+        # Save the TLS session so that it can be resumed when reconnecting.
+        # With TLS 1.3, the session is only available after data has been
+        # received, so it's saved here instead of after the handshake.
+        session = getattr(getattr(self, 'sock', None), 'session', None)
+        if session is not None:
+            self._ssl_session = ((self.ip, self.port, self.sock.context),
+                                 session)
+
         try:
             self.quote('QUIT :' + str(msg or self.quit_message), force=True)
             self.sock.shutdown(socket.SHUT_RDWR)
         except:
             pass
+        if self._reactor is not None:
+            if hasattr(self, 'sock'):
+                self._reactor.unregister(self.sock)
+            if self._ping_timer is not None:
+                self._reactor.cancel(self._ping_timer)
+                self._ping_timer = None
+            if not self.persist:
+                self._reactor_done.set()
         try:
             self.sock.close()
         except:
@@ -472,36 +2326,212 @@ class IRC:
 
     # Start a handler function
     def _start_handler(self, handlers, command, hostmask, tags, args):
-        r = False
+        target = self._get_target(args)
+        event = str(command).upper()
+        plan = []
         for handler in handlers:
-            r = True
-            params = [self, hostmask, list(args)]
-            if not hasattr(handler, 'miniirc_colon') and args and \
-                    args[-1].startswith(':'):
-                params[2][-1] = args[-1][1:]
-            if hasattr(handler, 'miniirc_ircv3'):
-                params.insert(2, dict(tags))
-            if hasattr(handler, 'miniirc_cmd_arg'):
-                params.insert(1, command)
-
-            if self._executor is None:
-                threading.Thread(target=handler, args=params).start()
-            else:
-                self._executor.submit(handler, *params)
-        return r
+            filter = self._find_filter(event, handler)
+            if self._check_target(filter, target):
+                plan.append(self._compile_handler(handler, event, filter))
+        self._dispatch_plan(tuple(plan), command, hostmask, tags, args)
+        return bool(plan)
+
+    # Returns the filter a handler was registered with. This is only used by
+    # _start_handler(), which doesn't know which handlers dict it was given.
+    def _find_filter(self, event, handler):
+        for filters in (self._handler_filters, _global_handler_filters):
+            for key in ((event, handler), (None, handler)):
+                if key in filters:
+                    return filters[key]
+        return None
+
+    # Returns the normalised first argument, which is the target of most
+    # commands
+    def _get_target(self, args):
+        if not args:
+            return None
+        target = args[0]
+        if target[:1] == ':':
+            target = target[1:]
+        return self.casefold(target)
+
+    # Checks a handler's target filter without a dispatch table
+    def _check_target(self, filter, target):
+        if filter is None or filter.targets is None:
+            return True
+        return target in map(self.casefold, filter.targets)
+
+    # Returns the function used to run the handler
+    def _get_runner(self, handler):
+        if handler in _builtin_handlers:
+            return self._run_inline
+        return self._run_handler
+
+    # Run a handler function in the current thread
+    def _run_inline(self, handler, params):
+        _call(handler, *params)
+
+    # Run a handler function
+    def _run_handler(self, handler, params):
+        executor = self._executor or handler_pool or _get_handler_pool()
+        executor.submit(handler, *params)
+
+    # Profiled handlers are submitted to the executor with
+    # HandlerProfiler._call, coroutine handlers (in AsyncIRC) aren't profiled.
+    def _compile_handler(self, handler, event=None, filter=None):
+        run = self._get_runner(handler)
+        profiler = self.handler_profiler
+        if profiler is not None and run == self._run_handler:
+            stats = profiler._get_stats(handler, event)
+            call = profiler._call
+            perf_counter = time.perf_counter
+
+            # The queueing delay starts when the line was received, or now
+            # if the handler wasn't called for a received line
+            def run_profiled(handler, params):
+                queued_at = self._received_at or perf_counter()
+                self._run_handler(call, (self, stats, handler,
+                                         queued_at) + tuple(params))
+            run = run_profiled
+
+        return (run, handler, _get_param_builder(handler),
+                self._compile_filter(filter))
+
+    # Returns a function that checks a handler's sender, prefix and pattern
+    # filters, or None if the handler doesn't have any.
+    def _compile_filter(self, filter):
+        if filter is None or (filter.senders is None and
+                              filter.prefix is None and
+                              filter.pattern is None):
+            return None
+
+        senders = filter.senders
+        if senders is not None:
+            senders = _compile_masks(map(self.casefold, senders)).match
+        prefix = filter.prefix
+        pattern = filter.pattern
+        casefold = self.casefold
+
+        def match(hostmask, args):
+            if senders is not None and not senders(
+                    casefold('{}!{}@{}'.format(*hostmask))):
+                return False
+            if prefix is None and pattern is None:
+                return True
+            if not args:
+                return False
+            return ((prefix is None or args[-1].startswith(prefix)) and
+                    (pattern is None or pattern.search(args[-1]) is not None))
+
+        return match
+
+    # Normalises a nickname or channel name with the server's casemapping so
+    # that it can be compared to other normalised names
+    def casefold(self, name):
+        return name.translate(_casemaps.get(self.isupport.get('CASEMAPPING'),
+                                            _rfc1459))
+
+    # Returns a list of statistics for each handler (see
+    # HandlerProfiler.report()), or an empty list if handler profiling is
+    # disabled.
+    def handler_stats(self):
+        if self.handler_profiler is None:
+            return []
+        return self.handler_profiler.report()
+
+    # Create a list of handlers for a command and work out how they should be
+    # called. This is cached until another handler is added.
+    def _compile_dispatch(self, cmd):
+        upper_cmd = str(cmd).upper()
+        all_handlers = []
+        r = False
+        for handlers, filters in ((_global_handlers, _global_handler_filters),
+                                  (self.handlers, self._handler_filters)):
+            if upper_cmd in handlers:
+                r = r or bool(handlers[upper_cmd])
+            for event in (upper_cmd, None):
+                all_handlers.extend((handler, filters.get((event, handler)))
+                                    for handler in handlers.get(event, ()))
+
+        # Handlers with a target filter are only added to the plans for their
+        # targets, every plan keeps the order that handlers were added in.
+        plan = []
+        targets = {}
+        for handler, filter in all_handlers:
+            entry = self._compile_handler(handler, upper_cmd, filter)
+            if filter is None or filter.targets is None:
+                plan.append(entry)
+                for target_plan in targets.values():
+                    target_plan.append(entry)
+                continue
+
+            for target in set(map(self.casefold, filter.targets)):
+                if target not in targets:
+                    targets[target] = list(plan)
+                targets[target].append(entry)
+
+        # Don't let the cache grow forever if the server sends lots of
+        # unknown commands.
+        if len(self._dispatch) > 512:
+            self._dispatch.clear()
+
+        targets = {target: tuple(target_plan)
+                   for target, target_plan in targets.items()}
+        res = self._dispatch[cmd] = (r, upper_cmd, tuple(plan),
+                                     targets or None)
+        return res
+
+    def _dispatch_plan(self, plan, cmd, hostmask, tags, args, *, raw=None,
+                       received=None):
+        if args and args[-1][:1] == ':':
+            stripped = args[:-1]
+            stripped.append(args[-1][1:])
+        else:
+            stripped = args
+
+        message = None
+        calls = 0
+        for run, handler, build, match in plan:
+            if match is not None and not match(hostmask, stripped):
+                continue
+            calls += 1
+            if build is not None:
+                run(handler, build(self, cmd, hostmask, tags, args, stripped))
+                continue
+
+            # Message handlers all get the same Message object
+            if message is None:
+                message = Message(cmd, hostmask, tags, stripped, raw,
+                                  received)
+            run(handler, (self, message))
+        return calls
 
     # Launch handlers
-    def _handle(self, cmd, hostmask, tags, args):
-        r = False
-        cmd = str(cmd).upper()
-        hostmask = tuple(hostmask)
-        for handlers in (_global_handlers, self.handlers):
-            if cmd in handlers:
-                r = self._start_handler(handlers[cmd], cmd, hostmask, tags,
-                                        args)
+    def _handle(self, cmd, hostmask, tags, args, *, raw=None, received=None):
+        # Channel state is updated before handlers are called so that they
+        # see the new state
+        if self.state_tracker is not None:
+            self.state_tracker._update(cmd, hostmask, args)
 
-            if None in handlers:
-                self._start_handler(handlers[None], cmd, hostmask, tags, args)
+        if self._dispatch_generation != _handler_generation:
+            self._dispatch_generation = _handler_generation
+            self._dispatch.clear()
+
+        try:
+            r, cmd, plan, targets = self._dispatch[cmd]
+        except KeyError:
+            r, cmd, plan, targets = self._compile_dispatch(cmd)
+
+        if targets is not None and args:
+            plan = targets.get(self._get_target(args), plan)
+
+        if plan:
+            if type(hostmask) is not tuple:
+                hostmask = tuple(hostmask)
+            calls = self._dispatch_plan(plan, cmd, hostmask, tags, args,
+                                        raw=raw, received=received)
+            if self.metrics is not None:
+                self.metrics.handler_calls += calls
 
         return r
 
@@ -517,33 +2547,115 @@ class IRC:
             if not handled:
                 self.finish_negotiation(cap)
 
+    # Receive data from the socket into a _RecvBuffer
+    def _recv(self, buffer):
+        space = buffer.space()
+
+        # Acquire the send lock when receiving data because I don't think
+        # you're supposed to call SSL functions from multiple threads at once
+        self._send_lock.acquire()
+        try:
+            size = self.sock.recv_into(space)
+        finally:
+            self._send_lock.release()
+
+        if not size:
+            raise ConnectionAbortedError
+        buffer.end += size
+        if self.metrics is not None:
+            self.metrics.bytes_received += size
+
+    # Decode a line that isn't valid UTF-8
+    def _decode_fallback(self, line):
+        for encoding in self.fallback_encodings:
+            try:
+                return line.decode(encoding)
+            except UnicodeDecodeError:
+                pass
+        return line.decode('utf-8', 'replace')
+
+    # Handle any complete lines in buffer and move the incomplete line (if
+    # any) to the start of the buffer.
+    def _handle_lines(self, buffer):
+        # Only search data that hasn't been searched before
+        size = buffer.end
+        last = max(buffer.data.rfind(b'\n', buffer.scanned, size),
+                   buffer.data.rfind(b'\r', buffer.scanned, size))
+        if last < 0:
+            buffer.scanned = size
+            return
+
+        # Splitting every complete line at once is a lot faster than finding
+        # each line terminator in Python code.
+        lines = buffer.view[:last].tobytes().replace(b'\r', b'\n')
+        buffer.end = size = size - last - 1
+        buffer.data[:size] = buffer.view[last + 1:last + 1 + size].tobytes()
+        buffer.scanned = size
+
+        # Message.received uses the wall clock, HandlerProfiler measures
+        # queueing delays from _received_at.
+        received = time.time()
+        self._received_at = time.perf_counter()
+        parse = self._parse
+        if parse is ircv3_message_parser:
+            parse = _lazy_message_parser
+        lines = lines.split(b'\n')
+        if self.metrics is not None:
+            self.metrics.lines_received += len(lines) - lines.count(b'')
+        try:
+            for line in lines:
+                if not line:
+                    continue
+
+                # Strict UTF-8 decoding is fastest (especially for ASCII
+                # text), other encodings are only tried if it fails.
+                try:
+                    line = line.decode('utf-8')
+                except UnicodeDecodeError:
+                    line = self._decode_fallback(line)
+
+                self.debug('<<<', line)
+                try:
+                    result = parse(line)
+                except Exception:
+                    result = None
+                if isinstance(result, tuple) and len(result) == 4:
+                    self._handle(*result, raw=line, received=received)
+                else:
+                    self.debug('Ignored message:', line)
+                    if self.metrics is not None:
+                        self.metrics.ignored_lines += 1
+        finally:
+            self._received_at = None
+
+    # Send a PING to check if the connection is still alive
+    def _send_ping(self):
+        self._pinged = True
+        self._ping_sent = time.monotonic()
+        self.quote('PING', ':miniirc-ping', force=True)
+
+    # Attempt to change nicknames every 30 seconds
+    def _check_keepnick(self):
+        if (self._keepnick_active and
+                time.monotonic() > self._last_keepnick_attempt + 30):
+            self.send('NICK', self._desired_nick, force=True)
+            self._last_keepnick_attempt = time.monotonic()
+
     # The main loop
     def _main(self):
         # Make the socket non-blocking.
         self.sock.setblocking(False)
 
         self.debug('Main loop running!')
-        buffer = b''
+        buffer = _RecvBuffer()
         while True:
             try:
-                assert len(buffer) < 65535, 'Very long line detected!'
                 try:
-                    # Acquire the send lock when receiving data because I don't
-                    # think you're supposed to call SSL functions from multiple
-                    # threads at once
-                    self._send_lock.acquire()
-                    try:
-                        raw = self.sock.recv(8192).replace(b'\r', b'\n')
-                    finally:
-                        self._send_lock.release()
-
-                    if not raw:
-                        raise ConnectionAbortedError
-                    buffer += raw
+                    self._recv(buffer)
                 except (BlockingIOError, ssl.SSLWantReadError):
                     # Wait for the socket to become ready again
-                    readable, _, _ = select.select(
-                        (self.sock,), (), (self.sock,),
+                    readable = _wait_for_socket(
+                        self.sock, selectors.EVENT_READ,
 
                         # self.ping_interval should be used when
                         # self.ping_timeout is None
@@ -555,53 +2667,108 @@ class IRC:
                     if not readable:
                         if self._pinged:
                             raise TimeoutError
-                        self._pinged = True
-                        self.quote('PING', ':miniirc-ping', force=True)
+                        self._send_ping()
                 except ssl.SSLWantWriteError:
-                    select.select((), (self.sock,), (self.sock,),
-                                  self.ping_timeout or self.ping_interval)
-
-                # Attempt to change nicknames every 30 seconds
-                if (self._keepnick_active and
-                        time.monotonic() > self._last_keepnick_attempt + 30):
-                    self.send('NICK', self._desired_nick, force=True)
-                    self._last_keepnick_attempt = time.monotonic()
+                    _wait_for_socket(self.sock, selectors.EVENT_WRITE,
+                                     self.ping_timeout or self.ping_interval)
+
+                self._check_keepnick()
             except OSError as e:
                 self.debug('Lost connection!', repr(e))
                 self.disconnect(auto_reconnect=True)
-                while self.persist:
-                    time.sleep(5)
-                    self.debug('Reconnecting...')
-                    try:
-                        self.connect()
-                    except OSError:
-                        self.debug('Failed to reconnect!')
-                        self.connected = None
-                    else:
-                        return
+                self._reconnect()
                 return
 
-            raw = buffer.split(b'\n')
-            buffer = raw.pop()
-            for line in raw:
-                line = line.decode('utf-8', 'replace')
+            self._handle_lines(buffer)
 
-                if line:
-                    self.debug('<<<', line)
-                    try:
-                        result = self._parse(line)
-                    except Exception:
-                        result = None
-                    if isinstance(result, tuple) and len(result) == 4:
-                        self._handle(*result)
-                    else:
-                        self.debug('Ignored message:', line)
-            del raw
+    # Called from the reactor thread when the socket is readable
+    def _reactor_read(self):
+        try:
+            while True:
+                try:
+                    self._recv(self._reactor_buffer)
+                except (BlockingIOError, ssl.SSLWantReadError,
+                        ssl.SSLWantWriteError):
+                    break
+
+                if self.ping_interval:
+                    self._ping_deadline = time.monotonic() + (
+                        self._pinged and self.ping_timeout or
+                        self.ping_interval
+                    )
+                self._handle_lines(self._reactor_buffer)
+
+            self._check_keepnick()
+        except OSError as e:
+            self._reactor_lost(e)
+
+    # Ping timeouts are timers instead of select() timeouts when using a
+    # reactor. The timer is only rescheduled when it fires so that receiving
+    # data doesn't have to touch the reactor's timer heap.
+    def _reactor_ping(self, sock):
+        if sock is not self.sock or self.connected is None:
+            return
+
+        now = time.monotonic()
+        if now < self._ping_deadline:
+            self._ping_timer = self._reactor.call_later(
+                self._ping_deadline - now, self._reactor_ping, sock
+            )
+            return
+
+        try:
+            if self._pinged:
+                raise TimeoutError
+            self._send_ping()
+            self._check_keepnick()
+        except OSError as e:
+            self._reactor_lost(e)
+            return
+
+        delay = self.ping_timeout or self.ping_interval
+        self._ping_deadline = now + delay
+        self._ping_timer = self._reactor.call_later(delay, self._reactor_ping,
+                                                    sock)
+
+    def _reactor_lost(self, e):
+        self.debug('Lost connection!', repr(e))
+        self.disconnect(auto_reconnect=True)
+        self._reactor_schedule_reconnect()
+
+    def _reactor_schedule_reconnect(self):
+        delay = self._next_reconnect()
+        if delay is None:
+            self._reactor_done.set()
+        else:
+            self._reactor.call_later(delay, self._reactor_reconnect, delay)
+
+    # connect() blocks, so it gets run in a temporary thread to avoid stalling
+    # every other connection using the reactor.
+    def _reactor_reconnect(self, delay):
+        if self.persist:
+            threading.Thread(target=self._reactor_reconnect_thread,
+                             args=(delay,)).start()
+        else:
+            self._reactor_done.set()
+
+    def _reactor_reconnect_thread(self, delay):
+        if not self._reconnect_now(delay):
+            self._reactor_schedule_reconnect()
 
     def wait_until_disconnected(self, *, _timeout=None):
-        # The main thread may be replaced on reconnects
-        while self._main_thread and self._main_thread.is_alive():
-            self._main_thread.join(_timeout)
+        while True:
+            # The main thread may be replaced on reconnects
+            while self._main_thread and self._main_thread.is_alive():
+                self._main_thread.join(_timeout)
+
+            if self._reactor is None:
+                return
+
+            # The STS handler sets _main_thread while reconnecting
+            self._reactor_done.wait(_timeout)
+            if self._reactor_done.is_set() and not (
+                    self._main_thread and self._main_thread.is_alive()):
+                return
 
     def main(self):
         warnings.warn('The miniirc.IRC.main() function is deprecated and '
@@ -609,15 +2776,22 @@ class IRC:
         # The main thread may be started after the if check and before
         # _start_main_loop. This function is deprecated so fixing this probably
         # isn't worthwhile.
-        if not self._main_thread or not self._main_thread.is_alive():
+        if self._reactor is None and (not self._main_thread or
+                                      not self._main_thread.is_alive()):
             self._start_main_loop()
 
 
 # Handle some IRC messages by default.
 @Handler('001')
 def _handler(irc, hostmask, args):
+    # Handlers run in other threads, so the connection may have been lost
+    # before this runs. Setting irc.connected would stop reconnecting from
+    # working.
+    if irc.connected is None:
+        return
     irc.connected = True
     irc.isupport.clear()
+    irc._dispatch.clear()
     irc._unhandled_caps = None
     irc.debug('Connected!')
 
@@ -635,17 +2809,31 @@ def _handler(irc, hostmask, args):
         irc.debug('Logging in (no SASL, aww)...')
         irc.msg('NickServ', 'identify ' + irc.ns_identity)
 
+    irc._reconnect_attempts = 0
+    irc._joins_start = time.monotonic()
+    registration_start = getattr(irc, '_registration_start', None)
+    if registration_start is not None:
+        irc.connect_timings['registration'] = (irc._joins_start -
+                                               registration_start)
+
     # Join channels
     if irc.channels:
         irc.debug('*** Joining channels...', irc.channels)
-        irc.quote('JOIN', ','.join(irc.channels))
+        irc._pending_joins = set(map(irc.casefold, irc.channels))
+        irc.quote_many(irc._join_lines(irc.channels))
+    else:
+        irc._pending_joins = None
+        irc.debug('Connection timings:', irc.connect_timings)
 
     # Send any queued messages
     with irc._send_lock:
         sendq, irc.sendq = irc.sendq, None
     if sendq:
         for i in sendq:
-            irc.quote(*i)
+            if isinstance(i, bytes):
+                irc.quote_raw(i)
+            else:
+                irc.quote(*i)
 
 
 @Handler('PING', colon=True)
@@ -657,6 +2845,17 @@ def _handler(irc, hostmask, args):
 def _handler(irc, hostmask, args):
     if args and args[-1] == 'miniirc-ping' and irc.ping_interval:
         irc._pinged = False
+        if irc.metrics is not None and irc._ping_sent is not None:
+            irc.metrics._observe_rtt(time.monotonic() - irc._ping_sent)
+            irc._ping_sent = None
+
+
+# Slow down if the server disconnects miniirc for flooding
+@Handler('ERROR', colon=False)
+def _handler(irc, hostmask, args):
+    if (irc.flood_control is not None and args and
+            'flood' in args[-1].lower()):
+        irc.flood_control._excess_flood()
 
 
 @Handler('432', '433')
@@ -677,11 +2876,11 @@ def _handler(irc, hostmask, args):
 
 @Handler('NICK', colon=False)
 def _handler(irc, hostmask, args):
-    if hostmask[0].lower() == irc._current_nick.lower():
+    if irc.casefold(hostmask[0]) == irc.casefold(irc._current_nick):
         irc._current_nick = args[-1]
 
         # Deactivate keepnick if the client has the right nickname
-        if irc._current_nick.lower() == irc._desired_nick.lower():
+        if irc.casefold(irc._current_nick) == irc.casefold(irc._desired_nick):
             irc._keepnick_active = False
 
 
@@ -768,6 +2967,19 @@ def _handler(irc, hostmask, args):
 
 
 # STS
+def _sts_upgrade(irc, port):
+    persist = irc.persist
+    irc.disconnect()
+    irc.debug('STS detected, enabling TLS/SSL and changing the port to ',
+              port)
+    irc.port = port
+    irc.ssl = True
+    time.sleep(1 if irc.reconnect_policy is None else
+               irc.reconnect_policy.delay(0))
+    irc.connect()
+    irc.persist = persist
+
+
 @Handler('IRCv3 STS')
 def _handler(irc, hostmask, args):
     if not irc.ssl and len(args) == 2:
@@ -776,18 +2988,12 @@ def _handler(irc, hostmask, args):
         except (IndexError, ValueError):
             return
 
-        # Stop irc.wait_until_disconnected() from returning early
-        irc._main_thread = threading.current_thread()
-
-        persist = irc.persist
-        irc.disconnect()
-        irc.debug('STS detected, enabling TLS/SSL and changing the port to ',
-                  port)
-        irc.port = port
-        irc.ssl = True
-        time.sleep(1)
-        irc.connect()
-        irc.persist = persist
+        # Built-in handlers run in the receiving thread, so reconnect in a
+        # new one. This is also used as irc._main_thread to stop
+        # irc.wait_until_disconnected() from returning early.
+        thread = threading.Thread(target=_sts_upgrade, args=(irc, port))
+        irc._main_thread = thread
+        thread.start()
     else:
         irc.finish_negotiation('sts')
 
@@ -826,16 +3032,45 @@ def _handler(irc, hostmask, args):
 
     irc.isupport.update(isupport)
 
+    # Handler target filters are indexed with the casemapping
+    if 'CASEMAPPING' in isupport:
+        irc._dispatch.clear()
+
 
 # Attempt to get the desired nickname if the user that currently has it quits
 @Handler('QUIT', 'NICK')
 def _handler(irc, hostmask, args):
     if (irc.connected and irc._keepnick_active and
-            hostmask[0].lower() == irc._desired_nick.lower()):
+            irc.casefold(hostmask[0]) == irc.casefold(irc._desired_nick)):
         irc.send('NICK', irc._desired_nick, force=True)
         irc._last_keepnick_attempt = time.monotonic()
 
 
+# Keep track of miniirc's own ident and hostname so that irc.msg(split=True)
+# knows how long the prefix added by the server will be
+@CmdHandler('JOIN', 'CHGHOST', '396', colon=False)
+def _handler(irc, cmd, hostmask, args):
+    if cmd == '396':
+        if irc._userhost and len(args) > 1:
+            ident = irc._userhost.split('@', 1)[0]
+            irc._userhost = '{}@{}'.format(ident, args[1])
+    elif hostmask[0] == irc.current_nick:
+        if cmd == 'JOIN':
+            irc._userhost = '{}@{}'.format(hostmask[1], hostmask[2])
+
+            # Record how long it took to join every channel
+            pending = irc._pending_joins
+            if pending and args:
+                pending.discard(irc.casefold(args[0]))
+                if not pending:
+                    irc._pending_joins = None
+                    irc.connect_timings['joins'] = (time.monotonic() -
+                                                    irc._joins_start)
+                    irc.debug('Connection timings:', irc.connect_timings)
+        elif len(args) > 1:
+            irc._userhost = '{}@{}'.format(args[0], args[1])
+
+
 # Stop trying to get the desired nickname if it's invalid or if nick changes
 # aren't permitted
 @Handler('432', '435', '447')
@@ -843,5 +3078,11 @@ def _handler(irc, hostmask, args):
     irc._keepnick_active = False
 
 
+# The built-in handlers are quick, so they're run in the receiving thread
+# instead of the handler pool. This stops slow handlers that fill up the pool
+# from delaying PONGs and registration.
+_builtin_handlers = frozenset(
+    itertools.chain.from_iterable(_global_handlers.values())
+)
 _colon_warning = True
 del _handler
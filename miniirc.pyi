@@ -3,21 +3,30 @@
 #   file slower to load.
 
 from __future__ import annotations
-import atexit, concurrent.futures, errno, io, threading, time, socket, sys
-from collections.abc import Callable, Iterable
-from typing import Any, Optional, Union, overload
+import atexit, concurrent.futures, errno, io, logging, re, threading, time
+import socket, ssl, sys
+from collections.abc import Callable, Iterable, Iterator, Mapping
+from typing import IO, Any, Optional, Union, overload
 
 if sys.version_info >= (3, 8):
     from typing import Literal
 else:
     from typing_extensions import Literal
 
+# IRC.ssl shadows the ssl module inside the IRC class
+_SSLContext = ssl.SSLContext
+
 # The version string and tuple
 ver: tuple[int, int, int] = ...
 version: str = ...
 
 # __all__ and _default_caps
-__all__: list[str] = ['CmdHandler', 'Handler', 'IRC']
+__all__: list[str] = ['ChannelState', 'CmdHandler', 'DebugLog',
+                       'FloodControl', 'Handler', 'HandlerPool',
+                       'HandlerProfiler', 'IRC', 'Message', 'Metrics',
+                       'Reactor', 'ReconnectPolicy', 'Resolver',
+                       'StateTracker', 'Tags', 'UserState',
+                       'prometheus_metrics']
 _default_caps: set[str] = {'account-tag', 'cap-notify', 'chghost',
                            'draft/message-tags-0.2', 'invite-notify', 'message-tags',
                            'oragono.io/maxline-2', 'server-time', 'sts'}
@@ -27,42 +36,83 @@ get_ca_certs: Callable[[], Optional[str]]
 
 # Create global handlers
 _global_handlers: dict[str, Callable] = {}
+_global_handler_filters: dict[tuple[Optional[str], Callable], Any] = {}
+
 
+def _add_handler(handlers, events, ircv3, cmd_arg, colon, message=False,
+                 filter=None,
+                 filters=None) -> Callable[[Callable], Callable]: ...
 
-def _add_handler(handlers, events, ircv3, cmd_arg, colon) \
-    -> Callable[[Callable], Callable]: ...
+
+# Handler filters
+_Filter = Optional[Union[str, Iterable[str]]]
 
 
 _handler_func_1 = Callable[['IRC', tuple[str, str, str], list[str]], Any]
 _handler_func_2 = Callable[['IRC', tuple[str, str, str],
                             dict[str, Union[str, bool]], list[str]], Any]
+_handler_func_5 = Callable[['IRC', 'Message'], Any]
 
 
 @overload
-def Handler(*events: str, colon: bool, ircv3: Literal[False] = False) \
+def Handler(*events: str, colon: bool, ircv3: Literal[False] = False,
+            message: Literal[False] = False,
+            target: _Filter = None, sender: _Filter = None,
+            prefix: _Filter = None,
+            pattern: Optional[Union[str, re.Pattern[str]]] = None) \
     -> Callable[[_handler_func_1], _handler_func_1]: ...
 
 
 @overload
-def Handler(*events: str, colon: bool, ircv3: Literal[True]) \
+def Handler(*events: str, colon: bool, ircv3: Literal[True],
+            message: Literal[False] = False,
+            target: _Filter = None, sender: _Filter = None,
+            prefix: _Filter = None,
+            pattern: Optional[Union[str, re.Pattern[str]]] = None) \
     -> Callable[[_handler_func_2], _handler_func_2]: ...
 
 
+@overload
+def Handler(*events: str, colon: bool = True, ircv3: bool = False,
+            message: Literal[True],
+            target: _Filter = None, sender: _Filter = None,
+            prefix: _Filter = None,
+            pattern: Optional[Union[str, re.Pattern[str]]] = None) \
+    -> Callable[[_handler_func_5], _handler_func_5]: ...
+
+
 _handler_func_3 = Callable[['IRC', str, tuple[str, str, str], list[str]], Any]
 _handler_func_4 = Callable[['IRC', str, tuple[str, str, str],
                             dict[str, Union[str, bool]], list[str]], Any]
 
 
 @overload
-def CmdHandler(*events: str, colon: bool, ircv3: Literal[False] = False) \
+def CmdHandler(*events: str, colon: bool, ircv3: Literal[False] = False,
+               message: Literal[False] = False,
+               target: _Filter = None, sender: _Filter = None,
+               prefix: _Filter = None,
+               pattern: Optional[Union[str, re.Pattern[str]]] = None) \
     -> Callable[[_handler_func_3], _handler_func_3]: ...
 
 
 @overload
-def CmdHandler(*events: str, colon: bool, ircv3: Literal[True]) \
+def CmdHandler(*events: str, colon: bool, ircv3: Literal[True],
+               message: Literal[False] = False,
+               target: _Filter = None, sender: _Filter = None,
+               prefix: _Filter = None,
+               pattern: Optional[Union[str, re.Pattern[str]]] = None) \
     -> Callable[[_handler_func_4], _handler_func_4]: ...
 
 
+@overload
+def CmdHandler(*events: str, colon: bool = True, ircv3: bool = False,
+               message: Literal[True],
+               target: _Filter = None, sender: _Filter = None,
+               prefix: _Filter = None,
+               pattern: Optional[Union[str, re.Pattern[str]]] = None) \
+    -> Callable[[_handler_func_5], _handler_func_5]: ...
+
+
 # Parse IRCv3 tags
 ircv3_tag_escapes: dict[str, str] = {':': ';', 's': ' ', 'r': '\r', 'n': '\n'}
 def _tags_to_dict(tag_list: Union[str, list[str]],
@@ -72,11 +122,40 @@ def _tags_to_dict(tag_list: Union[str, list[str]],
 def ircv3_message_parser(msg: str) -> tuple[str, tuple[str, str, str],
                                             dict[str, Union[str, bool]], list[str]]: ...
 
+# A read-only message passed to handlers created with message=True
+class Message:
+    command: str
+    hostmask: tuple[str, str, str]
+    tags: Mapping[str, Union[str, bool]]
+    args: tuple[str, ...]
+    raw: Optional[str]
+    received: Optional[float]
+
+    def __init__(self, command: str, hostmask: tuple[str, str, str],
+                 tags: dict[str, Union[str, bool]], args: Iterable[str],
+                 raw: Optional[str] = None,
+                 received: Optional[float] = None) -> None: ...
+
 # Escape tags
 def _escape_tag(tag: str) -> str: ...
 
+# Convert (tag, value) pairs into an IRCv3 tags string
+def _encode_tags(items: Iterable[tuple[str, Union[str, bool]]]) -> bytes: ...
+
 # Convert a dict into an IRCv3 tags string
-def _dict_to_tags(tags: dict[str, Union[str, bool]]) -> bytes: ...
+def _dict_to_tags(tags: Union[dict[str, Union[str, bool]], Tags]) -> bytes: ...
+
+# Pre-encoded IRCv3 tags
+class Tags(Mapping[str, Union[str, bool]]):
+    __slots__ = ('_encoded', '_tags')
+
+    def __init__(self, tags: Union[Mapping[str, Union[str, bool]],
+                                   Iterable[tuple[str,
+                                                  Union[str, bool]]]] = (),
+                 **kwargs: Union[str, bool]) -> None: ...
+    def __getitem__(self, key: str) -> Union[str, bool]: ...
+    def __iter__(self) -> Iterator[str]: ...
+    def __len__(self) -> int: ...
 
 # A wrapper for callable logfiles
 class _Logfile:
@@ -85,10 +164,146 @@ class _Logfile:
     def write(self, data: str) -> None: ...
     def __init__(self, func: Callable[[str], Any]) -> None: ...
 
+# A bounded thread pool for running handlers
+class HandlerPool:
+    overflow: Literal['block', 'drop', 'thread']
+    dropped: int
+
+    def __init__(self, max_workers: int = 16, *, max_queue: int = 1024,
+                 overflow: Literal['block', 'drop', 'thread'] = 'thread',
+                 idle_timeout: float = 60) -> None: ...
+    def submit(self, func: Callable[..., Any], *args: Any) -> None: ...
+    def qsize(self) -> int: ...
+
+handler_pool: Optional[HandlerPool] = None
+
+# Records how long handlers take to run
+class HandlerProfiler:
+    slow_threshold: Optional[float]
+    on_slow: Optional[Callable[[IRC, str, str, float], Any]]
+    buckets: tuple[float, ...]
+
+    def __init__(self, slow_threshold: Optional[float] = None, *,
+                 on_slow: Optional[Callable[[IRC, str, str, float],
+                                            Any]] = None,
+                 buckets: Iterable[float] = (0.001, 0.01, 0.1, 1, 10)
+                 ) -> None: ...
+    def report(self) -> list[dict[str, Any]]: ...
+    def reset(self) -> None: ...
+
+# A token bucket that limits how quickly messages are sent to the server
+class FloodControl:
+    immediate: frozenset[bytes]
+    bulk: frozenset[bytes]
+    burst: float
+    rate: float
+    max_queue: int
+    coalesce: bool
+    adaptive: bool
+    dropped: int
+
+    def __init__(self, burst: float = 5, rate: float = 0.5, *,
+                 max_queue: int = 1024, coalesce: bool = True,
+                 adaptive: bool = True) -> None: ...
+    def qsize(self) -> int: ...
+    def clear(self) -> None: ...
+
+# Writes debug messages from a background thread
+class DebugLog:
+    categories: frozenset[str]
+    dropped: int
+
+    def __init__(self, output: Union[None, IO[str], Callable[[str], Any],
+                                     logging.Logger] = None, *,
+                 categories: Iterable[str] = ('in', 'out', 'state'),
+                 max_records: int = 4096) -> None: ...
+    def flush(self) -> None: ...
+
+# Decides how long to wait before reconnecting
+class ReconnectPolicy:
+    base: float
+    factor: float
+    max_delay: float
+    first_delay: float
+    jitter: bool
+    max_attempts: Optional[int]
+    on_reconnect: Optional[Callable[[IRC, int, float], Any]]
+
+    def __init__(self, base: float = 1, *, factor: float = 2,
+                 max_delay: float = 300, first_delay: float = 0,
+                 jitter: bool = True, max_attempts: Optional[int] = None,
+                 on_reconnect: Optional[Callable[[IRC, int, float],
+                                                 Any]] = None) -> None: ...
+    def delay(self, attempt: int) -> float: ...
+
+# Caches DNS lookups
+class Resolver:
+    ttl: float
+
+    def __init__(self, ttl: float = 300) -> None: ...
+    def resolve(self, host: str, port: int) -> list[tuple[Any, ...]]: ...
+    def invalidate(self, host: str, port: int) -> None: ...
+    def clear(self) -> None: ...
+
+# Channel state tracking
+class UserState:
+    nick: str
+    ident: Optional[str]
+    host: Optional[str]
+    account: Optional[str]
+    channels: set[ChannelState]
+
+class ChannelState:
+    name: str
+    members: set[UserState]
+
+class StateTracker:
+    def __init__(self) -> None: ...
+    def get_user(self, nick: str) -> Optional[UserState]: ...
+    def get_channel(self, name: str) -> Optional[ChannelState]: ...
+    def members(self, channel: str) -> Optional[frozenset[UserState]]: ...
+    def user_channels(self, nick: str) -> frozenset[ChannelState]: ...
+    def is_member(self, channel: str, nick: str) -> bool: ...
+    def users(self) -> list[UserState]: ...
+    def channels(self) -> list[ChannelState]: ...
+    def clear(self) -> None: ...
+
+# Counters and a ping round-trip time histogram for one IRC object
+class Metrics:
+    bytes_received: int
+    bytes_sent: int
+    lines_received: int
+    lines_sent: int
+    ignored_lines: int
+    handler_calls: int
+    connects: int
+    reconnects: int
+    rtt_buckets: tuple[float, ...]
+    rtt_counts: list[int]
+    rtt_sum: float
+
+    def __init__(self, *, rtt_buckets: Iterable[float] = ...) -> None: ...
+
+def prometheus_metrics(ircs: Optional[Iterable[IRC]] = None) -> str: ...
+
+# A selector-based event loop that can drive many IRC objects from one thread
+class Reactor:
+    def __init__(self) -> None: ...
+    def register(self, sock: socket.socket,
+                 func: Callable[[], Any]) -> None: ...
+    def unregister(self, sock: socket.socket) -> None: ...
+    def call_later(self, delay: float, func: Callable[..., Any],
+                   *args: Any) -> list: ...
+    def cancel(self, timer: list) -> None: ...
+    def in_reactor_thread(self) -> bool: ...
+
+# Tags that can be sent with messages
+_OutgoingTags = Union[dict[str, Union[str, bool]], Tags]
+
 # Create the IRC class
 class IRC:
     connected: Optional[bool] = None
-    debug_file: Optional[Union[io.TextIOWrapper, _Logfile]] = ...
+    debug_file: Optional[Union[io.TextIOWrapper, _Logfile, DebugLog]] = ...
     msglen: int = 512
     _main_lock: Optional[threading.Thread] = None
     _sasl: bool = False
@@ -113,6 +328,17 @@ class IRC:
     quit_message: str
     ping_interval: int
     verify_ssl: bool
+    fallback_encodings: tuple[str, ...]
+    flood_control: Optional[FloodControl]
+    metrics: Optional[Metrics]
+    handler_profiler: Optional[HandlerProfiler]
+    reconnect_policy: Optional[ReconnectPolicy]
+    connect_timings: dict[str, float]
+    ssl_context: Optional[_SSLContext]
+    resolver: Optional[Resolver]
+    state_tracker: Optional[StateTracker]
+    server_address: Optional[tuple[Any, ...]]
+    connection_attempt_delay: float
 
     ns_identity: Union[tuple[str, str], str]
 
@@ -121,41 +347,102 @@ class IRC:
 
     # Send raw messages
     def quote(self, *msg: str, force: Optional[bool] = None,
-              tags: Optional[dict[str, Union[str, bool]]] = None) -> None: ...
+              tags: Optional[_OutgoingTags] = None) -> None: ...
 
     def send(self, *msg: str, force: Optional[bool] = None,
-             tags: Optional[dict[str, Union[str, bool]]] = None) -> None: ...
+             tags: Optional[_OutgoingTags] = None) -> None: ...
+
+    # Send multiple messages at once
+    def quote_many(self, messages: Iterable[Union[str, Iterable[Any]]], *,
+                   force: Optional[bool] = None,
+                   tags: Optional[_OutgoingTags] = None) -> None: ...
+
+    def quote_raw(self, data: Union[bytes, bytearray, memoryview], *,
+                  force: Optional[bool] = None) -> None: ...
+
+    def send_many(self, messages: Iterable[Iterable[str]], *,
+                  force: Optional[bool] = None,
+                  tags: Optional[_OutgoingTags] = None) -> None: ...
 
     # User-friendly msg, notice, and ctcp functions.
     def msg(self, target: str, *msg: str,
-            tags: Optional[dict[str, Union[str, bool]]] = None) -> None: ...
+            tags: Optional[_OutgoingTags] = None,
+            split: bool = False) -> None: ...
 
     def notice(self, target: str, *msg: str,
-               tags: Optional[dict[str, Union[str, bool]]] = None) -> None: ...
+               tags: Optional[_OutgoingTags] = None,
+               split: bool = False) -> None: ...
+
+    def msg_many(self, targets: Iterable[str], *msg: str,
+                 tags: Optional[_OutgoingTags] = None) -> None: ...
+
+    def notice_many(self, targets: Iterable[str], *msg: str,
+                    tags: Optional[_OutgoingTags] = None) -> None: ...
+
+    # Join or part multiple channels
+    def join(self, channels: Union[Iterable[str], str],
+             keys: Optional[dict[str, str]] = None) -> None: ...
+
+    def part(self, channels: Union[Iterable[str], str],
+             msg: Optional[str] = None) -> None: ...
 
     def ctcp(self, target: str, *msg: str, reply: bool = False,
-             tags: Optional[dict[str, Union[str, bool]]] = None) -> None: ...
+             tags: Optional[_OutgoingTags] = None,
+             split: bool = False) -> None: ...
 
     def me(self, target: str, *msg: str,
-           tags: Optional[dict[str, Union[str, bool]]] = None) -> None: ...
+           tags: Optional[_OutgoingTags] = None,
+           split: bool = False) -> None: ...
 
     # Allow per-connection handlers
     @overload
-    def Handler(*events: str, colon: bool, ircv3: Literal[False] = False) \
+    def Handler(*events: str, colon: bool, ircv3: Literal[False] = False,
+                message: Literal[False] = False,
+                target: _Filter = None, sender: _Filter = None,
+                prefix: _Filter = None,
+                pattern: Optional[Union[str, re.Pattern[str]]] = None) \
         -> Callable[[_handler_func_1], _handler_func_1]: ...
 
     @overload
-    def Handler(*events: str, colon: bool, ircv3: Literal[True]) \
+    def Handler(*events: str, colon: bool, ircv3: Literal[True],
+                message: Literal[False] = False,
+                target: _Filter = None, sender: _Filter = None,
+                prefix: _Filter = None,
+                pattern: Optional[Union[str, re.Pattern[str]]] = None) \
         -> Callable[[_handler_func_2], _handler_func_2]: ...
 
     @overload
-    def CmdHandler(*events: str, colon: bool, ircv3: Literal[False] = False) \
+    def Handler(*events: str, colon: bool = True, ircv3: bool = False,
+                message: Literal[True],
+                target: _Filter = None, sender: _Filter = None,
+                prefix: _Filter = None,
+                pattern: Optional[Union[str, re.Pattern[str]]] = None) \
+        -> Callable[[_handler_func_5], _handler_func_5]: ...
+
+    @overload
+    def CmdHandler(*events: str, colon: bool, ircv3: Literal[False] = False,
+                   message: Literal[False] = False,
+                   target: _Filter = None, sender: _Filter = None,
+                   prefix: _Filter = None,
+                   pattern: Optional[Union[str, re.Pattern[str]]] = None) \
         -> Callable[[_handler_func_3], _handler_func_3]: ...
 
     @overload
-    def CmdHandler(*events: str, colon: bool, ircv3: Literal[True]) \
+    def CmdHandler(*events: str, colon: bool, ircv3: Literal[True],
+                   message: Literal[False] = False,
+                   target: _Filter = None, sender: _Filter = None,
+                   prefix: _Filter = None,
+                   pattern: Optional[Union[str, re.Pattern[str]]] = None) \
         -> Callable[[_handler_func_4], _handler_func_4]: ...
 
+    @overload
+    def CmdHandler(*events: str, colon: bool = True, ircv3: bool = False,
+                   message: Literal[True],
+                   target: _Filter = None, sender: _Filter = None,
+                   prefix: _Filter = None,
+                   pattern: Optional[Union[str, re.Pattern[str]]] = None) \
+        -> Callable[[_handler_func_5], _handler_func_5]: ...
+
     # The connect function
     def connect(self) -> None: ...
 
@@ -182,7 +469,9 @@ class IRC:
 
     # Launch handlers
     def _handle(self, cmd: str, hostmask: tuple[str, str, str],
-                tags: dict[str, Union[str, bool]], args: list[str]) -> bool: ...
+                tags: dict[str, Union[str, bool]], args: list[str], *,
+                raw: Optional[str] = None,
+                received: Optional[float] = None) -> bool: ...
 
     # Launch IRCv3 handlers
     def _handle_cap(self, cap: str) -> None: ...
@@ -190,6 +479,12 @@ class IRC:
     # The main loop
     def _main(self) -> None: ...
 
+    # Normalises a nickname or channel name with the server's casemapping
+    def casefold(self, name: str) -> str: ...
+
+    # Returns statistics for each handler if handler_profiler was set
+    def handler_stats(self) -> list[dict[str, Any]]: ...
+
     # Waits until the client is disconnected and won't auto reconnect
     def wait_until_disconnected(self) -> None: ...
 
@@ -199,11 +494,21 @@ class IRC:
         channels: Union[Iterable[str], str] = None, *,
         ssl: Optional[bool] = None, ident: Optional[str] = None,
         realname: Optional[str] = None, persist: bool = True,
-        debug: Union[bool, io.TextIOWrapper, _Logfile] = False,
+        debug: Union[bool, io.TextIOWrapper, _Logfile, DebugLog] = False,
         ns_identity: Optional[Union[tuple[str, str], str]] = None,
         auto_connect: bool = True, ircv3_caps: Optional[set[str]] = None,
         connect_modes: Optional[str] = None,
         quit_message: str = 'I grew sick and died.', ping_interval: int = 60,
         verify_ssl: bool = True, server_password: Optional[str] = None,
-        executor: Optional[concurrent.futures.ThreadPoolExecutor]
+        executor: Optional[Union[concurrent.futures.ThreadPoolExecutor,
+                                 HandlerPool]] = None,
+        reactor: Optional[Reactor] = None,
+        fallback_encodings: Iterable[str] = (),
+        flood_control: Optional[FloodControl] = None,
+        metrics: Optional[Metrics] = None,
+        handler_profiler: Optional[HandlerProfiler] = None,
+        reconnect_policy: Optional[ReconnectPolicy] = None,
+        ssl_context: Optional[_SSLContext] = None,
+        resolver: Optional[Resolver] = None,
+        state_tracker: Optional[StateTracker] = None
     ) -> None: ...
@@ -0,0 +1,274 @@
+#!/usr/bin/python3
+#
+# miniirc_asyncio - An asyncio version of miniirc.IRC.
+#
+# © 2026 by luk3yx and other contributors of miniirc.
+#
+# This requires Python 3.7 or later. Handlers are shared with miniirc, so
+# miniirc.Handler and miniirc.CmdHandler also apply to AsyncIRC objects.
+#
+
+import asyncio, miniirc, sys, time
+
+__all__ = ['AsyncIRC']
+
+
+# Waits for the write buffer to drain. Nothing happens if this isn't awaited,
+# so synchronous code (such as the built-in handlers) can ignore the return
+# value of irc.quote() and friends.
+class _Drain:
+    __slots__ = ('_irc',)
+
+    def __await__(self):
+        irc = self._irc
+        if irc._writer is None or not irc._in_loop():
+            return iter(())
+        return irc._writer.drain().__await__()
+
+    def __init__(self, irc):
+        self._irc = irc
+
+
+# Returned by "async for" on AsyncIRC objects
+class _EventIterator:
+    __slots__ = ('_irc', '_queue')
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self._queue.get()
+        if event is None:
+            try:
+                self._irc._event_queues.remove(self._queue)
+            except ValueError:
+                pass
+            raise StopAsyncIteration
+        return event
+
+    def __init__(self, irc):
+        self._irc = irc
+        self._queue = asyncio.Queue()
+        irc._event_queues.append(self._queue)
+
+
+# Create the AsyncIRC class
+class AsyncIRC(miniirc.IRC):
+    _connect_task = None
+    _loop = None
+    _main_task = None
+    _writer = None
+
+    def __init__(self, *args, loop=None, **kwargs):
+        self._loop = loop
+        self._event_queues = []
+        super().__init__(*args, **kwargs)
+
+    # Check if the current thread is running this object's event loop
+    def _in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    # Run func(*args) in the event loop from any thread
+    def _call_soon(self, func, *args):
+        if self._in_loop():
+            func(*args)
+        else:
+            self._loop.call_soon_threadsafe(func, *args)
+
+    # Run a coroutine in the event loop from any thread
+    def _create_task(self, coro):
+        if self._in_loop():
+            return self._loop.create_task(coro)
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    # These return awaitables that wait for the data to be written.
+    def quote(self, *msg, force=None, tags=None):
+        super().quote(*msg, force=force, tags=tags)
+        return _Drain(self)
+
+    def quote_many(self, messages, *, force=None, tags=None):
+        super().quote_many(messages, force=force, tags=tags)
+        return _Drain(self)
+
+    def quote_raw(self, data, *, force=None):
+        super().quote_raw(data, force=force)
+        return _Drain(self)
+
+    def _write(self, msg, force):
+        writer = self._writer
+        if writer is None:
+            if force:
+                raise BrokenPipeError
+            return
+        if self.metrics is not None:
+            self.metrics.bytes_sent += len(msg)
+            self.metrics.lines_sent += msg.count(b'\n')
+        self._call_soon(self._write_now, writer, msg)
+
+    @staticmethod
+    def _write_now(writer, msg):
+        if not writer.transport.is_closing():
+            writer.write(msg)
+
+    # Coroutine handlers are run as tasks, other handlers (except for the
+    # built-in ones) are run in the executor or handler pool.
+    def _get_runner(self, handler):
+        if asyncio.iscoroutinefunction(handler):
+            return self._run_coroutine
+        return super()._get_runner(handler)
+
+    def _run_coroutine(self, handler, params):
+        self._create_task(handler(*params))
+
+    def _handle(self, cmd, hostmask, tags, args, **kwargs):
+        if self._event_queues:
+            # Handlers with colon=True still need the original arguments
+            stripped = args
+            if args and args[-1].startswith(':'):
+                stripped = args[:-1] + [args[-1][1:]]
+            event = (str(cmd).upper(), tuple(hostmask),
+                     miniirc._copy_tags(tags), stripped)
+            for queue in self._event_queues:
+                self._call_soon(queue.put_nowait, event)
+        return super()._handle(cmd, hostmask, tags, args, **kwargs)
+
+    # Iterate over incoming messages with "async for". Iteration stops once
+    # the client is disconnected and won't reconnect.
+    def __aiter__(self):
+        return _EventIterator(self)
+
+    # Returns an awaitable when called. The event loop only keeps a weak
+    # reference to tasks, so the task is stored here in case the return value
+    # is discarded (like it is when auto_connect is used).
+    def connect(self):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        task = self._connect_task = self._create_task(self._connect())
+        return task
+
+    async def _connect(self):
+        with self._send_lock:
+            if self.connected is not None:
+                self.debug('Already connected!')
+                return
+            self.connected = False
+
+        self.debug('Connecting to', self.ip, 'port', self.port)
+        timings = self.connect_timings = {}
+        start = time.monotonic()
+        ctx = None
+        if self.ssl:
+            self.debug('SSL handshake')
+            ctx = self._get_ssl_context()
+        kwargs = {}
+        if sys.version_info >= (3, 8):
+            kwargs['happy_eyeballs_delay'] = self.connection_attempt_delay
+        try:
+            reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(
+                    self.ip, self.port, ssl=ctx,
+                    server_hostname=self.ip if ctx else None, **kwargs
+                ),
+                self.ping_timeout or self.ping_interval,
+            )
+        except (OSError, asyncio.TimeoutError):
+            self.connected = None
+            raise
+
+        # asyncio resolves the address, connects and does the TLS handshake
+        # in one step.
+        timings['connect'] = time.monotonic() - start
+        self._registration_start = time.monotonic()
+        if self.metrics is not None:
+            self.metrics.connects += 1
+
+        self._login()
+        self.debug('Starting main loop...')
+        self._sasl = self._pinged = self._keepnick_active = False
+        self._main_task = self._loop.create_task(self._main(reader))
+
+    def disconnect(self, msg=None, *, auto_reconnect=False):
+        super().disconnect(msg, auto_reconnect=auto_reconnect)
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            self._call_soon(writer.close)
+
+    # The main loop
+    async def _main(self, reader):
+        self.debug('Main loop running!')
+        buffer = miniirc._RecvBuffer()
+        while True:
+            try:
+                try:
+                    raw = await asyncio.wait_for(
+                        reader.read(8192),
+
+                        # self.ping_interval should be used when
+                        # self.ping_timeout is None
+                        self._pinged and self.ping_timeout or
+                        self.ping_interval
+                    )
+                except asyncio.TimeoutError:
+                    # Handle ping timeouts
+                    if self._pinged:
+                        raise TimeoutError
+                    self._send_ping()
+                else:
+                    if not raw:
+                        raise ConnectionAbortedError
+                    buffer.feed(raw)
+                    if self.metrics is not None:
+                        self.metrics.bytes_received += len(raw)
+
+                self._check_keepnick()
+            # This also catches the ConnectionAbortedError raised by
+            # buffer.feed() if a line is too long.
+            except OSError as e:
+                self.debug('Lost connection!', repr(e))
+                self.disconnect(auto_reconnect=True)
+                while True:
+                    delay = self._next_reconnect()
+                    if delay is None:
+                        break
+                    await asyncio.sleep(delay)
+                    if not self.persist:
+                        break
+                    self.debug('Reconnecting...')
+                    if self.metrics is not None:
+                        self.metrics.reconnects += 1
+                    try:
+                        await self._connect()
+                    except (OSError, asyncio.TimeoutError):
+                        self.debug('Failed to reconnect!')
+                        self.connected = None
+                    else:
+                        self.connect_timings['backoff'] = delay
+                        return
+
+                # Stop any "async for" loops
+                for queue in self._event_queues:
+                    queue.put_nowait(None)
+                return
+
+            self._handle_lines(buffer)
+
+    async def wait_until_disconnected(self):
+        while True:
+            # The main task is replaced on reconnects
+            task = self._main_task
+            if task is not None and not task.done():
+                await asyncio.wait((task,))
+
+            # The STS handler sets _main_thread while reconnecting
+            elif self._main_thread and self._main_thread.is_alive():
+                await self._loop.run_in_executor(None, self._main_thread.join)
+            else:
+                return
+
+    # The main loop is started by connect() and runs in the event loop, so
+    # this does nothing instead of starting a thread.
+    def main(self):
+        pass
@@ -0,0 +1,497 @@
+#!/usr/bin/python3
+#
+# miniirc_testserver - A fake IRC server for tests and benchmarks.
+#
+# © 2026 by luk3yx and other contributors of miniirc.
+#
+# This isn't a real IRC server, it only implements enough of the protocol for
+# IRC clients to connect (registration, CAP, SASL PLAIN, PING, ISUPPORT,
+# JOIN/NAMES/PART and relaying messages) and runs in a background thread so
+# that tests and benchmarks don't need network access. Latency, partial
+# writes, slow reading and disconnects can be injected.
+#
+
+import base64, collections, miniirc, socket, threading, time, weakref
+
+__all__ = ['LoadReport', 'TestServer', 'measure_load', 'measure_reconnect']
+
+_default_caps = ('account-tag', 'cap-notify', 'message-tags', 'sasl',
+                 'server-time')
+_default_isupport = collections.OrderedDict((
+    ('CASEMAPPING', 'ascii'), ('CHANTYPES', '#'), ('NETWORK', 'TestNet'),
+    ('PREFIX', '(ov)@+'), ('TARGMAX', 'JOIN:,PART:,PRIVMSG:4,NOTICE:4'),
+))
+
+
+# A client connected to a TestServer
+class ServerClient:
+    def __init__(self, server, sock, address):
+        self.server = server
+        self.sock = sock
+        self.address = address
+        self.nick = self.user = self.account = None
+        self.caps = set()
+        self.channels = set()
+        self.received = []
+        self.registered = threading.Event()
+        self.closed = threading.Event()
+        self.connected_at = time.monotonic()
+        self.registered_at = None
+        self._negotiating = False
+        self._write_lock = threading.Lock()
+
+    @property
+    def hostmask(self):
+        return '{}!{}@127.0.0.1'.format(self.nick, self.user or self.nick)
+
+    # Send lines (without line endings) to the client
+    def send(self, *lines):
+        self.send_raw(''.join(line + '\r\n' for line in lines)
+                      .encode('utf-8'))
+
+    # Send encoded data to the client, with the server's latency and write
+    # size applied.
+    def send_raw(self, data):
+        server = self.server
+        with self._write_lock:
+            if server.latency:
+                time.sleep(server.latency)
+            try:
+                size = server.write_size or len(data)
+                for i in range(0, len(data), size):
+                    self.sock.sendall(data[i:i + size])
+            except OSError:
+                self.close()
+
+    # Send a numeric reply
+    def numeric(self, numeric, *args):
+        self.send(':{} {} {} {}'.format(self.server.name, numeric,
+                                        self.nick or '*', ' '.join(args)))
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.server._remove(self)
+
+    def _run(self):
+        server = self.server
+        try:
+            if server.ssl_context is not None:
+                self.sock = server.ssl_context.wrap_socket(self.sock,
+                                                           server_side=True)
+            buf = b''
+            while True:
+                data = self.sock.recv(server.read_size)
+                if not data:
+                    break
+                buf += data
+                *lines, buf = buf.replace(b'\r', b'\n').split(b'\n')
+                for line in lines:
+                    if line:
+                        self._handle(line.decode('utf-8', 'replace'))
+                if server.read_delay:
+                    time.sleep(server.read_delay)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.close()
+
+    def _handle(self, line):
+        self.received.append(line)
+        cmd, _, _, args = miniirc.ircv3_message_parser(line)
+        if args and args[-1].startswith(':'):
+            args[-1] = args[-1][1:]
+        func = getattr(self, '_cmd_' + cmd.upper(), None)
+        if func is not None:
+            func(args)
+        elif self.registered.is_set():
+            self.numeric('421', cmd, ':Unknown command')
+
+    def _cmd_CAP(self, args):
+        subcmd = args[0].upper() if args else ''
+        if subcmd == 'LS':
+            self._negotiating = True
+            self.send(':{} CAP {} LS :{}'.format(
+                self.server.name, self.nick or '*',
+                ' '.join(sorted(self.server.caps))
+            ))
+        elif subcmd == 'REQ' and len(args) > 1:
+            caps = args[1].split()
+            reply = 'ACK' if self.server.caps.issuperset(caps) else 'NAK'
+            if reply == 'ACK':
+                self.caps.update(caps)
+            self.send(':{} CAP {} {} :{}'.format(
+                self.server.name, self.nick or '*', reply, args[1]
+            ))
+        elif subcmd == 'END':
+            self._negotiating = False
+            self._try_register()
+
+    def _cmd_AUTHENTICATE(self, args):
+        if not args or 'sasl' not in self.caps:
+            return
+        elif args[0] == '*':
+            self.numeric('906', ':SASL authentication aborted')
+        elif args[0].upper() == 'PLAIN':
+            self.send('AUTHENTICATE +')
+        else:
+            try:
+                _, account, password = (base64.b64decode(args[0])
+                                        .decode('utf-8').split('\x00'))
+            except ValueError:
+                account = password = None
+            accounts = self.server.accounts
+            if account is not None and (accounts is None or
+                                        accounts.get(account) == password):
+                self.account = account
+                self.numeric('900', self.hostmask, account,
+                             ':You are now logged in as ' + account)
+                self.numeric('903', ':SASL authentication successful')
+            else:
+                self.numeric('904', ':SASL authentication failed')
+
+    def _cmd_NICK(self, args):
+        if not args:
+            return
+        elif self.server._nick_in_use(args[0], self):
+            self.numeric('433', args[0], ':Nickname is already in use')
+        elif self.registered.is_set():
+            self.send(':{} NICK :{}'.format(self.hostmask, args[0]))
+            self.nick = args[0]
+        else:
+            self.nick = args[0]
+            self._try_register()
+
+    def _cmd_USER(self, args):
+        if args and not self.registered.is_set():
+            self.user = args[0]
+            self._try_register()
+
+    def _try_register(self):
+        if (self.registered.is_set() or self._negotiating or
+                self.nick is None or self.user is None):
+            return
+
+        server = self.server
+        self.numeric('001', ':Welcome to the TestNet IRC network',
+                     self.hostmask)
+        self.numeric('002', ':Your host is', server.name)
+        self.numeric('003', ':This server was created just now')
+        self.numeric('004', server.name, 'miniirc_testserver', 'i', 'ov')
+        tokens = ['{}={}'.format(key, value) if value is not True else key
+                  for key, value in server.isupport.items()]
+        for i in range(0, len(tokens), 13):
+            self.numeric('005', *tokens[i:i + 13] +
+                         [':are supported by this server'])
+        self.numeric('422', ':MOTD File is missing')
+        self.registered_at = time.monotonic()
+        server._registered(self)
+
+    def _cmd_PING(self, args):
+        self.send(':{0} PONG {0} :{1}'.format(self.server.name,
+                                              args[-1] if args else ''))
+
+    def _cmd_JOIN(self, args):
+        if not args or not self.registered.is_set():
+            return
+        for channel in args[0].split(','):
+            if not channel.startswith('#') or channel in self.channels:
+                continue
+            self.channels.add(channel)
+            members = self.server._members(channel)
+            self.server._relay(members, ':{} JOIN {}'.format(self.hostmask,
+                                                             channel))
+            nicks = ' '.join(client.nick for client in members)
+            self.numeric('353', '=', channel, ':' + nicks)
+            self.numeric('366', channel, ':End of /NAMES list.')
+
+    def _cmd_PART(self, args):
+        if not args:
+            return
+        for channel in args[0].split(','):
+            if channel in self.channels:
+                self.server._relay(self.server._members(channel),
+                                   ':{} PART {}'.format(self.hostmask,
+                                                        channel))
+                self.channels.discard(channel)
+
+    # PRIVMSG and NOTICE are relayed to other clients
+    def _cmd_PRIVMSG(self, args, cmd='PRIVMSG'):
+        if len(args) < 2 or not self.registered.is_set():
+            return
+        line = ':{} {} {} :{}'.format(self.hostmask, cmd, args[0], args[1])
+        for target in args[0].split(','):
+            if target.startswith('#'):
+                clients = [client for client in self.server._members(target)
+                           if client is not self]
+            else:
+                clients = [client for client in self.server.clients
+                           if client.nick == target]
+            self.server._relay(clients, line)
+
+    def _cmd_NOTICE(self, args):
+        self._cmd_PRIVMSG(args, 'NOTICE')
+
+    def _cmd_PONG(self, args):
+        pass
+
+    def _cmd_QUIT(self, args):
+        self.send('ERROR :Closing link')
+        self.close()
+
+
+# The fake IRC server. The server starts listening when it is created and
+# should be closed with close() (or by using it as a context manager).
+#   latency:    Seconds to wait before every write to a client.
+#   write_size: Send data to clients in chunks of at most this many bytes.
+#   read_size:  The maximum number of bytes read from a client at once.
+#   read_delay: Seconds to wait after every read, to emulate a slow server.
+#   accounts:   A dict of SASL account names and passwords, None accepts any.
+class TestServer:
+    def __init__(self, host='127.0.0.1', port=0, *, name='irc.example.com',
+                 caps=_default_caps, isupport=None, accounts=None,
+                 ssl_context=None, latency=0, write_size=None,
+                 read_size=65536, read_delay=0):
+        self.name = name
+        self.caps = frozenset(caps)
+        self.isupport = collections.OrderedDict(_default_isupport)
+        self.isupport.update(isupport or ())
+        self.accounts = accounts
+        self.ssl_context = ssl_context
+        self.latency = latency
+        self.write_size = write_size
+        self.read_size = read_size
+        self.read_delay = read_delay
+        self.clients = []
+        self.registrations = 0
+        self._cond = threading.Condition()
+
+        self._sock = socket.socket()
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((host, port))
+        self._sock.listen(128)
+        self.host, self.port = self._sock.getsockname()[:2]
+        self._thread = threading.Thread(target=self._accept, daemon=True,
+                                        name='miniirc-testserver')
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self._sock.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = ServerClient(self, sock, address)
+            with self._cond:
+                self.clients.append(client)
+            threading.Thread(target=client._run, daemon=True,
+                             name='miniirc-testserver-client').start()
+
+    def _registered(self, client):
+        with self._cond:
+            self.registrations += 1
+            client.registered.set()
+            self._cond.notify_all()
+
+    def _remove(self, client):
+        with self._cond:
+            try:
+                self.clients.remove(client)
+            except ValueError:
+                pass
+            self._cond.notify_all()
+
+    def _nick_in_use(self, nick, client):
+        nick = nick.lower()
+        return any(other is not client and other.nick is not None and
+                   other.nick.lower() == nick for other in self.clients)
+
+    def _members(self, channel):
+        return [client for client in self.clients
+                if channel in client.channels]
+
+    def _relay(self, clients, line):
+        data = (line + '\r\n').encode('utf-8')
+        for client in clients:
+            client.send_raw(data)
+
+    # Returns the registered clients
+    def registered_clients(self):
+        with self._cond:
+            return [client for client in self.clients
+                    if client.registered.is_set()]
+
+    # Wait until there are at least "count" registered clients (or until
+    # "registrations" is at least min_registrations). Raises TimeoutError
+    # if this doesn't happen within timeout seconds.
+    def wait_for_clients(self, count, *, min_registrations=0, timeout=10):
+        def ready():
+            return (len(self.registered_clients()) >= count and
+                    self.registrations >= min_registrations)
+        with self._cond:
+            if not self._cond.wait_for(ready, timeout):
+                raise TimeoutError('Timed out waiting for clients')
+
+    # Send lines to every registered client
+    def broadcast(self, *lines):
+        self._relay(self.registered_clients(), '\r\n'.join(lines))
+
+    # Send lines to every registered client "repeat" times, at most "rate"
+    # lines per second (per client) if rate isn't None. Lines are sent in
+    # batches of up to batch_size lines.
+    def replay(self, lines, *, rate=None, repeat=1, batch_size=100):
+        lines = list(lines) * repeat
+        if rate is not None:
+            batch_size = max(min(batch_size, int(rate / 100)), 1)
+        start = time.monotonic()
+        for i in range(0, len(lines), batch_size):
+            if rate is not None:
+                delay = start + i / rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self.broadcast(*lines[i:i + batch_size])
+        return len(lines)
+
+    # Disconnect every client without sending an ERROR
+    def disconnect_all(self):
+        for client in list(self.clients):
+            client.close()
+
+    def close(self):
+        try:
+            self._sock.close()
+        except OSError:
+            pass
+        self.disconnect_all()
+
+    # Create a miniirc.IRC object that connects to this server
+    def connect_irc(self, nick, irc_class=miniirc.IRC, **kwargs):
+        kwargs.setdefault('persist', False)
+        if self.ssl_context is not None:
+            kwargs.setdefault('ssl', True)
+            kwargs.setdefault('verify_ssl', False)
+        else:
+            kwargs.setdefault('ssl', False)
+        return irc_class(self.host, self.port, nick, **kwargs)
+
+
+# The results of measure_load()
+LoadReport = collections.namedtuple('LoadReport', (
+    'clients', 'sent', 'received', 'seconds', 'throughput', 'latency_mean',
+    'latency_p50', 'latency_p99', 'latency_max',
+))
+
+
+# Records when load test messages are received
+class _LoadRecorder:
+    __slots__ = ('count', 'done', 'expected', 'latencies', 'lock', 'prefix')
+
+    def __init__(self, prefix, expected):
+        self.prefix = prefix
+        self.expected = expected
+        self.count = 0
+        self.latencies = []
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def _handler(self, irc, hostmask, args):
+        text = args[-1]
+        if not text.startswith(self.prefix):
+            return
+        latency = time.perf_counter() - float(text.rsplit(' ', 1)[-1])
+        with self.lock:
+            self.count += 1
+            self.latencies.append(latency)
+            if self.count >= self.expected:
+                self.done.set()
+
+
+# IRC objects that have the load test handler, it is only added once.
+_load_recorders = weakref.WeakKeyDictionary()
+
+
+def _load_handler(irc, hostmask, args):
+    recorder = _load_recorders.get(irc)
+    if recorder is not None and args:
+        recorder._handler(irc, hostmask, args)
+
+
+# Send "lines" PRIVMSGs to every client connected to the server (at most
+# "rate" lines per second per client if rate isn't None) and measure how
+# quickly the IRC objects in "ircs" handle them. The latency is the time
+# between the server sending each message and a handler receiving it.
+def measure_load(server, ircs, lines=1000, *, rate=None, timeout=60,
+                 batch_size=100):
+    ircs = list(ircs)
+    server.wait_for_clients(len(ircs), timeout=timeout)
+    prefix = 'load-{} '.format(time.perf_counter())
+    recorder = _LoadRecorder(prefix, lines * len(ircs))
+    for irc in ircs:
+        if irc not in _load_recorders:
+            irc.Handler('PRIVMSG', colon=False)(_load_handler)
+        _load_recorders[irc] = recorder
+
+    if rate is not None:
+        batch_size = max(min(batch_size, int(rate / 100)), 1)
+    clients = server.registered_clients()
+    start = time.perf_counter()
+    try:
+        for i in range(0, lines, batch_size):
+            if rate is not None:
+                delay = start + i / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            now = time.perf_counter()
+            data = ''.join(
+                ':load!load@load PRIVMSG * :{}{} {}\r\n'.format(prefix, j, now)
+                for j in range(i, min(i + batch_size, lines))
+            ).encode('utf-8')
+            for client in clients:
+                client.send_raw(data)
+
+        recorder.done.wait(timeout)
+        seconds = time.perf_counter() - start
+    finally:
+        for irc in ircs:
+            if _load_recorders.get(irc) is recorder:
+                _load_recorders[irc] = None
+
+    with recorder.lock:
+        latencies = sorted(recorder.latencies)
+    if not latencies:
+        latencies = [float('nan')]
+    return LoadReport(
+        clients=len(ircs), sent=lines * len(ircs), received=recorder.count,
+        seconds=seconds, throughput=recorder.count / seconds,
+        latency_mean=sum(latencies) / len(latencies),
+        latency_p50=latencies[len(latencies) // 2],
+        latency_p99=latencies[min(len(latencies) * 99 // 100,
+                                  len(latencies) - 1)],
+        latency_max=latencies[-1],
+    )
+
+
+# Disconnect every client and return a sorted list of how long (in seconds)
+# it took for "count" clients to register again.
+def measure_reconnect(server, count, *, timeout=60):
+    server.wait_for_clients(count, timeout=timeout)
+    registrations = server.registrations
+    start = time.monotonic()
+    server.disconnect_all()
+    server.wait_for_clients(count, min_registrations=registrations + count,
+                            timeout=timeout)
+    return sorted(client.registered_at - start
+                  for client in server.registered_clients())
@@ -8,7 +8,7 @@ with open('README.md', 'r') as f:
 setup(
     name='miniirc',
     version='1.10.0',
-    py_modules=['miniirc'],
+    py_modules=['miniirc', 'miniirc_asyncio', 'miniirc_testserver'],
     author='luk3yx',
     description='A lightweight IRC framework.',
     url='https://github.com/luk3yx/miniirc',
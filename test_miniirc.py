@@ -1,6 +1,6 @@
 #!/bin/false
-import collections, functools, miniirc, pathlib, pytest, queue, random, re, \
-       select, socket, threading, time
+import collections, functools, gc, json, miniirc, os, pathlib, pytest, \
+       queue, random, re, selectors, socket, threading, time, weakref
 
 MINIIRC_V2 = miniirc.ver >= (2, 0, 0)
 if MINIIRC_V2:
@@ -42,6 +42,61 @@ def test_message_parser():
             ('Hi', hostmask, {'tag1': 'value; with \\spaces\rand\nnewlines',
                               'tag2': True, 'tag3': True}, []))
 
+    # Edge cases
+    hostmask = fill_in_hostmask('CMD', ())
+    assert p('CMD a b :c d  e :f') == ('CMD', hostmask, {},
+                                        ['a', 'b', ':c d  e :f'])
+    assert p('CMD :') == ('CMD', hostmask, {}, [':'])
+    assert p('CMD a:b') == ('CMD', hostmask, {}, ['a:b'])
+    assert p(':n@h CMD a')[1] == ('n@h', 'n', 'h')
+    assert (p(r'@a=\;b=c\;d=\\\x\ CMD')[2] ==
+            {'a': '', 'b': 'c', 'd': '\\x'})
+    for msg in ('CMD a  b', 'CMD ', '@a=b'):
+        with pytest.raises(ValueError):
+            p(msg)
+
+
+def test_lazy_tags():
+    # The public parser always returns a dict
+    tags = miniirc.ircv3_message_parser('@time=1 CMD')[2]
+    assert type(tags) is dict
+    tags['a'] = 'b'
+    assert tags == {'time': '1', 'a': 'b'}
+
+    tags = miniirc._lazy_message_parser(r'@time=1;msgid=a\sb;c CMD')[2]
+    assert not isinstance(tags, dict)
+    assert tags['msgid'] == 'a b' and tags.get('d', 1) == 1
+    assert 'c' in tags and 'd' not in tags
+    assert len(tags) == 3 and list(tags) == ['time', 'msgid', 'c']
+    assert dict(tags) == tags.copy() == {'time': '1', 'msgid': 'a b',
+                                         'c': True}
+    with pytest.raises(TypeError):
+        tags['a'] = 'b'
+
+    # Handlers should get a real dict that C code (such as json.dumps()) can
+    # read, and Message.tags should work with dict().
+    executor = RecordingExecutor()
+    irc = DummyIRC(executor=executor)
+
+    def f1(irc, hostmask, tags, args):
+        ...
+
+    def f2(irc, message):
+        ...
+
+    irc.Handler('PRIVMSG', colon=False, ircv3=True)(f1)
+    irc.Handler('PRIVMSG', message=True)(f2)
+    buffer = miniirc._RecvBuffer(512)
+    buffer.feed(b'@time=1;msgid=a\\sb :n!u@h PRIVMSG #c :Hi\r\n')
+    irc._handle_lines(buffer)
+    calls = dict(executor.calls)
+    tags = calls[f1][2]
+    assert type(tags) is dict
+    assert json.dumps(tags) == '{"time": "1", "msgid": "a b"}'
+    message = calls[f2][1]
+    assert dict(message.tags) == {'time': '1', 'msgid': 'a b'}
+    assert message.tags.get('msgid') == 'a b' and len(message.tags) == 2
+
 
 if MINIIRC_V2:
     def verify_handler(event, cmdhandler, colon, ircv3):
@@ -111,6 +166,80 @@ def test_dict_to_tags():
         ('abc', True), ('def', False), ('ghi', ''), ('jkl', 'test\r\n; ')
     ))
     assert dict_to_tags(tags_dict) == rb'@abc;jkl=test\r\n\:\s '
+    assert dict_to_tags({'a': ['unhashable']}) == b'@a '
+
+    # Equal keys and values that are encoded differently shouldn't share a
+    # cache entry
+    assert dict_to_tags({1: True}) == b'@1 '
+    assert dict_to_tags({True: True}) == b'@True '
+    assert dict_to_tags({'a': 1.0}) == dict_to_tags({'a': True}) == b'@a '
+
+    tags = miniirc.Tags(tags_dict)
+    assert tags == tags_dict and tags['jkl'] == 'test\r\n; '
+    assert dict_to_tags(tags) == rb'@abc;jkl=test\r\n\:\s '
+    with pytest.raises(TypeError):
+        tags['abc'] = False
+
+    irc = DummyIRC()
+    irc.sock = RecordingSocket()
+    irc.connected = True
+    irc.active_caps.add('message-tags')
+    irc.msg('#channel', 'Hello', tags=miniirc.Tags({'+a': 'b'}))
+    irc.quote(miniirc.Tags({'+a': 'c'}), 'TAGMSG #channel')
+    assert irc.sock.sent == [b'@+a=b PRIVMSG #channel :Hello\r\n',
+                             b'@+a=c TAGMSG #channel\r\n']
+
+
+def test_debug_log():
+    lines = []
+    log = miniirc.DebugLog(lines.append, categories=('out', 'state'))
+    irc = DummyIRC(debug=log)
+    irc.sock = RecordingSocket()
+    irc.connected = True
+    irc.debug('Connected!')
+    irc.quote('PRIVMSG', '#channel', ':Hello')
+    buffer = miniirc._RecvBuffer()
+    buffer.feed(b'NOTHING :a\r\n')
+    irc._handle_lines(buffer)
+    log.flush()
+    assert lines == ['Connected!', '>>> PRIVMSG #channel :Hello']
+
+    records = []
+
+    class Logger:
+        def isEnabledFor(self, level):
+            return level > 10
+
+        def log(self, level, msg, *args):
+            records.append((level, msg % args))
+
+    log = miniirc.DebugLog(Logger())
+    irc = DummyIRC(debug=log)
+    irc.debug('a', 'b')
+    irc.debug('<<<', 'PING :a')
+    log.flush()
+    assert records == [(20, 'a b')]
+
+    # Messages that haven't been written yet are flushed when Python exits
+    log = miniirc.DebugLog(lines.append)
+    log._records.append(('state', ('exiting',), {}))
+    miniirc._flush_debug_logs()
+    assert lines[-1] == 'exiting'
+
+    # Unused DebugLog objects should be freed and their threads should stop
+    log._log(('state', 'test'), {})
+    thread = log._thread
+    ref = weakref.ref(log)
+    del log
+    for _ in range(100):
+        gc.collect()
+        if ref() is None:
+            break
+        time.sleep(0.01)
+    assert ref() is None
+    thread.join(1)
+    assert not thread.is_alive()
+    assert lines[-1] == 'state test'
 
 
 def test_logfile():
@@ -164,6 +293,250 @@ def test_irc_send():
             ('\xa0 abc\xa0def\xa0\xa0 \u0703ghi ::jkl', {'a': 'b'}))
 
 
+class RecordingSocket:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(bytes(data))
+        return len(data)
+
+
+def test_quote_many():
+    irc = DummyIRC()
+    irc.sock = RecordingSocket()
+    irc.connected = True
+    irc.active_caps.add('message-tags')
+    irc.quote_many(['PING :a', ('PRIVMSG', '#c', ':b'),
+                    ({'a': 'b'}, 'TAGMSG', '#c')])
+    irc.send_many([('PRIVMSG', '#c', 'Hello world!'), ['QUIT']],
+                  tags={'c': 'd'})
+    assert irc.sock.sent == [
+        b'PING :a\r\nPRIVMSG #c :b\r\n@a=b TAGMSG #c\r\n',
+        b'@c=d PRIVMSG #c :Hello world!\r\n@c=d QUIT\r\n',
+    ]
+
+    # Messages should be queued if the IRC object isn't connected
+    irc.connected = False
+    irc.quote_many(['A', ('B', 'C')])
+    assert irc.sock.sent[2:] == []
+    assert irc.sendq == [('A',), ('B', 'C')]
+
+
+def test_quote_raw():
+    irc = DummyIRC()
+    irc.sock = RecordingSocket()
+    irc.connected = True
+    irc.quote_raw(b'PRIVMSG #a :1\r\n\r\nPRIVMSG #a :2\rQUIT\x00\n'
+                  b'@+a=b TAGMSG #a\nPRIVMSG #bc :' + '\xe9'.encode() * 300)
+    assert irc.sock.sent[0].split(b'\r\n')[:3] == [
+        b'PRIVMSG #a :1', b'PRIVMSG #a :2 QUIT\xef\xbf\xbd', b'TAGMSG #a'
+    ]
+    last_line = irc.sock.sent[0].split(b'\r\n')[3]
+    assert len(last_line) == 510 - 1
+    last_line.decode('utf-8')
+
+    irc.active_caps.add('message-tags')
+    irc.quote_raw(bytearray(b'@+a=b TAGMSG #a'))
+    assert irc.sock.sent[1] == b'@+a=b TAGMSG #a\r\n'
+
+    # Oversized and empty tags should be dropped, and so should lines that
+    # only have tags
+    irc.quote_raw(b'@+a=' + b'x' * 4090 + b' TAGMSG #a\n@ TAGMSG #b\n'
+                  b'@+a=b \n@+a=' + b'x' * 4089 + b' TAGMSG #c')
+    assert irc.sock.sent[2:] == [b'TAGMSG #a\r\nTAGMSG #b\r\n@+a=' +
+                                 b'x' * 4089 + b' TAGMSG #c\r\n']
+    del irc.sock.sent[2:]
+
+    # Messages should be queued if the IRC object isn't connected
+    irc.connected = False
+    irc.quote_raw(memoryview(b'PING :a'))
+    assert irc.sendq == [b'PING :a']
+    assert len(irc.sock.sent) == 2
+
+
+def test_split_messages():
+    irc = DummyIRC(nick='nick', ident='ident')
+    irc.sock = RecordingSocket()
+    irc.connected = True
+    irc._current_nick = 'nick'
+    irc._handle('JOIN', ('nick', 'ident', 'example.com'), {}, ['#channel'])
+    for _ in range(100):
+        if irc._userhost:
+            break
+        time.sleep(0.01)
+    assert irc._userhost == 'ident@example.com'
+
+    prefix = b':nick!ident@example.com '
+    text = ' '.join('word{}'.format(i) for i in range(200))
+    irc.msg('#channel', text, split=True)
+    irc.me('#channel', '\xe9' * 500, split=True)
+    assert len(irc.sock.sent) == 2
+    lines = irc.sock.sent[0].split(b'\r\n')[:-1]
+    assert len(lines) > 1
+    assert all(len(prefix + line) + 2 <= 512 for line in lines)
+    assert b' '.join(line[18:] for line in lines).decode('utf-8') == text
+
+    lines = irc.sock.sent[1].split(b'\r\n')[:-1]
+    assert all(len(prefix + line) + 2 <= 512 for line in lines)
+    assert all(line.startswith(b'PRIVMSG #channel :\x01ACTION \xc3') and
+               line.endswith(b'\xa9\x01') for line in lines)
+    assert sum(line.count('\xe9'.encode('utf-8')) for line in lines) == 500
+
+
+def test_msg_many():
+    irc = DummyIRC()
+    irc.sock = RecordingSocket()
+    irc.connected = True
+    targets = ['#channel{}'.format(i) for i in range(100)]
+
+    # Without TARGMAX or MAXTARGETS only one target should be used per line
+    irc.msg_many(targets[:3], 'Hello', 'world!')
+    assert irc.sock.sent.pop() == (b'PRIVMSG #channel0 :Hello world!\r\n'
+                                   b'PRIVMSG #channel1 :Hello world!\r\n'
+                                   b'PRIVMSG #channel2 :Hello world!\r\n')
+
+    irc.isupport['MAXTARGETS'] = 2
+    irc.notice_many(targets[:3], 'Hi')
+    assert irc.sock.sent.pop() == (b'NOTICE #channel0,#channel1 :Hi\r\n'
+                                   b'NOTICE #channel2 :Hi\r\n')
+
+    irc.isupport['TARGMAX'] = 'PRIVMSG:30,NOTICE:'
+    irc.msg_many(targets, 'Hi')
+    lines = irc.sock.sent.pop().split(b'\r\n')[:-1]
+    assert [len(line.split(b' ')[1].split(b',')) for line in lines] == [
+        30, 30, 30, 10
+    ]
+
+    # The number of targets for NOTICE is only limited by the line length
+    irc.notice_many(targets, 'Hi')
+    lines = irc.sock.sent.pop().split(b'\r\n')[:-1]
+    assert len(lines) == 3
+    assert all(len(line) <= 510 for line in lines)
+    assert b','.join(line.split(b' ')[1] for line in lines) == \
+        ','.join(targets).encode('utf-8')
+
+
+def test_join_part():
+    irc = DummyIRC()
+    irc.sock = RecordingSocket()
+    irc.connected = True
+    channels = ['#channel{}'.format(i) for i in range(300)]
+
+    irc.join(channels, keys={'#channel299': 'key1', '#channel0': 'key2'})
+    lines = irc.sock.sent.pop().split(b'\r\n')[:-1]
+    assert len(lines) > 1
+    assert all(len(line) <= 510 for line in lines)
+    assert lines[0].startswith(b'JOIN #channel0,#channel299,#channel1,')
+    assert lines[0].endswith(b' key2,key1')
+    joined = [line.split(b' ')[1].decode('utf-8') for line in lines]
+    assert sorted(','.join(joined).split(',')) == sorted(channels)
+
+    irc.isupport['TARGMAX'] = 'JOIN:2,PRIVMSG:4'
+    irc.join('#a,#b,#c')
+    irc.part(['#a', '#b', '#c'], 'Goodbye')
+    assert irc.sock.sent == [b'JOIN #a,#b\r\nJOIN #c\r\n',
+                             b'PART #a,#b,#c :Goodbye\r\n']
+
+
+def test_flood_control():
+    flood_control = miniirc.FloodControl(burst=2, rate=20)
+    irc = DummyIRC(flood_control=flood_control)
+    irc.sock = RecordingSocket()
+    irc.connected = True
+
+    # The first two messages should be sent immediately, and duplicate
+    # messages in the queue should be dropped.
+    irc.msg('#channel', '1')
+    irc.msg('#channel', '2')
+    irc.msg('#channel', '3')
+    irc.msg('#channel', '3')
+    irc.quote('MODE #channel +o nick')
+    irc.quote('PONG :x')
+    assert flood_control.qsize() == 2
+    assert flood_control.dropped == 1
+    assert b''.join(irc.sock.sent) == (b'PRIVMSG #channel :1\r\n'
+                                       b'PRIVMSG #channel :2\r\n'
+                                       b'PONG :x\r\n')
+
+    # MODE should be sent before the queued PRIVMSG
+    for i in range(100):
+        if flood_control.qsize() == 0:
+            break
+        time.sleep(0.01)
+    assert irc.sock.sent[3:] == [b'MODE #channel +o nick\r\n',
+                                 b'PRIVMSG #channel :3\r\n']
+
+
+def test_flood_control_edge_cases(monkeypatch):
+    flood_control = miniirc.FloodControl(burst=1, rate=0.01)
+    irc = DummyIRC(flood_control=flood_control)
+    irc.sock = RecordingSocket()
+    irc.connected = True
+
+    # FloodControl objects can't be shared
+    with pytest.raises(ValueError):
+        DummyIRC(flood_control=flood_control)
+    irc2 = DummyIRC()
+    irc2.flood_control = flood_control
+    irc2.connected = True
+    with pytest.raises(ValueError):
+        irc2.quote('PRIVMSG #channel :hi')
+
+    # Empty and tags-only lines should be queued like any other message
+    flood_control._submit(irc, [b'@a=b \r\n', b'\r\n', b'@a=b\r\n'])
+    assert irc.sock.sent == [b'@a=b \r\n']
+    assert flood_control.qsize() == 2
+    flood_control.clear()
+
+    # Flood disconnects should only slow miniirc down temporarily
+    now = 1000
+    monkeypatch.setattr(miniirc.time, 'monotonic', lambda: now)
+    for _ in range(6):
+        flood_control._excess_flood()
+    assert flood_control.rate == 0.01
+    assert flood_control._rate() == 0.01 / 16
+    now += 299
+    flood_control.clear()
+    assert flood_control._rate() == 0.01 / 16
+    for expected in (8, 4, 2, 1, 1):
+        now += 300
+        flood_control._submit(irc, [])
+        assert flood_control._rate() == 0.01 / expected
+
+
+def test_reconnect_policy(monkeypatch):
+    policy = miniirc.ReconnectPolicy(2, factor=3, max_delay=20,
+                                     first_delay=0.5, jitter=False)
+    assert [policy.delay(i) for i in range(5)] == [0.5, 2, 6, 18, 20]
+
+    policy.jitter = True
+    monkeypatch.setattr(miniirc.random, 'uniform', lambda a, b: (a, b))
+    assert policy.delay(2) == (0, 6)
+    policy.first_delay = 0
+    assert policy.delay(0) == 0
+
+    # The attempt number should only be reset after connecting
+    calls = []
+    irc = DummyIRC(reconnect_policy=miniirc.ReconnectPolicy(
+        1, jitter=False, max_attempts=3,
+        on_reconnect=lambda *args: calls.append(args)
+    ))
+    assert [irc._next_reconnect() for _ in range(4)] == [0, 1, 2, None]
+    assert calls == [(irc, 1, 0), (irc, 2, 1), (irc, 3, 2)]
+
+    irc._reconnect_attempts = 0
+    irc.reconnect_policy.on_reconnect = lambda *args: False
+    assert irc._next_reconnect() is None
+    irc.persist = False
+    irc.reconnect_policy.on_reconnect = None
+    assert irc._next_reconnect() is None
+
+    # The default policy waits 5 seconds every time
+    irc = DummyIRC()
+    assert [irc._next_reconnect() for _ in range(3)] == [5, 5, 5]
+
+
 irc_msg_funcs = {
     'msg': 'PRIVMSG {} :{}',
     'notice': 'NOTICE {} :{}',
@@ -201,6 +574,355 @@ def test_executor(monkeypatch):
     assert executor.submissions == 1
 
 
+class RecordingExecutor:
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, func, *args):
+        self.calls.append((func, args))
+
+
+def test_metrics():
+    metrics = miniirc.Metrics(rtt_buckets=(1, 0.1))
+    executor = RecordingExecutor()
+    irc = DummyIRC('irc.example.com', 6667, 'nick', metrics=metrics,
+                   executor=executor)
+    irc.sock = RecordingSocket()
+    irc.connected = True
+    irc.quote_many(['PRIVMSG #channel :1', 'PRIVMSG #channel :2'])
+    assert metrics.bytes_sent == 42
+    assert metrics.lines_sent == 2
+
+    irc.change_parser(lambda line: None if line == 'bad' else
+                      miniirc.ircv3_message_parser(line))
+    irc.Handler('NOTHING', colon=False)(lambda irc, hostmask, args: None)
+    buffer = miniirc._RecvBuffer()
+    buffer.feed(b'NOTHING\r\nbad\r\n\r\nNOTH')
+    irc._handle_lines(buffer)
+    assert metrics.lines_received == 2
+    assert metrics.ignored_lines == 1
+    assert metrics.handler_calls == 1
+
+    # Handle a PONG 0.5 seconds after sending a PING
+    irc.ping_interval = 60
+    irc._send_ping()
+    irc._ping_sent -= 0.5
+    irc._handle('PONG', ('server',) * 3, {}, ['server', 'miniirc-ping'])
+    for func, args in executor.calls:
+        func(*args)
+    assert metrics.rtt_counts == [0, 1, 0]
+    assert 0.5 <= metrics.rtt_sum < 1
+
+    irc.connected = None
+    irc.quote('PRIVMSG #channel :queued')
+    text = miniirc.prometheus_metrics([irc, DummyIRC()])
+    labels = 'server="irc.example.com",port="6667",nick="nick"'
+    assert text.endswith('\n')
+    lines = text.split('\n')
+    assert '# TYPE miniirc_lines_sent_total counter' in lines
+    assert 'miniirc_lines_sent_total{' + labels + '} 3' in lines
+    assert 'miniirc_sendq_length{' + labels + '} 1' in lines
+    assert 'miniirc_connected{' + labels + '} 0' in lines
+    assert ('miniirc_ping_rtt_seconds_bucket{' + labels + ',le="0.1"} 0'
+            in lines)
+    assert ('miniirc_ping_rtt_seconds_bucket{' + labels + ',le="1"} 1'
+            in lines)
+    assert ('miniirc_ping_rtt_seconds_bucket{' + labels + ',le="+Inf"} 1'
+            in lines)
+    assert 'miniirc_ping_rtt_seconds_count{' + labels + '} 1' in lines
+
+    # Every IRC object with metrics is included by default
+    assert labels in miniirc.prometheus_metrics()
+    assert miniirc._prometheus_label('a"b\\\n') == r'"a\"b\\\n"'
+
+
+def test_handler_profiler():
+    slow = []
+    profiler = miniirc.HandlerProfiler(0.05, buckets=(0.05, 0.01),
+                                       on_slow=lambda *args: slow.append(args))
+    executor = RecordingExecutor()
+    irc = DummyIRC(executor=executor, handler_profiler=profiler)
+
+    def fast_handler(irc, hostmask, args):
+        pass
+
+    def slow_handler(irc, hostmask, args):
+        time.sleep(0.06)
+        if args == ['error']:
+            raise ValueError
+
+    irc.Handler('TEST1', colon=False)(fast_handler)
+    irc.Handler('TEST1', 'TEST2', colon=False)(slow_handler)
+    irc._handle('TEST1', ('a', 'b', 'c'), {}, ['#channel', ':1'])
+    irc._handle('test2', ('a', 'b', 'c'), {}, ['error'])
+    assert len(executor.calls) == 3
+    for func, args in executor.calls:
+        assert func == profiler._call
+        try:
+            func(*args)
+        except ValueError:
+            pass
+
+    name = __name__ + '.test_handler_profiler.<locals>.slow_handler'
+    assert slow[0][:3] == (irc, name, 'TEST1')
+    assert slow[1][:3] == (irc, name, 'TEST2')
+    assert len(slow) == 2
+
+    stats = irc.handler_stats()
+    assert [(s['handler'].rsplit('.', 1)[-1], s['event'], s['calls'],
+             s['errors']) for s in stats][2:] == [
+        ('fast_handler', 'TEST1', 1, 0),
+    ]
+    assert {(s['event'], s['errors']) for s in stats[:2]} == {
+        ('TEST1', 0), ('TEST2', 1)
+    }
+    assert stats[0]['latency'] == {0.01: 0, 0.05: 0, float('inf'): 1}
+    assert stats[2]['latency'][0.01] == 1
+    assert stats[0]['max_time'] >= 0.06
+    assert stats[0]['mean_queue_time'] > 0
+
+    profiler.reset()
+    assert irc.handler_stats() == []
+    irc._handle('TEST1', ('a', 'b', 'c'), {}, ['#channel', ':1'])
+    executor.calls[-1][0](*executor.calls[-1][1])
+    assert [s['calls'] for s in irc.handler_stats()] == [1]
+    assert DummyIRC().handler_stats() == []
+
+
+def test_handler_profiler_queue_time(monkeypatch):
+    executor = RecordingExecutor()
+    irc = DummyIRC(executor=executor,
+                   handler_profiler=miniirc.HandlerProfiler())
+    irc.Handler('TEST', colon=False)(lambda irc, hostmask, args: None)
+
+    # Parsing and dispatching are part of the queueing delay
+    def parser(line):
+        nonlocal now
+        now += 1
+        return miniirc.ircv3_message_parser(line)
+
+    irc.change_parser(parser)
+    now = 10
+    monkeypatch.setattr(miniirc.time, 'perf_counter', lambda: now)
+    buffer = miniirc._RecvBuffer()
+    buffer.feed(b':a!b@c TEST\r\n')
+    irc._handle_lines(buffer)
+    assert irc._received_at is None
+    func, args = executor.calls[-1]
+    assert args[3] == 10
+    func(*args)
+    monkeypatch.undo()
+    stats, = irc.handler_stats()
+    assert stats['mean_queue_time'] == stats['max_queue_time'] == 1
+
+
+def test_dispatch_cache(monkeypatch):
+    monkeypatch.setattr(miniirc, '_colon_warning', False)
+    executor = RecordingExecutor()
+    irc = DummyIRC(executor=executor)
+    hostmask = ('n', 'u', 'h')
+    tags = {'a': 'b'}
+    args = ['#channel', ':Hello world!']
+
+    def f1(irc, hostmask, args):
+        ...
+
+    def f2(irc, command, hostmask, tags, args):
+        ...
+
+    irc.Handler('PRIVMSG', colon=False)(f1)
+    assert irc._handle('privmsg', hostmask, tags, args)
+    assert 'privmsg' in irc._dispatch
+    calls = [call for call in executor.calls if call[0] in (f1, f2)]
+    assert calls == [(f1, (irc, hostmask, ['#channel', 'Hello world!']))]
+
+    # Adding a handler should invalidate the cache
+    executor.calls.clear()
+    irc.CmdHandler('PRIVMSG', ircv3=True, colon=True)(f2)
+    irc._handle('privmsg', hostmask, tags, args)
+    calls = [call for call in executor.calls if call[0] in (f1, f2)]
+    assert calls == [
+        (f1, (irc, hostmask, ['#channel', 'Hello world!'])),
+        (f2, (irc, 'PRIVMSG', hostmask, tags, args)),
+    ]
+    assert calls[1][1][3] is not tags
+    assert calls[1][1][4] is not args
+    assert args == ['#channel', ':Hello world!']
+
+    # Commands without handlers should return False
+    assert not irc._handle('NOTHING', hostmask, {}, [])
+
+
+def test_wait_for_socket():
+    # This has to work with file descriptors that select.select() doesn't
+    # support
+    a, b = socket.socketpair()
+    try:
+        try:
+            fd = os.dup2(a.fileno(), 2000)
+        except OSError:
+            pytest.skip('Too many open files')
+        high = socket.socket(fileno=fd)
+        try:
+            assert miniirc._wait_for_socket(high, selectors.EVENT_WRITE, 1)
+            assert not miniirc._wait_for_socket(high, selectors.EVENT_READ,
+                                                0.01)
+            b.send(b'x')
+            assert miniirc._wait_for_socket(high, selectors.EVENT_READ, 1)
+        finally:
+            high.close()
+    finally:
+        a.close()
+        b.close()
+
+
+def test_recv_buffer():
+    lines = []
+    irc = DummyIRC(fallback_encodings=('latin-1',))
+    irc.change_parser(lines.append)
+    buffer = miniirc._RecvBuffer(16, 32)
+    for chunk in (b'PING :a\r', b'\nPI', b'NG :\xe9\xff\n\r\n', b'PING :\xc3'):
+        buffer.feed(chunk)
+        irc._handle_lines(buffer)
+    assert lines == ['PING :a', 'PING :\xe9\xff']
+
+    buffer.feed(b'\xa9\n')
+    irc._handle_lines(buffer)
+    assert lines[-1] == 'PING :\xe9'
+    assert buffer.end == 0
+
+    # The buffer should only grow when an incomplete line needs the space
+    assert len(buffer.data) == 16
+    buffer.feed(b'x' * 20)
+    assert len(buffer.data) == 32 and buffer.data[:20] == b'x' * 20
+    with pytest.raises(ConnectionAbortedError):
+        buffer.feed(b'x' * 12)
+
+    buffer = miniirc._RecvBuffer(16, 32)
+    assert len(buffer.space()) == 32
+    buffer.end = 31
+    with pytest.raises(ConnectionAbortedError):
+        buffer.feed(b'x')
+    buffer.end = 32
+    with pytest.raises(ConnectionAbortedError):
+        buffer.space()
+
+
+def test_message_handler():
+    executor = RecordingExecutor()
+    irc = DummyIRC(executor=executor)
+
+    def f1(irc, message):
+        ...
+
+    def f2(irc, message):
+        ...
+
+    irc.Handler('PRIVMSG', message=True)(f1)
+    irc.CmdHandler(message=True)(f2)
+    line = '@a=b :n!u@h PRIVMSG #channel :Hello world!'
+    irc._handle(*miniirc.ircv3_message_parser(line), raw=line, received=1.5)
+    calls = [call for call in executor.calls if call[0] in (f1, f2)]
+    assert [call[0] for call in calls] == [f1, f2]
+    message = calls[0][1][1]
+    assert calls[1][1] == (irc, message)
+
+    assert isinstance(message, miniirc.Message)
+    assert message.command == 'PRIVMSG'
+    assert message.hostmask == ('n', 'u', 'h')
+    assert message.tags == {'a': 'b'}
+    assert message.args == ('#channel', 'Hello world!')
+    assert message.raw == line
+    assert message.received == 1.5
+
+    with pytest.raises(AttributeError):
+        message.command = 'NOTICE'
+    with pytest.raises(TypeError):
+        message.tags['a'] = 'c'
+
+
+def test_handler_pool(monkeypatch):
+    for overflow in ('drop', 'thread', 'block'):
+        pool = miniirc.HandlerPool(2, max_queue=2, overflow=overflow)
+        release = threading.Event()
+        started = threading.Semaphore(0)
+        results = queue.Queue()
+
+        def f(i):
+            started.release()
+            assert release.wait(3)
+            results.put((i, threading.current_thread().name))
+
+        # Keep both workers busy and fill up the queue
+        for i in range(2):
+            pool.submit(f, i)
+        for i in range(2):
+            assert started.acquire(timeout=3)
+        pool.submit(f, 2)
+        pool.submit(f, 3)
+        assert pool.qsize() == 2
+
+        if overflow == 'block':
+            threading.Timer(0.05, release.set).start()
+        pool.submit(f, 4)
+        release.set()
+
+        expected = 4 if overflow == 'drop' else 5
+        res = dict(results.get(timeout=3) for _ in range(expected))
+        assert sorted(res) == list(range(expected))
+        assert pool.dropped == (1 if overflow == 'drop' else 0)
+        assert set(res[i] for i in range(4)) == {'miniirc-handler'}
+        if overflow == 'thread':
+            assert res[4] != 'miniirc-handler'
+
+    # The default handler pool should be created automatically
+    monkeypatch.setattr(miniirc, 'handler_pool', None)
+    monkeypatch.setattr(miniirc, '_colon_warning', False)
+    irc = DummyIRC()
+    irc.Handler('test')(lambda irc, hostmask, args:
+                        results.put(threading.current_thread().name))
+    irc._handle('TEST', ('a', 'b', 'c'), {}, [])
+    assert results.get(timeout=3) == 'miniirc-handler'
+    assert isinstance(miniirc.handler_pool, miniirc.HandlerPool)
+
+
+# A worker that times out while a handler is being submitted shouldn't exit
+# and leave the handler in the queue.
+def test_handler_pool_idle_race():
+    class SlowQueue(queue.Queue):
+        def put_nowait(self, item):
+            time.sleep(0.1)
+            super().put_nowait(item)
+
+    pool = miniirc.HandlerPool(1, idle_timeout=0.01)
+    pool._queue = SlowQueue()
+    ran = threading.Event()
+    pool.submit(ran.set)
+    assert ran.wait(3)
+
+
+# Built-in handlers shouldn't wait for user handlers in the handler pool
+def test_builtin_handlers(monkeypatch):
+    executor = RecordingExecutor()
+    irc = DummyIRC(executor=executor)
+    sent = []
+    irc.quote = lambda *msg, force=None, tags=None: sent.append(msg)
+    irc._handle('PING', ('server',) * 3, {}, [':123'])
+    assert sent == [('PONG', ':123')]
+    assert not [call for call in executor.calls
+                if call[0] in miniirc._builtin_handlers]
+
+    # STS upgrades should use their own thread
+    upgrades = []
+    monkeypatch.setattr(miniirc, '_sts_upgrade', lambda irc, port: (
+        upgrades.append((threading.current_thread(), port))
+    ))
+    irc._handle('IRCv3 sts', ('CAP', 'CAP', 'CAP'), {}, ['sts', 'port=6697'])
+    irc._main_thread.join(3)
+    assert upgrades == [(irc._main_thread, 6697)]
+    assert irc._main_thread is not threading.current_thread()
+
+
 def test_change_parser():
     irc = DummyIRC()
     assert irc._parse == miniirc.ircv3_message_parser
@@ -220,6 +942,28 @@ def test_get_ca_certs():
         assert miniirc.get_ca_certs() == certifi.where()
 
 
+def test_ssl_context_cache(monkeypatch):
+    ctx = DummyIRC()._get_ssl_context()
+    assert ctx.check_hostname
+    assert DummyIRC()._get_ssl_context() is ctx
+
+    with pytest.warns(UserWarning):
+        insecure = DummyIRC(verify_ssl=False)._get_ssl_context()
+    assert insecure is not ctx
+    assert not insecure.check_hostname
+
+    custom = object()
+    assert DummyIRC(ssl_context=custom)._get_ssl_context() is custom
+
+    # Sessions are only reused for the same server and context
+    irc = DummyIRC('irc.example.com', 6697)
+    irc._ssl_session = (('irc.example.com', 6697, ctx), 'session')
+    assert irc._get_ssl_session(ctx) == 'session'
+    assert irc._get_ssl_session(insecure) is None
+    irc.port = 6698
+    assert irc._get_ssl_session(ctx) is None
+
+
 def test_start_main_loop(monkeypatch):
     irc = DummyIRC()
     thread = None
@@ -258,6 +1002,235 @@ def test_nick_backwards_compatibility():
     assert irc.current_nick == irc.nick == 'test1'
 
 
+def test_handler_filters():
+    executor = RecordingExecutor()
+    irc = DummyIRC(executor=executor)
+
+    def make_handler(**kwargs):
+        func = irc.Handler('PRIVMSG', colon=False, **kwargs)(
+            lambda irc, hostmask, args: None
+        )
+        names[func] = ','.join(sorted(kwargs))
+        return func
+
+    names = {}
+    make_handler()
+    make_handler(target='#Chan[1]')
+    make_handler(target=('#other', '#chan{1}'), prefix=('!help', '!info'))
+    make_handler(sender='Nick[]')
+    make_handler(sender=['*!*@*.example.com', 'other'], pattern=r'^\d+$')
+
+    def calls(line):
+        executor.calls.clear()
+        irc._handle(*miniirc.ircv3_message_parser(line))
+        return sorted(names[func] for func, args in executor.calls
+                      if func in names)
+
+    assert calls(':nick{}!u@h PRIVMSG #CHAN{1} :!help') == [
+        '', 'prefix,target', 'sender', 'target'
+    ]
+    assert calls(':a!u@h.example.com PRIVMSG #chan[1] :123') == [
+        '', 'pattern,sender', 'target'
+    ]
+    assert calls(':a!u@example.com PRIVMSG #other :123') == ['']
+    assert calls(':other!u@h PRIVMSG #other :!info 123') == [
+        '', 'prefix,target'
+    ]
+    assert calls(':other!u@h PRIVMSG nick :123') == ['', 'pattern,sender']
+
+    # The index should be rebuilt if the casemapping changes
+    irc.isupport['CASEMAPPING'] = 'ascii'
+    irc._dispatch.clear()
+    assert calls(':nick{}!u@h PRIVMSG #CHAN{1} :!help') == [
+        '', 'prefix,target'
+    ]
+
+    # Filters should also work without a dispatch table
+    executor.calls.clear()
+    irc._start_handler(list(names), 'PRIVMSG', ('Nick[]', 'u', 'h'), {},
+                       ['#chan[1]', ':hi'])
+    assert sorted(names[func] for func, args in executor.calls) == [
+        '', 'sender', 'target'
+    ]
+
+
+def test_handler_filters_per_registration():
+    executor = RecordingExecutor()
+    irc = DummyIRC(executor=executor)
+    irc2 = DummyIRC(executor=executor)
+
+    def f(irc, hostmask, args):
+        ...
+
+    # The same function can be registered with different filters
+    irc.Handler('PRIVMSG', colon=False, target='#a')(f)
+    irc.Handler('NOTICE', colon=False, target='#b')(f)
+    irc2.Handler('PRIVMSG', colon=False, prefix='!')(f)
+    assert not hasattr(f, 'miniirc_filter')
+
+    def calls(irc, line):
+        executor.calls.clear()
+        irc._handle(*miniirc.ircv3_message_parser(line))
+        return [call for call in executor.calls if call[0] is f]
+
+    assert calls(irc, ':n!u@h PRIVMSG #a :hi')
+    assert not calls(irc, ':n!u@h PRIVMSG #b :hi')
+    assert calls(irc, ':n!u@h NOTICE #b :hi')
+    assert not calls(irc, ':n!u@h NOTICE #a :hi')
+    assert calls(irc2, ':n!u@h PRIVMSG #b :!hi')
+    assert not calls(irc2, ':n!u@h PRIVMSG #a :hi')
+
+    # Adding a function for the same event again replaces its filters
+    irc2.Handler('PRIVMSG', colon=False)(f)
+    assert calls(irc2, ':n!u@h PRIVMSG #a :hi')
+
+
+def test_casefold():
+    irc = DummyIRC()
+    assert irc.casefold('Nick[]\\~') == 'nick{}|^'
+    irc.isupport['CASEMAPPING'] = 'ascii'
+    assert irc.casefold('Nick[]\\~') == 'nick[]\\~'
+    irc.isupport['CASEMAPPING'] = 'strict-rfc1459'
+    assert irc.casefold('Nick[]\\~') == 'nick{}|~'
+
+
+def test_state_tracker():
+    tracker = miniirc.StateTracker()
+    irc = DummyIRC(executor=RecordingExecutor(), state_tracker=tracker)
+
+    def recv(line):
+        irc._handle(*miniirc.ircv3_message_parser(line))
+
+    recv(':server 001 Me[m] :Welcome')
+    recv(':server 005 Me[m] PREFIX=(qov)~@+ CASEMAPPING=ascii :are supported')
+    recv(':Me[m]!bot@host JOIN #Chan')
+    recv(':server 353 Me[m] = #chan :Me[m] ~@Alice @+Bob +carol!c@h')
+    recv(':me[m]!bot@host JOIN #other')
+
+    # Channels that miniirc isn't in should be ignored
+    recv(':dave!d@h JOIN #elsewhere')
+    assert tracker.get_channel('#elsewhere') is None
+    assert tracker.get_user('dave') is None
+
+    # Nicknames should be compared with the casemapping
+    assert tracker.get_user('me{m}') is None
+    assert {user.nick for user in tracker.members('#CHAN')} == {
+        'Me[m]', 'Alice', 'Bob', 'carol'
+    }
+    carol = tracker.get_user('CAROL')
+    assert (carol.ident, carol.host, carol.account) == ('c', 'h', None)
+    assert tracker.is_member('#chan', 'alice')
+    assert not tracker.is_member('#other', 'alice')
+
+    recv(':dave!d@h JOIN #other dave :Dave')
+    recv(':Alice!a@h NICK :Alice2')
+    recv(':carol!c@h ACCOUNT carol')
+    recv(':carol!c@h CHGHOST c2 h2')
+    recv(':Me[m]!bot@host KICK #chan bob :Bye')
+    assert tracker.get_user('dave').account == 'dave'
+    assert tracker.get_user('alice') is None
+    chan = tracker.get_channel('#chan')
+    assert tracker.get_user('alice2').channels == {chan}
+    assert (carol.account, carol.ident, carol.host) == ('carol', 'c2', 'h2')
+    assert tracker.get_user('bob') is None
+    assert {channel.name for channel in tracker.user_channels('me[m]')} == {
+        '#Chan', '#other'
+    }
+
+    # Leaving a channel should forget about users that aren't in any other
+    # channels
+    recv(':carol!c@h JOIN #other')
+    recv(':Me[m]!bot@host PART #chan')
+    assert tracker.get_channel('#chan') is None
+    assert tracker.get_user('alice2') is None
+    other = tracker.get_channel('#other')
+    assert tracker.get_user('carol').channels == {other}
+
+    recv(':dave!d@h QUIT :Quit')
+    assert tracker.get_user('dave') is None
+    assert {user.nick for user in tracker.users()} == {'Me[m]', 'carol'}
+
+    irc.disconnect()
+    assert tracker.users() == tracker.channels() == []
+
+
+class StubResolver:
+    def __init__(self, addrs=None):
+        self.addrs = addrs or [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                                ('127.0.0.1', 6667))]
+        self.invalidated = []
+
+    def resolve(self, host, port):
+        return self.addrs
+
+    def invalidate(self, host, port):
+        self.invalidated.append((host, port))
+
+
+def test_resolver(monkeypatch):
+    calls = []
+
+    def getaddrinfo(host, port, family, type):
+        calls.append((host, port))
+        return [(socket.AF_INET, type, 6, '', ('127.0.0.1', port))]
+
+    monkeypatch.setattr(socket, 'getaddrinfo', getaddrinfo)
+    resolver = miniirc.Resolver()
+    addrs = resolver.resolve('irc.example.com', 6697)
+    assert addrs == [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                      ('127.0.0.1', 6697))]
+    assert resolver.resolve('irc.example.com', 6697) is addrs
+    assert resolver.resolve('irc.example.com', 6667) is not addrs
+    assert calls == [('irc.example.com', 6697), ('irc.example.com', 6667)]
+
+    resolver.invalidate('irc.example.com', 6697)
+    resolver.resolve('irc.example.com', 6697)
+    assert len(calls) == 3
+
+    # Entries that have expired should be looked up again
+    resolver.ttl = 0
+    resolver.clear()
+    resolver.resolve('irc.example.com', 6697)
+    resolver.resolve('irc.example.com', 6697)
+    assert len(calls) == 5
+
+    assert miniirc._interleave_addrs([(6, 1), (6, 2), (6, 3), (4, 4),
+                                      (4, 5)]) == [
+        (6, 1), (4, 4), (6, 2), (4, 5), (6, 3)
+    ]
+
+
+def test_happy_eyeballs():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    closed = socket.socket()
+    closed.bind(('127.0.0.1', 0))
+    port, closed_port = listener.getsockname()[1], closed.getsockname()[1]
+    closed.close()
+    addr = (socket.AF_INET, socket.SOCK_STREAM, 6, '')
+    try:
+        # 192.0.2.1 is reserved for documentation and shouldn't be reachable
+        resolver = StubResolver([addr + (('192.0.2.1', port),),
+                                 addr + (('127.0.0.1', closed_port),),
+                                 addr + (('127.0.0.1', port),)])
+        irc = DummyIRC('irc.example.com', port, resolver=resolver)
+        irc.connection_attempt_delay = 0.05
+        start = time.monotonic()
+        sock = irc._create_connection(resolver.addrs)
+        sock.close()
+        assert time.monotonic() - start < 1
+        assert irc.server_address == ('127.0.0.1', port)
+
+        # The cached address should be removed if connecting fails
+        resolver.addrs = resolver.addrs[1:2]
+        with pytest.raises(ConnectionRefusedError):
+            irc.connect()
+        assert resolver.invalidated == [('irc.example.com', port)]
+    finally:
+        listener.close()
+
+
 def test_connection(monkeypatch):
     irc = err = None
 
@@ -341,15 +1314,17 @@ def test_connection(monkeypatch):
             return len(data)
 
         @catch_errors
-        def recv(self, chunk_size):
-            assert chunk_size == 8192
+        def recv_into(self, buffer, nbytes=0):
+            assert len(buffer) >= 512 and not nbytes
             if err is not None or self._recvq is None:
-                return b''
+                return 0
             else:
                 try:
-                    return self._recvq.get_nowait()
+                    data = self._recvq.get_nowait()
                 except queue.Empty:
                     raise BlockingIOError
+                buffer[:len(data)] = data
+                return len(data)
 
         def close(self):
             nonlocal err
@@ -367,28 +1342,27 @@ def test_connection(monkeypatch):
 
     monkeypatch.setattr(socket, 'socket', fakesocket)
 
-    def fake_select(read, write, err, timeout):
-        assert read == err or write == err
-        assert len(err) == 1
+    def fake_wait(sock, events, timeout):
+        assert isinstance(sock, fakesocket)
         assert timeout == 60
 
         # When waiting for writing just return immediately
-        if write:
-            assert not read
-            return read, write, err
+        if events == selectors.EVENT_WRITE:
+            return True
 
         # Otherwise wait for the next socket event
+        assert events == selectors.EVENT_READ
         socket_event.wait()
         socket_event.clear()
-        return read, write, err
+        return True
 
-    monkeypatch.setattr(select, 'select', fake_select)
+    monkeypatch.setattr(miniirc, '_wait_for_socket', fake_wait)
 
     try:
         event = threading.Event()
         irc = miniirc.IRC('example.com', 6667, 'miniirc-test',
                           auto_connect=False, ns_identity=('test', 'hunter2'),
-                          persist=False, debug=True)
+                          persist=False, debug=True, resolver=StubResolver())
         assert irc.connected is None
 
         @irc.Handler('001', colon=False)
@@ -418,3 +1392,68 @@ def test_connection(monkeypatch):
         irc.disconnect()
         socket_event.set()
         assert not irc.connected
+
+
+def test_reactor(monkeypatch):
+    monkeypatch.setattr(miniirc, '_colon_warning', False)
+    reactor = miniirc.Reactor()
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    port = server.getsockname()[1]
+
+    received = queue.Queue()
+    ircs = []
+    conns = []
+    try:
+        for i in range(3):
+            irc = miniirc.IRC('127.0.0.1', port, 'test{}'.format(i),
+                              auto_connect=False, persist=False,
+                              reactor=reactor)
+
+            @irc.Handler('PRIVMSG', colon=False)
+            def _handle_privmsg(irc, hostmask, args):
+                received.put((irc, hostmask, args))
+
+            irc.connect()
+            ircs.append(irc)
+            conns.append(server.accept()[0])
+
+        # Every connection should be handled by the reactor thread
+        assert all(irc._main_thread is None for irc in ircs)
+        assert reactor._thread.is_alive()
+
+        for i, conn in enumerate(conns):
+            conn.sendall(':server 001 test{0} :Welcome\r\n'
+                         ':n!u@h PRIVMSG test{0} :Hello {0}\n'.format(i)
+                         .encode('utf-8'))
+
+        results = {}
+        for _ in ircs:
+            irc, hostmask, args = received.get(timeout=3)
+            results[irc] = (hostmask, args)
+
+        for i, irc in enumerate(ircs):
+            # The 001 handler may still be running
+            for _ in range(300):
+                if irc.connected:
+                    break
+                time.sleep(0.01)
+            assert irc.connected
+            assert results[irc] == (('n', 'u', 'h'),
+                                    ['test{}'.format(i), 'Hello {}'.format(i)])
+    finally:
+        for irc in ircs:
+            irc.disconnect()
+        for conn in conns:
+            conn.close()
+        server.close()
+
+    for irc in ircs:
+        irc.wait_until_disconnected(_timeout=3)
+        assert irc.connected is None
+
+    thread = reactor._thread
+    if thread is not None:
+        thread.join(3)
+    assert reactor._thread is None
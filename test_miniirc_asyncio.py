@@ -0,0 +1,120 @@
+#!/bin/false
+import asyncio, json, miniirc, miniirc_asyncio
+
+
+async def _fake_server(lines, received):
+    async def handle(reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            line = line.decode('utf-8').rstrip('\r\n')
+            received.append(line)
+            if line.startswith('NICK '):
+                writer.write(b''.join(lines))
+            elif line.startswith('QUIT '):
+                break
+        writer.close()
+
+    return await asyncio.start_server(handle, '127.0.0.1', 0)
+
+
+def test_async_irc(monkeypatch):
+    monkeypatch.setattr(miniirc, '_colon_warning', False)
+    received = []
+
+    async def main():
+        server = await _fake_server([
+            b':server 001 miniirc-test :Welcome\r\n',
+            b'@msgid=1 :n!u@h PRIVMSG miniirc-test :Hello world!\r\n',
+            b':n!u@h PRIVMSG miniirc-test :second\n',
+        ], received)
+        port = server.sockets[0].getsockname()[1]
+
+        irc = miniirc_asyncio.AsyncIRC('127.0.0.1', port, 'miniirc-test',
+                                       auto_connect=False, persist=False)
+        handled = asyncio.Event()
+
+        @irc.Handler('PRIVMSG', colon=False, ircv3=True)
+        async def handler(irc, hostmask, tags, args):
+            if args[-1] == 'Hello world!':
+                assert tags == {'msgid': '1'}
+                await irc.msg(hostmask[0], 'reply')
+                handled.set()
+
+        await irc.connect()
+        events = []
+        async for cmd, hostmask, tags, args in irc:
+            events.append((cmd, hostmask, args))
+            if args == ['miniirc-test', 'Hello world!']:
+                assert type(tags) is dict
+                assert json.dumps(tags) == '{"msgid": "1"}'
+            if args == ['miniirc-test', 'second']:
+                break
+
+        await asyncio.wait_for(handled.wait(), 3)
+        assert irc.connected
+        assert ('PRIVMSG', ('n', 'u', 'h'),
+                ['miniirc-test', 'Hello world!']) in events
+
+        irc.disconnect()
+        await asyncio.wait_for(irc.wait_until_disconnected(), 3)
+        assert irc.connected is None
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(main())
+    assert received[:3] == ['CAP LS 302',
+                            'USER miniirc-test 0 * :miniirc-test',
+                            'NICK miniirc-test']
+    assert 'PRIVMSG n :reply' in received
+    assert received[-1] == 'QUIT :I grew sick and died.'
+
+
+def test_async_irc_colon(monkeypatch):
+    monkeypatch.setattr(miniirc, '_colon_warning', False)
+
+    async def main():
+        irc = miniirc_asyncio.AsyncIRC('127.0.0.1', 6667, 'miniirc-test',
+                                       auto_connect=False, persist=False)
+        irc._loop = asyncio.get_running_loop()
+        called = asyncio.Event()
+        handler_args = []
+
+        @irc.Handler('PRIVMSG', colon=True)
+        async def handler(irc, hostmask, args):
+            handler_args.append(args)
+            called.set()
+
+        # Only the event should have the colon removed
+        events = irc.__aiter__()
+        irc._handle('PRIVMSG', ('n', 'u', 'h'), {}, ['#chan', ':hello world'])
+        event = await asyncio.wait_for(events.__anext__(), 3)
+        assert event == ('PRIVMSG', ('n', 'u', 'h'), {},
+                         ['#chan', 'hello world'])
+        await asyncio.wait_for(called.wait(), 3)
+        assert handler_args == [['#chan', ':hello world']]
+
+    asyncio.run(main())
+
+
+def test_async_irc_long_line(monkeypatch):
+    monkeypatch.setattr(miniirc, '_colon_warning', False)
+
+    async def main():
+        server = await _fake_server([b'x' * 70000], [])
+        port = server.sockets[0].getsockname()[1]
+
+        # The connect task shouldn't be garbage collected with auto_connect
+        irc = miniirc_asyncio.AsyncIRC('127.0.0.1', port, 'miniirc-test',
+                                       persist=False)
+        await irc._connect_task
+        irc.main()
+
+        # Lines that don't fit in the receive buffer should disconnect
+        await asyncio.wait_for(irc.wait_until_disconnected(), 3)
+        assert irc.connected is None
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(main())
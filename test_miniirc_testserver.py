@@ -0,0 +1,187 @@
+#!/bin/false
+import miniirc, miniirc_testserver, pytest, shutil, ssl, subprocess
+import threading, time
+
+
+def _wait(irc, event):
+    done = threading.Event()
+    irc.Handler(event, colon=False)(lambda irc, hostmask, args: done.set())
+    return done
+
+
+def test_registration(monkeypatch):
+    monkeypatch.setattr(miniirc, '_colon_warning', False)
+    with miniirc_testserver.TestServer(accounts={'user': 'hunter2'},
+                                       write_size=7) as server:
+        # Register the handler before connecting so that 366 can't be missed
+        irc = server.connect_irc('miniirc-test', channels=['#a', '#b'],
+                                 ns_identity=('user', 'hunter2'),
+                                 auto_connect=False)
+        joined = _wait(irc, '366')
+        irc.connect()
+        try:
+            server.wait_for_clients(1)
+            client, = server.registered_clients()
+            assert client.nick == 'miniirc-test'
+            assert client.account == 'user'
+            assert {'sasl', 'message-tags'} <= client.caps
+
+            # Channels should be joined after registering
+            assert joined.wait(5)
+            assert client.channels == {'#a', '#b'}
+            assert ('JOIN #a,#b' in client.received or
+                    'JOIN #b,#a' in client.received)
+
+            # The nickname should be in use for a second client
+            irc2 = server.connect_irc('miniirc-test')
+            try:
+                server.wait_for_clients(2)
+                assert {c.nick for c in server.clients} == {
+                    'miniirc-test', 'miniirc-test_'
+                }
+            finally:
+                irc2.disconnect()
+        finally:
+            irc.disconnect()
+
+
+def test_sasl_failure(monkeypatch):
+    monkeypatch.setattr(miniirc, '_colon_warning', False)
+    with miniirc_testserver.TestServer(accounts={}) as server:
+        irc = server.connect_irc('miniirc-test', ns_identity='user hunter2')
+        try:
+            server.wait_for_clients(1)
+            client, = server.registered_clients()
+            assert client.account is None
+
+            # The 904 handlers run in parallel, so CAP END may be sent first
+            deadline = time.monotonic() + 5
+            while ('AUTHENTICATE *' not in client.received and
+                    time.monotonic() < deadline):
+                time.sleep(0.01)
+            assert 'AUTHENTICATE *' in client.received
+        finally:
+            irc.disconnect()
+
+
+def test_measure_load(monkeypatch):
+    monkeypatch.setattr(miniirc, '_colon_warning', False)
+    with miniirc_testserver.TestServer(latency=0.001,
+                                       read_delay=0.001) as server:
+        ircs = [server.connect_irc('miniirc-test' + str(i))
+                for i in range(3)]
+        try:
+            report = miniirc_testserver.measure_load(server, ircs, 100,
+                                                     timeout=10)
+            assert report.clients == 3
+            assert report.sent == report.received == 300
+            assert (0 < report.latency_p50 <= report.latency_p99 <=
+                    report.latency_max)
+
+            # The handler should only be added once
+            report = miniirc_testserver.measure_load(server, ircs[:1], 50,
+                                                     rate=1000, timeout=10)
+            assert report.received == 50
+            assert report.seconds >= 0.04
+        finally:
+            for irc in ircs:
+                irc.disconnect()
+
+
+def test_wait_for_clients_timeout():
+    with miniirc_testserver.TestServer() as server:
+        with pytest.raises(TimeoutError):
+            server.wait_for_clients(1, timeout=0.01)
+
+
+def test_reconnect(monkeypatch):
+    monkeypatch.setattr(miniirc, '_colon_warning', False)
+    policy = miniirc.ReconnectPolicy(0.1, first_delay=0)
+    with miniirc_testserver.TestServer() as server:
+        ircs = [server.connect_irc('miniirc-test' + str(i), persist=True,
+                                   channels=['#a'], reconnect_policy=policy)
+                for i in range(3)]
+        try:
+            times = miniirc_testserver.measure_reconnect(server, 3, timeout=5)
+            assert len(times) == 3 and times[-1] < 2
+            assert server.registrations == 6
+            for irc in ircs:
+                for i in range(100):
+                    if 'joins' in irc.connect_timings:
+                        break
+                    time.sleep(0.01)
+                assert set(irc.connect_timings) == {
+                    'backoff', 'dns', 'tcp', 'registration', 'joins'
+                }
+                assert irc.connect_timings['backoff'] == 0
+                assert irc._reconnect_attempts == 0
+        finally:
+            for irc in ircs:
+                irc.disconnect()
+
+
+# TLS session resumption, this needs the openssl command to create a
+# certificate.
+@pytest.mark.skipif(not shutil.which('openssl'), reason='needs openssl')
+def test_tls_resumption(monkeypatch, tmp_path):
+    monkeypatch.setattr(miniirc, '_colon_warning', False)
+    cert, key = str(tmp_path / 'cert.pem'), str(tmp_path / 'key.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                           '-nodes', '-keyout', key, '-out', cert, '-days',
+                           '1', '-subj', '/CN=localhost'],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    server_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_ctx.load_cert_chain(cert, key)
+
+    # session= should only be passed when there's a session to resume, it
+    # isn't supported by Python 3.4 and 3.5.
+    wrap_kwargs = []
+
+    class ClientContext(ssl.SSLContext):
+        def wrap_socket(self, *args, **kwargs):
+            wrap_kwargs.append(sorted(kwargs))
+            return super().wrap_socket(*args, **kwargs)
+
+    client_ctx = ClientContext(ssl.PROTOCOL_TLS_CLIENT)
+    client_ctx.load_verify_locations(cert)
+    client_ctx.check_hostname = False
+
+    with miniirc_testserver.TestServer(ssl_context=server_ctx) as server:
+        irc = server.connect_irc('miniirc-test', persist=True,
+                                 ssl_context=client_ctx,
+                                 reconnect_policy=miniirc.ReconnectPolicy())
+        try:
+            server.wait_for_clients(1)
+            assert not irc.sock.session_reused
+            time.sleep(0.1)
+            miniirc_testserver.measure_reconnect(server, 1, timeout=5)
+            assert irc.sock.session_reused
+            assert 'tls' in irc.connect_timings
+            assert wrap_kwargs == [['server_hostname'],
+                                   ['server_hostname', 'session']]
+        finally:
+            irc.disconnect()
+
+
+# A line that doesn't fit in the receive buffer should disconnect the client
+# without stopping the reactor.
+def test_long_line(monkeypatch):
+    monkeypatch.setattr(miniirc, '_colon_warning', False)
+    reactor = miniirc.Reactor()
+    with miniirc_testserver.TestServer() as server:
+        irc = server.connect_irc('miniirc-test', reactor=reactor)
+        try:
+            server.wait_for_clients(1)
+            client, = server.registered_clients()
+            client.send_raw(b'x' * 70000)
+            assert irc._reactor_done.wait(5)
+            assert irc.connected is None
+
+            # Other clients using the reactor should still work
+            irc2 = server.connect_irc('miniirc-test2', reactor=reactor)
+            try:
+                server.wait_for_clients(1, min_registrations=2)
+            finally:
+                irc2.disconnect()
+        finally:
+            irc.disconnect()